@@ -4,8 +4,7 @@ import bluetooth
 import time
 from queue import Queue, Empty
 
-from protocol import Protocol
-from communication import AbstractSerialInterface
+from communication import AbstractSerialInterface, StreamFramer, FRAME_COMMENT, IO_MODE_EVENT
 from sharedResources import SharedRsc, sharedResources
 import definitions
 
@@ -45,8 +44,8 @@ class AppMessageProtocol:
             logger.warning("Invalid mode: %s", val)
             return
         try:
-            cls.sharedResources.get("TASK.MODE.REQ").put_nowait(val)
-            logger.info(f"Task mode set to {val}")
+            cls.sharedResources.put("TASK.MODE.REQ", val)
+            logger.info("Task mode set to %s", val)
         except Exception as e:
             logger.error("Error setting task mode: %s", e)
 
@@ -56,8 +55,8 @@ class AppMessageProtocol:
             logger.warning("Invalid task status: %s", val)
             return
         try:
-            cls.sharedResources.get("TASK.STATUS.REQ").put_nowait(val)
-            logger.info(f"Task status set to {val}")
+            cls.sharedResources.put("TASK.STATUS.REQ", val)
+            logger.info("Task status set to %s", val)
         except Exception as e:
             logger.error("Error setting task status: %s", e)
 
@@ -67,8 +66,8 @@ class AppMessageProtocol:
             logger.warning("Invalid move command: %s", val)
             return
         try:
-            cls.sharedResources.get("APP.MOVE.REQ").put_nowait(val)
-            logger.info(f"Move command received: {val}")
+            cls.sharedResources.put("APP.MOVE.REQ", val)
+            logger.info("Move command received: %s", val)
         except Exception as e:
             logger.error("Error processing move command: %s", e)
 
@@ -78,9 +77,9 @@ class AppMessageProtocol:
             str(cls.sharedResources.get("TASK.MODE")).startswith("TASK")):
             logger.warning("Map update rejected; task in progress.")
             return
-        cls.sharedResources.set("MAP.NEW.FLAG", 1)
-        cls.sharedResources.set("MAP.STR", val)
-        logger.info(f"Map updated: {val}")
+        # One transaction, so MAP.NEW.FLAG is never seen without the matching MAP.STR.
+        cls.sharedResources.update({"MAP.STR": val, "MAP.NEW.FLAG": 1})
+        logger.info("Map updated: %s", val)
 
     @classmethod
     def call_cmd(cls, cmd, val):
@@ -106,9 +105,15 @@ class AppInterface(AbstractSerialInterface):
     def set_shared_resources(self, shared_resources):
         self.sharedResources = shared_resources
 
+    def create_framer(self):
+        # Android commands are wrapped in /* ... */
+        return StreamFramer(FRAME_COMMENT)
+
     def rx_callback(self, msg):
         # Automatically process the message via the protocol.
-        logger.info(f"Android RX: {msg}")
+        if isinstance(msg, (bytes, bytearray)):
+            msg = msg.decode('utf-8', errors='replace')
+        logger.info("Android RX: %s", msg)
         self.msg_protocol_cls.decode_message(msg)
 
     def setup_bluetooth(self, bt_port=1, bind_timeout=10):
@@ -123,7 +128,7 @@ class AppInterface(AbstractSerialInterface):
             try:
                 server_sock.bind(("", bt_port))
                 server_sock.listen(1)
-                logger.info(f"[BT] Bound to port {bt_port}")
+                logger.info("[BT] Bound to port %s", bt_port)
                 break
             except Exception as e:
                 logger.error("[BT] Could not bind to port %d: %s", bt_port, e)
@@ -131,11 +136,12 @@ class AppInterface(AbstractSerialInterface):
                     logger.error("Bluetooth bind timeout reached.")
                     break
                 time.sleep(1)
-        logger.info(f"[BT] Waiting for connection on RFCOMM channel {bt_port}")
+        logger.info("[BT] Waiting for connection on RFCOMM channel %s", bt_port)
 
 class AndroidApp:
-    def __init__(self, port):
-        self.interface = AppInterface(port=port, baudrate=115200)
+    def __init__(self, port, auto_reconnect=False, io_mode=IO_MODE_EVENT):
+        self.interface = AppInterface(port=port, baudrate=115200, io_mode=io_mode,
+                                      auto_reconnect=auto_reconnect)
         self.interface.set_shared_resources(sharedResources)
         self.interface.setup_protocol()
 
@@ -148,7 +154,7 @@ class AndroidApp:
     def send_command(self, command: str):
         """Standardized API to send any command from Android side."""
         self.interface.tx(command)
-        logger.info(f"Sent command from Android: {command}")
+        logger.info("Sent command from Android: %s", command)
 
     def transmit_map_details(self):
         """Sends map details using the standardized API."""
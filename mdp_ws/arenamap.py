@@ -0,0 +1,210 @@
+import functools
+import math
+import re
+
+import numpy as np
+
+# Arena geometry in cm. The origin is the bottom-left corner of the arena,
+# x points right and y up; headings are radians counter-clockwise from +x
+# (the car starts facing +y, i.e. pi / 2, as in pose.PoseEstimator).
+ARENA_SIZE = 200
+MAP_CELL = 10  # Obstacle coordinates in MAP strings are in cells of this size
+OBSTACLE_SIZE = 10
+MAX_OBSTACLES = 8  # Most obstacles placed in a TASK1 arena
+
+# Image face of an obstacle as sent in MAP strings; FACING_NONE = no image.
+FACING_NONE = 0
+FACING_N = 1
+FACING_E = 2
+FACING_S = 3
+FACING_W = 4
+FACINGS = (FACING_NONE, FACING_N, FACING_E, FACING_S, FACING_W)
+# Outward normal of each face as a heading.
+FACING_THETA = {FACING_N: math.pi / 2, FACING_E: 0.0, FACING_S: 3 * math.pi / 2, FACING_W: math.pi}
+
+OBSTACLE_COLUMNS = ("id", "x", "y", "facing")
+_TUPLE = re.compile(r"\(([^()]*)\)")
+_INT = re.compile(r"-?\d+")
+
+
+def parse_map(text):
+    """
+    Parse an Android MAP string, e.g. "[(0, 00, 00, 1),(1, 05, 12, 2)]".
+
+    Args:
+        text: MAP payload; tuples of (id, x, y, facing) with x, y in MAP_CELL units
+
+    Returns:
+        int32 array of shape (n, 4) with columns OBSTACLE_COLUMNS
+
+    Raises:
+        ValueError: Malformed string, obstacle outside the arena, unknown
+            facing or duplicate id
+    """
+    tuples = _TUPLE.findall(text)
+    if not tuples:
+        if text.strip(" []") == "":
+            return np.zeros((0, 4), dtype=np.int32)
+        raise ValueError(f"No obstacles in MAP string: {text!r}")
+    # One regex pass over all tuples, one conversion to an array.
+    values = _INT.findall(",".join(tuples))
+    if len(values) != 4 * len(tuples):
+        raise ValueError(f"Every obstacle needs (id, x, y, facing): {text!r}")
+    table = np.array(values, dtype=np.int32).reshape(-1, 4)
+    cells = ARENA_SIZE // MAP_CELL
+    xy = table[:, 1:3]
+    if ((xy < 0) | (xy >= cells)).any():
+        raise ValueError(f"Obstacle outside the {cells}x{cells} arena: {text!r}")
+    if not np.isin(table[:, 3], FACINGS).all():
+        raise ValueError(f"Facing must be one of {FACINGS}: {text!r}")
+    if len(np.unique(table[:, 0])) != len(table):
+        raise ValueError(f"Duplicate obstacle id: {text!r}")
+    return table
+
+
+@functools.lru_cache(maxsize=None)
+def footprint_kernels(length, width, resolution, headings):
+    """
+    Grid offsets covered by the car's rectangular footprint at each heading.
+
+    The footprint is centred on the car's reference point, `length` along the
+    heading and `width` across it. It is sampled at half the grid resolution,
+    so kernel h holds every (dx, dy) cell offset the footprint touches when
+    its reference point is at a cell centre and its heading is 2*pi*h/headings.
+
+    Returns:
+        Tuple of `headings` int arrays of shape (k, 2)
+    """
+    step = resolution / 2.0
+    along = np.linspace(-length / 2.0, length / 2.0, int(math.ceil(length / step)) + 1)
+    across = np.linspace(-width / 2.0, width / 2.0, int(math.ceil(width / step)) + 1)
+    px, py = (a.ravel() for a in np.meshgrid(along, across))
+    kernels = []
+    for h in range(headings):
+        theta = 2 * math.pi * h / headings
+        wx = px * math.cos(theta) - py * math.sin(theta)
+        wy = px * math.sin(theta) + py * math.cos(theta)
+        offsets = np.stack((np.floor(wx / resolution + 0.5), np.floor(wy / resolution + 0.5)), axis=1)
+        kernels.append(np.unique(offsets.astype(np.int64), axis=0))
+    return tuple(kernels)
+
+
+class ArenaMap:
+    """
+    Obstacles of one MAP string rasterized for collision queries.
+
+    `occupancy[iy, ix]` is True where an obstacle covers grid cell (ix, iy)
+    (each cell `resolution` cm square). `cspace[h, iy, ix]` is True where the
+    car, with its reference point at that cell's centre and heading index h,
+    would touch an obstacle or leave the arena; the footprint is inflated by
+    `clearance` on every side. Both are computed once, so a collision check
+    is a single array lookup.
+
+    Args:
+        obstacles: Obstacle table from parse_map()
+        resolution: Grid cell size in cm; must divide MAP_CELL
+        length: Car footprint length in cm (along its heading)
+        width: Car footprint width in cm
+        clearance: Extra margin around the footprint in cm
+        headings: Number of discrete headings in cspace
+    """
+
+    def __init__(self, obstacles, resolution=5, length=22.0, width=20.0, clearance=3.0, headings=16):
+        if MAP_CELL % resolution:
+            raise ValueError(f"resolution must divide {MAP_CELL}")
+        self.obstacles = np.asarray(obstacles, dtype=np.int32).reshape(-1, 4)
+        self.resolution = resolution
+        self.length = length
+        self.width = width
+        self.clearance = clearance
+        self.headings = headings
+        self.size = ARENA_SIZE // resolution
+        self.occupancy = self._rasterize()
+        self.cspace = self._inflate()
+
+    @classmethod
+    def from_string(cls, text, **kwargs):
+        return cls(parse_map(text), **kwargs)
+
+    @classmethod
+    def from_arrays(cls, obstacles, cspace, resolution=5, length=22.0, width=20.0, clearance=3.0):
+        """
+        ArenaMap around an already computed configuration space, e.g. one
+        shared with a planner worker process; only the occupancy grid is rebuilt.
+        """
+        arena = cls.__new__(cls)
+        arena.obstacles = np.asarray(obstacles, dtype=np.int32).reshape(-1, 4)
+        arena.resolution = resolution
+        arena.length = length
+        arena.width = width
+        arena.clearance = clearance
+        arena.headings = cspace.shape[0]
+        arena.size = ARENA_SIZE // resolution
+        arena.occupancy = arena._rasterize()
+        arena.cspace = cspace
+        return arena
+
+    def __repr__(self):
+        return f"ArenaMap({len(self.obstacles)} obstacles, {self.size}x{self.size} @ {self.resolution} cm)"
+
+    def _rasterize(self):
+        cells = ARENA_SIZE // MAP_CELL
+        coarse = np.zeros((cells, cells), dtype=bool)
+        coarse[self.obstacles[:, 2], self.obstacles[:, 1]] = True
+        scale = MAP_CELL // self.resolution
+        return coarse.repeat(scale, axis=0).repeat(scale, axis=1)
+
+    def _inflate(self):
+        kernels = footprint_kernels(self.length + 2 * self.clearance, self.width + 2 * self.clearance,
+                                    self.resolution, self.headings)
+        pad = max(int(np.abs(kernel).max()) for kernel in kernels)
+        n = self.size
+        # Everything outside the arena counts as an obstacle.
+        padded = np.ones((n + 2 * pad, n + 2 * pad), dtype=bool)
+        padded[pad:pad + n, pad:pad + n] = self.occupancy
+        cspace = np.zeros((self.headings, n, n), dtype=bool)
+        for h, kernel in enumerate(kernels):
+            layer = cspace[h]
+            for dx, dy in kernel:
+                layer |= padded[pad + dy:pad + dy + n, pad + dx:pad + dx + n]
+        return cspace
+
+    # Queries
+
+    def heading_index(self, theta):
+        """
+        Nearest discrete heading index of `theta` (radians; scalar or array).
+        """
+        return np.rint(np.asarray(theta) * (self.headings / (2 * math.pi))).astype(np.int64) % self.headings
+
+    def cell(self, x, y):
+        """
+        Grid cell (ix, iy) containing the point (x, y) cm; may lie outside the grid.
+        """
+        return int(x // self.resolution), int(y // self.resolution)
+
+    def cell_center(self, ix, iy):
+        return (ix + 0.5) * self.resolution, (iy + 0.5) * self.resolution
+
+    def is_free(self, x, y, theta):
+        """
+        True if the car at (x, y) cm with heading `theta` touches no obstacle
+        and stays inside the arena.
+        """
+        ix, iy = self.cell(x, y)
+        if not (0 <= ix < self.size and 0 <= iy < self.size):
+            return False
+        h = int(round(theta * self.headings / (2 * math.pi))) % self.headings
+        return not self.cspace[h, iy, ix]
+
+    def free_mask(self, x, y, theta):
+        """
+        Vectorized is_free() over arrays of poses.
+        """
+        ix = np.floor_divide(np.asarray(x), self.resolution).astype(np.int64)
+        iy = np.floor_divide(np.asarray(y), self.resolution).astype(np.int64)
+        ix, iy, h = np.broadcast_arrays(ix, iy, self.heading_index(theta))
+        inside = (ix >= 0) & (ix < self.size) & (iy >= 0) & (iy < self.size)
+        free = np.zeros(ix.shape, dtype=bool)
+        free[inside] = ~self.cspace[h[inside], iy[inside], ix[inside]]
+        return free
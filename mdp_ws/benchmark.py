@@ -0,0 +1,440 @@
+import argparse
+import json
+import logging
+import math
+import os
+import platform
+import pty
+import select
+import sys
+import threading
+import time
+import tty
+
+from communication import AbstractSerialInterface, StreamFramer, IO_MODE_POLL, IO_MODE_EVENT, FRAME_NEWLINE
+from car import CarInterface, CarMessageProtocol, CarBinaryProtocol, Car
+from caremulator import CarEmulator
+from sharedResources import sharedResources
+from arenamap import MAX_OBSTACLES
+
+logger = logging.getLogger("Benchmark")
+
+PROTOCOLS = {"text": CarMessageProtocol, "binary": CarBinaryProtocol}
+# The benchmarks drive their interfaces from plain threads; IO_MODE_ASYNC would
+# need them connected on a running event loop, so it is not offered here.
+BENCH_IO_MODES = [IO_MODE_POLL, IO_MODE_EVENT]
+BENCHMARKS = ["serial_rtt", "serial_tx", "serial_rx", "car_rtt", "car_rx", "app_rx", "task1_order"]
+
+
+def percentile(sorted_values, pct):
+    """
+    Nearest-rank percentile of an already sorted list.
+    """
+    if not sorted_values:
+        return None
+    rank = max(0, min(len(sorted_values) - 1, int(round(pct / 100.0 * len(sorted_values) + 0.5)) - 1))
+    return sorted_values[rank]
+
+
+def latency_summary(samples):
+    """
+    p50/p95/p99/mean/max of latency samples (seconds), reported in milliseconds.
+    """
+    values = sorted(samples)
+    if not values:
+        return None
+    return {
+        "p50": percentile(values, 50) * 1e3,
+        "p95": percentile(values, 95) * 1e3,
+        "p99": percentile(values, 99) * 1e3,
+        "mean": sum(values) / len(values) * 1e3,
+        "max": values[-1] * 1e3,
+    }
+
+
+class LoopbackPty:
+    """
+    PTY pair whose slave end is opened by the interface under test while the
+    benchmark reads and writes the master end directly.
+    """
+
+    def __init__(self):
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)
+        self.port = os.ttyname(self.slave_fd)
+
+    def write_all(self, data: bytes):
+        view = memoryview(data)
+        while view:
+            written = os.write(self.master_fd, view)
+            view = view[written:]
+
+    def close(self):
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+
+class LineInterface(AbstractSerialInterface):
+    """
+    Minimal newline-framed interface that hands frames to `on_frame`.
+    """
+
+    def __init__(self, port, on_frame, io_mode=IO_MODE_EVENT):
+        self.on_frame = on_frame
+        super().__init__(port, io_mode=io_mode, timeout=0.2)
+
+    def create_framer(self):
+        return StreamFramer(FRAME_NEWLINE)
+
+    def rx_callback(self, data):
+        self.on_frame(data)
+
+
+class _Counter:
+    def __init__(self, target):
+        self.target = target
+        self.count = 0
+        self.last = None
+        self.done = threading.Event()
+
+    def hit(self, *args):
+        self.count += 1
+        self.last = time.perf_counter()
+        if self.count >= self.target:
+            self.done.set()
+
+
+def _rate(count, elapsed):
+    return count / elapsed if elapsed > 0 else None
+
+
+def bench_serial_rtt(io_mode, count, **_):
+    """
+    Round trip through AbstractSerialInterface: tx() -> PTY echo -> RX callback.
+    """
+    loop = LoopbackPty()
+    arrived = threading.Event()
+    iface = LineInterface(loop.port, lambda frame: arrived.set(), io_mode)
+    running = True
+
+    def echo():
+        while running:
+            try:
+                data = os.read(loop.master_fd, 4096)
+            except OSError:
+                return
+            loop.write_all(data)
+
+    echo_thread = threading.Thread(target=echo, daemon=True)
+    echo_thread.start()
+    iface.connect()
+    samples = []
+    lost = 0
+    cpu_start = time.process_time()
+    for i in range(count):
+        arrived.clear()
+        start = time.perf_counter()
+        iface.tx(b"%06d\n" % i)
+        if arrived.wait(2.0):
+            samples.append(time.perf_counter() - start)
+        else:
+            lost += 1
+    cpu = time.process_time() - cpu_start
+    running = False
+    iface.disconnect()
+    loop.close()
+    return {
+        "latency_ms": latency_summary(samples),
+        "sent": count,
+        "received": len(samples),
+        "dropped": lost,
+        "cpu_us_per_msg": cpu / count * 1e6,
+    }
+
+
+def bench_serial_tx(io_mode, count, **_):
+    """
+    Sustained TX: queue `count` messages at once and time until the last byte reaches the PTY.
+    """
+    loop = LoopbackPty()
+    iface = LineInterface(loop.port, lambda frame: None, io_mode)
+    iface.max_tx_backlog = count  # Measure the link, not the backlog bound
+    iface.connect()
+    message = b"SF010\n"
+    expected = len(message) * count
+    received = 0
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    for _ in range(count):
+        iface.tx(message)
+    deadline = start + max(10.0, count * 0.2)
+    while received < expected and time.perf_counter() < deadline:
+        readable, _, _ = select.select([loop.master_fd], [], [], 0.5)
+        if readable:
+            received += len(os.read(loop.master_fd, 65536))
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpu_start
+    iface.disconnect()
+    loop.close()
+    delivered = received // len(message)
+    return {
+        "msgs_per_s": _rate(delivered, elapsed),
+        "sent": count,
+        "received": delivered,
+        "dropped": count - delivered,
+        "cpu_us_per_msg": cpu / count * 1e6,
+    }
+
+
+def _burst_rx(loop, payload, counter, count, timeout):
+    cpu_start = time.process_time()
+    start = time.perf_counter()
+    loop.write_all(payload)
+    counter.done.wait(timeout)
+    end = counter.last or time.perf_counter()
+    cpu = time.process_time() - cpu_start
+    return {
+        "msgs_per_s": _rate(counter.count, end - start),
+        "sent": count,
+        "received": counter.count,
+        "dropped": count - counter.count,
+        "cpu_us_per_msg": cpu / count * 1e6,
+    }
+
+
+def bench_serial_rx(io_mode, count, **_):
+    """
+    Burst RX: write `count` lines into the PTY at once and count framed messages.
+    """
+    loop = LoopbackPty()
+    counter = _Counter(count)
+    iface = LineInterface(loop.port, counter.hit, io_mode)
+    iface.connect()
+    result = _burst_rx(loop, b"GYRO: 123.45\n" * count, counter, count, max(10.0, count * 0.2))
+    iface.disconnect()
+    loop.close()
+    return result
+
+
+def bench_car_rtt(io_mode, count, protocol, **_):
+    """
+    Car.move() -> emulator ACK round trip through CarInterface and the decoder.
+    """
+    emulator = CarEmulator(binary=protocol == "binary", telemetry_hz=0, speed=1e6, turn_rate=1e6)
+    emulator.start()
+    car = Car(emulator.port, binary=protocol == "binary", reliable=True, window_size=1, ack_timeout=1.0)
+    car.interface.io_mode = io_mode
+    acked = threading.Event()
+    car.interface.add_listener(lambda key, value: acked.set() if key == "CAR.ACK" else None)
+    car.connect()
+    samples = []
+    lost = 0
+    cpu_start = time.process_time()
+    for _ in range(count):
+        acked.clear()
+        start = time.perf_counter()
+        car.move("F", 10)
+        if acked.wait(2.0):
+            samples.append(time.perf_counter() - start)
+        else:
+            lost += 1
+        car.link.wait_idle(2.0)
+    cpu = time.process_time() - cpu_start
+    car.disconnect()
+    emulator.stop()
+    return {
+        "latency_ms": latency_summary(samples),
+        "sent": count,
+        "received": len(samples),
+        "dropped": lost,
+        "retransmits": car.link.stats["retransmits"],
+        "cpu_us_per_msg": cpu / count * 1e6,
+    }
+
+
+def bench_car_rx(io_mode, count, protocol, **_):
+    """
+    Telemetry burst decoded by CarInterface with the selected protocol.
+    """
+    protocol_cls = PROTOCOLS[protocol]
+    loop = LoopbackPty()
+    counter = _Counter(count)
+    iface = CarInterface(loop.port, timeout=0.2, io_mode=io_mode, msg_protocol_cls=protocol_cls)
+    iface.set_shared_resources(sharedResources)
+    iface.setup_protocol()
+    iface.add_listener(counter.hit)
+    iface.connect()
+    if protocol == "binary":
+        packet = CarBinaryProtocol.encode_gyro(123.45)
+    else:
+        packet = b"GYRO: 123.45\n"
+    result = _burst_rx(loop, packet * count, counter, count, max(10.0, count * 0.2))
+    result["bytes_per_msg"] = len(packet)
+    iface.disconnect()
+    loop.close()
+    return result
+
+
+def bench_app_rx(io_mode, count, **_):
+    """
+    Burst of /*MAP=...*/ commands decoded by AppInterface.
+    """
+    from androidapp import AppInterface, AppMessageProtocol  # Needs PyBluez
+
+    class CountingAppProtocol(AppMessageProtocol):
+        @classmethod
+        def call_cmd(cls, cmd, val):
+            counter.hit()
+            super().call_cmd(cmd, val)
+
+    loop = LoopbackPty()
+    counter = _Counter(count)
+    iface = AppInterface(loop.port, timeout=0.2, io_mode=io_mode)
+    iface.msg_protocol_cls = CountingAppProtocol
+    iface.set_shared_resources(sharedResources)
+    iface.setup_protocol()
+    iface.connect()
+    message = b"/*MAP=[(0, 00, 00, 1),(1, 00, 00, 2)]*/"
+    result = _burst_rx(loop, message * count, counter, count, max(10.0, count * 0.2))
+    iface.disconnect()
+    loop.close()
+    return result
+
+
+def random_layout(rng, count):
+    """
+    MAP string with `count` obstacles on distinct cells outside the start zone, random facings.
+    """
+    from arenamap import ARENA_SIZE, MAP_CELL
+    cells = ARENA_SIZE // MAP_CELL
+    free = [(x, y) for x in range(cells) for y in range(cells) if x >= 5 or y >= 5]
+    picks = rng.sample(free, count)
+    return "[" + ",".join(f"({i}, {x:02d}, {y:02d}, {rng.randint(1, 4)})"
+                          for i, (x, y) in enumerate(picks)) + "]"
+
+
+def bench_task1_order(count, obstacles, **_):
+    """
+    TASK1 planning on `count` random layouts: planner cost matrix (in process
+    and on the persistent planner pool, started before timing), exact and heuristic
+    visiting order, and the saving over visiting in id order.
+    """
+    import random
+    from arenamap import ArenaMap
+    from planner import Planner, START_POSE, capture_poses
+    from tour import (cost_matrix, parallel_cost_matrix, planner_pool, held_karp, improve_order,
+                      nearest_neighbour, path_cost)
+
+    if (os.cpu_count() or 1) > 1:
+        planner_pool().warm()
+    rng = random.Random(0)
+    matrix_s, parallel_s, exact_s, heuristic_s = [], [], [], []
+    savings, heuristic_gap = [], []
+    for _ in range(count):
+        arena = ArenaMap.from_string(random_layout(rng, obstacles))
+        planner = Planner(arena)
+        goals = list(capture_poses(planner, arena.obstacles).values())
+        start = time.perf_counter()
+        cost = cost_matrix(planner, [START_POSE] + goals)
+        matrix_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        parallel_cost_matrix(arena, [START_POSE] + goals)
+        parallel_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        _, exact = held_karp(cost)
+        exact_s.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        nodes = range(1, len(cost))
+        _, heuristic = improve_order(cost, nearest_neighbour(cost, nodes))
+        heuristic_s.append(time.perf_counter() - start)
+        in_order = path_cost(cost, list(nodes))
+        if math.isfinite(exact):
+            if math.isfinite(in_order):
+                savings.append(1.0 - exact / in_order)
+            if math.isfinite(heuristic):
+                heuristic_gap.append(heuristic / exact - 1.0)
+    return {
+        "obstacles": obstacles,
+        "cost_matrix_ms": latency_summary(matrix_s),
+        "parallel_cost_matrix_ms": latency_summary(parallel_s),
+        "workers": os.cpu_count(),
+        "exact_order_ms": latency_summary(exact_s),
+        "heuristic_order_ms": latency_summary(heuristic_s),
+        "saving_vs_id_order": sum(savings) / len(savings) if savings else None,
+        "heuristic_gap": sum(heuristic_gap) / len(heuristic_gap) if heuristic_gap else None,
+    }
+
+
+BENCHMARK_FUNCS = {
+    "serial_rtt": bench_serial_rtt,
+    "serial_tx": bench_serial_tx,
+    "serial_rx": bench_serial_rx,
+    "car_rtt": bench_car_rtt,
+    "car_rx": bench_car_rx,
+    "app_rx": bench_app_rx,
+    "task1_order": bench_task1_order,
+}
+PROTOCOL_BENCHMARKS = ["car_rtt", "car_rx"]
+# Run once, independent of io_mode, with `layouts` as their count.
+PLANNING_BENCHMARKS = ["task1_order"]
+
+
+def run(benchmarks, io_modes, protocols, count, poll_count, layouts=10, obstacles=8):
+    results = []
+    for name in benchmarks:
+        for io_mode in (io_modes if name not in PLANNING_BENCHMARKS else [None]):
+            for protocol in (protocols if name in PROTOCOL_BENCHMARKS else [None]):
+                if name in PLANNING_BENCHMARKS:
+                    n = layouts
+                else:
+                    n = count if io_mode == IO_MODE_EVENT else poll_count
+                entry = {"benchmark": name, "io_mode": io_mode, "protocol": protocol, "count": n}
+                logger.info("Running %s (io_mode=%s, protocol=%s, count=%d)", name, io_mode, protocol, n)
+                try:
+                    entry.update(BENCHMARK_FUNCS[name](io_mode=io_mode, count=n, protocol=protocol,
+                                                       obstacles=obstacles))
+                except ImportError as e:
+                    entry["skipped"] = str(e)
+                results.append(entry)
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serial link latency/throughput benchmarks over PTY loopback, "
+                                                 "and TASK1 planning benchmarks")
+    parser.add_argument("--benchmarks", nargs="+", choices=BENCHMARKS, default=BENCHMARKS)
+    parser.add_argument("--io-modes", nargs="+", choices=BENCH_IO_MODES, default=[IO_MODE_EVENT])
+    parser.add_argument("--protocols", nargs="+", choices=list(PROTOCOLS), default=list(PROTOCOLS))
+    parser.add_argument("--count", type=int, default=2000, help="Messages per benchmark in event mode")
+    parser.add_argument("--poll-count", type=int, default=50,
+                        help="Messages per benchmark in poll mode (10 msg/s TX cap)")
+    parser.add_argument("--layouts", type=int, default=10, help="Random arenas per planning benchmark")
+    parser.add_argument("--obstacles", type=int, default=MAX_OBSTACLES, help="Obstacles per random arena")
+    parser.add_argument("--output", help="Write JSON results to this file instead of stdout")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING, stream=sys.stderr)
+    logger.setLevel(logging.INFO)
+    report = {
+        "meta": {
+            "timestamp": time.time(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "machine": platform.machine(),
+        },
+        "results": run(args.benchmarks, args.io_modes, args.protocols, args.count, args.poll_count,
+                       args.layouts, args.obstacles),
+    }
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text)
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,213 @@
+import argparse
+import logging
+import mmap
+import os
+import struct
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("Capture")
+
+# File layout: MAGIC, then records of RECORD_HEADER followed by `length` payload bytes.
+# A DIR_PORT record declares the port name (payload, UTF-8) for a port id;
+# it precedes the first RX/TX record of that port.
+MAGIC = b"MDPCAP01"
+RECORD_HEADER = struct.Struct("<QBBI")  # monotonic ns, direction, port id, payload length
+
+DIR_RX = 0
+DIR_TX = 1
+DIR_PORT = 2
+DIRECTION_NAMES = {DIR_RX: "RX", DIR_TX: "TX", DIR_PORT: "PORT"}
+
+
+class WireRecorder:
+    """
+    Append-only binary capture of serial traffic.
+
+    `record_rx`/`record_tx` only take a timestamp and append to an in-memory
+    queue; a background thread writes batches to disk every `flush_interval`
+    seconds, so the I/O threads never touch the file.
+    """
+
+    def __init__(self, path, flush_interval=0.05):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._queue = deque()  # (t_ns, direction, port, data); deque.append is thread-safe
+        self._port_ids = {}
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._stop = threading.Event()
+        self._writer = threading.Thread(target=self._write_loop, daemon=True)
+        self._writer.start()
+        self.records = 0
+
+    def record_rx(self, port, data):
+        self._queue.append((time.monotonic_ns(), DIR_RX, port, bytes(data)))
+
+    def record_tx(self, port, data):
+        self._queue.append((time.monotonic_ns(), DIR_TX, port, bytes(data)))
+
+    def close(self):
+        self._stop.set()
+        self._writer.join()
+        self._drain()
+        self._file.close()
+        logger.info("Capture %s closed; %d records", self.path, self.records)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            self._drain()
+
+    def _drain(self):
+        chunks = []
+        queue = self._queue
+        while queue:
+            t_ns, direction, port, data = queue.popleft()
+            port_id = self._port_ids.get(port)
+            if port_id is None:
+                port_id = self._port_ids[port] = len(self._port_ids)
+                name = port.encode("utf-8")
+                chunks.append(RECORD_HEADER.pack(t_ns, DIR_PORT, port_id, len(name)))
+                chunks.append(name)
+            chunks.append(RECORD_HEADER.pack(t_ns, direction, port_id, len(data)))
+            chunks.append(data)
+            self.records += 1
+        if chunks:
+            self._file.write(b"".join(chunks))
+            self._file.flush()
+
+
+class CaptureReader:
+    """
+    Memory-mapped reader for a WireRecorder capture.
+    Iterating yields (t_ns, direction, port, payload) with payload as a memoryview.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError(f"{path} is not a capture file")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a capture file")
+        self._view = memoryview(self._map)
+        self.ports = {}
+
+    def __iter__(self):
+        offset = len(MAGIC)
+        end = len(self._map)
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        while offset + header_size <= end:
+            t_ns, direction, port_id, length = unpack_from(self._map, offset)
+            offset += header_size
+            if offset + length > end:
+                logger.warning("Truncated record at end of %s", self.path)
+                return
+            offset += length
+            if direction == DIR_PORT:
+                self.ports[port_id] = self._map[offset - length:offset].decode("utf-8")
+                continue
+            # The view is not kept in a local so a suspended iterator does not pin the map.
+            yield t_ns, direction, self.ports.get(port_id, str(port_id)), self._view[offset - length:offset]
+
+    def close(self):
+        self._view.release()
+        self._map.close()
+        self._file.close()
+
+
+def replay(path, interface, port=None, direction=DIR_RX, speed=1.0):
+    """
+    Feed captured chunks into `interface.rx_callback`, through a fresh framer
+    from `interface.create_framer()`, as the RX thread would.
+
+    Args:
+        path: Capture file
+        interface: A CarInterface/AppInterface (need not be connected)
+        port: Only replay records of this port; None replays every port
+        direction: DIR_RX (default) or DIR_TX
+        speed: Playback rate relative to real time; 0 replays as fast as possible
+
+    Returns:
+        (chunks, frames, seconds spent in the framer and rx_callback)
+    """
+    reader = CaptureReader(path)
+    framer = interface.create_framer()
+    chunks = frames = 0
+    busy = 0.0
+    first_t = None
+    payload = None
+    start = time.monotonic()
+    try:
+        for t_ns, rec_direction, rec_port, payload in reader:
+            if rec_direction != direction or (port is not None and rec_port != port):
+                continue
+            if speed > 0:
+                if first_t is None:
+                    first_t = t_ns
+                delay = (t_ns - first_t) / 1e9 / speed - (time.monotonic() - start)
+                if delay > 0:
+                    time.sleep(delay)
+            begin = time.perf_counter()
+            for frame in (framer.feed(payload) if framer is not None else (bytes(payload),)):
+                interface.rx_callback(frame)
+                frames += 1
+            busy += time.perf_counter() - begin
+            chunks += 1
+    finally:
+        payload = None  # Drop the last view into the map before closing it
+        reader.close()
+    return chunks, frames, busy
+
+
+def dump(path):
+    reader = CaptureReader(path)
+    first_t = None
+    try:
+        for t_ns, direction, port, payload in reader:
+            if first_t is None:
+                first_t = t_ns
+            print(f"{(t_ns - first_t) / 1e6:12.3f} ms  {DIRECTION_NAMES[direction]}  {port}  {bytes(payload)!r}")
+        payload = None
+    finally:
+        reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay serial wire captures")
+    sub = parser.add_subparsers(dest="command", required=True)
+    dump_parser = sub.add_parser("dump", help="Print every record")
+    dump_parser.add_argument("path")
+    replay_parser = sub.add_parser("replay", help="Replay RX traffic into a protocol decoder")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--target", choices=["car", "car-binary", "app"], default="car")
+    replay_parser.add_argument("--port", help="Only replay records captured on this port")
+    replay_parser.add_argument("--speed", type=float, default=1.0, help="0 = as fast as possible")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == "dump":
+        dump(args.path)
+        return
+
+    from sharedResources import sharedResources
+    if args.target == "app":
+        from androidapp import AppInterface
+        interface = AppInterface(port=args.port or "replay")
+    else:
+        from car import CarInterface, CarMessageProtocol, CarBinaryProtocol
+        protocol_cls = CarBinaryProtocol if args.target == "car-binary" else CarMessageProtocol
+        interface = CarInterface(port=args.port or "replay", msg_protocol_cls=protocol_cls)
+    interface.set_shared_resources(sharedResources)
+    interface.setup_protocol()
+    chunks, frames, busy = replay(args.path, interface, port=args.port, speed=args.speed)
+    per_frame = busy / frames * 1e6 if frames else 0.0
+    print(f"Replayed {chunks} chunks / {frames} frames; decode time {busy * 1e3:.1f} ms ({per_frame:.1f} us/frame)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,5 +1,12 @@
+import itertools
 import logging
-from communication import AbstractSerialInterface
+import struct
+from communication import (AbstractSerialInterface, StreamFramer, IO_MODE_EVENT,
+                           PRIORITY_CONTROL, PRIORITY_EMERGENCY,
+                           FRAME_NEWLINE, FRAME_COBS, crc16, cobs_encode, cobs_decode)
+from carlink import CommandWindow, CommandHandle, CommandTracker
+from telemetry import car_telemetry_store
+from pose import PoseEstimator
 from sharedResources import SharedRsc, sharedResources
 from queue import Queue
 import definitions
@@ -8,12 +15,17 @@ logger = logging.getLogger("Car")
 
 class CarMessageProtocol:
     sharedResources = None
+    FRAMING = FRAME_NEWLINE
 
     @classmethod
     def init_shared_resources(cls):
         logger.info("[CarMessageProtocol] Initializing shared resources")
         cls.sharedResources.set("CAR.MOVE.REQ", Queue(1))
         cls.sharedResources.set("CAR.STATUS", "IDLE")
+        # Precomputed accessors for the keys written on every decoded message.
+        cls.range_handle = cls.sharedResources.handle("CAR.RANGE")
+        cls.gyro_handle = cls.sharedResources.handle("CAR.GYRO.Z")
+        cls.status_handle = cls.sharedResources.handle("CAR.STATUS")
 
     @classmethod
     def set_shared_resources(cls, shared_resources):
@@ -21,9 +33,17 @@ class CarMessageProtocol:
 
     @classmethod
     def decode_message(cls, msg):
+        """
+        Decode one car message and update shared resources.
+
+        Returns:
+            (key, value) describing what was received, e.g. ("CAR.GYRO.Z", 45.1)
+            or ("CAR.ACK", seq), or None if nothing usable was decoded
+        """
+        event = None
         try:
             decoded_msg = msg.decode('utf-8').strip()
-            logger.debug(f"Car RX Decoded: {decoded_msg}")
+            logger.debug("Car RX Decoded: %s", decoded_msg)
             
             # Processing incoming messages from the car
             if decoded_msg.startswith("RANGE"):
@@ -31,10 +51,11 @@ class CarMessageProtocol:
                 if len(parts) >= 2:
                     try:
                         range_value = float(parts[1])
-                        cls.sharedResources.set("CAR.RANGE", range_value)
-                        logger.info(f"Updated car range: {range_value}")
+                        cls.range_handle.set(range_value)
+                        logger.debug("Updated car range: %s", range_value)
+                        event = ("CAR.RANGE", range_value)
                     except ValueError:
-                        logger.warning(f"Invalid range value: {parts[1]}")
+                        logger.warning("Invalid range value: %s", parts[1])
             
             elif decoded_msg.startswith("GYRO:"):
                 # Process GYRO data - z-bearing only
@@ -42,59 +63,242 @@ class CarMessageProtocol:
                     # Extract the value after "GYRO: "
                     gyro_str = decoded_msg.replace("GYRO:", "").strip()
                     z_bearing = float(gyro_str)
-                    cls.sharedResources.set("CAR.GYRO.Z", z_bearing)
-                    logger.debug(f"Updated car z-bearing: {z_bearing}")
+                    cls.gyro_handle.set(z_bearing)
+                    logger.debug("Updated car z-bearing: %s", z_bearing)
+                    event = ("CAR.GYRO.Z", z_bearing)
                 except ValueError:
-                    logger.warning(f"Invalid GYRO value: {decoded_msg}")
+                    logger.warning("Invalid GYRO value: %s", decoded_msg)
             
             elif decoded_msg.startswith("STATUS"):
                 parts = decoded_msg.split()
                 if len(parts) >= 2:
                     status = parts[1]
-                    cls.sharedResources.set("CAR.STATUS", status)
-                    logger.info(f"Updated car status: {status}")
+                    cls.status_handle.set(status)
+                    logger.info("Updated car status: %s", status)
+                    event = ("CAR.STATUS", status)
+
+            elif decoded_msg.startswith("ACK"):
+                parts = decoded_msg.split()
+                if len(parts) >= 2:
+                    try:
+                        event = ("CAR.ACK", int(parts[1]))
+                    except ValueError:
+                        logger.warning("Invalid ACK value: %s", parts[1])
             
             else:
-                logger.debug(f"Unhandled car message: {decoded_msg}")
+                logger.debug("Unhandled car message: %s", decoded_msg)
                 
         except Exception as e:
-            logger.error(f"Error decoding car message: {e}")
+            logger.error("Error decoding car message: %s", e)
+        return event
 
     @classmethod
-    def encode_move(cls, direction: str, distance: int = 10):
+    def encode_move(cls, direction: str, distance: int = 10, seq: int = None):
         """
         Encodes a movement command according to the car's protocol.
         
         Args:
             direction: Direction to move ('F', 'B', 'L', 'R')
             distance: Distance value or angle (depends on direction)
+            seq: Optional sequence number, appended as "#nnn" for the car to ACK
             
         Returns:
             Formatted command string for the car
         """
         if direction not in definitions.MOVES:
-            logger.warning(f"Invalid direction: {direction}")
+            logger.warning("Invalid direction: %s", direction)
             return None
             
         # Format commands according to car's protocol
         if direction == "F":
-            return f"SF{str(distance).zfill(3)}"
+            command = f"SF{str(distance).zfill(3)}"
         elif direction == "B":
-            return f"SB{str(distance).zfill(3)}"
+            command = f"SB{str(distance).zfill(3)}"
         elif direction == "L":
-            return f"TL{str(distance).zfill(3)}"
+            command = f"TL{str(distance).zfill(3)}"
         elif direction == "R":
-            return f"TR{str(distance).zfill(3)}"
+            command = f"TR{str(distance).zfill(3)}"
+        return cls.with_seq(command, seq)
         
     @classmethod
-    def encode_stop(cls):
+    def encode_stop(cls, seq: int = None):
         """Encodes a stop command for the car."""
-        return "STOP"
+        return cls.with_seq("STOP", seq)
+
+    @classmethod
+    def with_seq(cls, command: str, seq: int = None):
+        """Appends the "#nnn" sequence suffix that the car echoes back as "ACK nnn"."""
+        if seq is None:
+            return command
+        return f"{command}#{seq:03d}"
+
+class CarBinaryProtocol(CarMessageProtocol):
+    """
+    Compact binary variant of CarMessageProtocol.
+
+    Every packet is a little-endian struct whose first byte is the message
+    type, followed by a CRC16 of the struct, COBS-encoded and terminated by
+    a zero byte. The move layout follows CarMoveProtocolStruct from
+    mdp_ws_old/protocol.py (msgId, moveMode, dir, steering_angle, target_dist).
+    Telemetry is sent as fixed-point integers so decoding needs no float parsing.
+    """
+    FRAMING = FRAME_COBS
+
+    # Message types, RPi -> car
+    MSG_MOVE = 0x01
+    MSG_STOP = 0x02
+    # Message types, car -> RPi
+    MSG_RANGE = 0x10
+    MSG_GYRO = 0x11
+    MSG_STATUS = 0x12
+    MSG_ACK = 0x13
+
+    # moveMode values
+    MOVE_MODE_STOP = 0
+    MOVE_MODE_STRAIGHT = 1
+    MOVE_MODE_TURN = 2
+
+    MOVE_STRUCT = struct.Struct("<BBBbBI")  # type, msgId, moveMode, dir, steering_angle, target_dist
+    STOP_STRUCT = struct.Struct("<BB")  # type, msgId
+    RANGE_STRUCT = struct.Struct("<BH")  # type, range in 0.1 units
+    GYRO_STRUCT = struct.Struct("<Bi")  # type, z-bearing in 0.01 degrees
+    STATUS_STRUCT = struct.Struct("<BB")  # type, status code
+    ACK_STRUCT = struct.Struct("<BB")  # type, msgId being acknowledged
+    CRC_STRUCT = struct.Struct("<H")
+
+    RANGE_SCALE = 10
+    GYRO_SCALE = 100
+    STATUS_CODES = ["IDLE", "MOVING", "DONE", "ERROR"]
+
+    # direction -> (moveMode, dir)
+    MOVE_TABLE = {
+        "F": (MOVE_MODE_STRAIGHT, 1),
+        "B": (MOVE_MODE_STRAIGHT, -1),
+        "L": (MOVE_MODE_TURN, -1),
+        "R": (MOVE_MODE_TURN, 1),
+    }
+
+    _msg_ids = itertools.count()
+
+    @classmethod
+    def next_msg_id(cls):
+        return next(cls._msg_ids) & 0xFF
+
+    @classmethod
+    def pack(cls, body: bytes):
+        """Append the CRC, COBS-encode and terminate a packet body."""
+        return cobs_encode(body + cls.CRC_STRUCT.pack(crc16(body))) + b"\x00"
+
+    @classmethod
+    def unpack(cls, frame: bytes):
+        """
+        Undo `pack` for a frame without its zero terminator.
+        Returns the packet body, or None if the frame is malformed or fails the CRC.
+        """
+        try:
+            raw = cobs_decode(frame)
+        except ValueError:
+            logger.warning("Malformed binary car frame: %s", frame)
+            return None
+        if len(raw) < 3:
+            logger.warning("Short binary car frame: %s", frame)
+            return None
+        body = raw[:-2]
+        if crc16(body) != cls.CRC_STRUCT.unpack_from(raw, len(body))[0]:
+            logger.warning("CRC mismatch on binary car frame: %s", frame)
+            return None
+        return body
+
+    @classmethod
+    def decode_message(cls, msg):
+        body = cls.unpack(msg)
+        if body is None:
+            return None
+        event = None
+        try:
+            msg_type = body[0]
+            if msg_type == cls.MSG_RANGE:
+                range_value = cls.RANGE_STRUCT.unpack(body)[1] / cls.RANGE_SCALE
+                cls.range_handle.set(range_value)
+                logger.debug("Updated car range: %s", range_value)
+                event = ("CAR.RANGE", range_value)
+            elif msg_type == cls.MSG_GYRO:
+                z_bearing = cls.GYRO_STRUCT.unpack(body)[1] / cls.GYRO_SCALE
+                cls.gyro_handle.set(z_bearing)
+                logger.debug("Updated car z-bearing: %s", z_bearing)
+                event = ("CAR.GYRO.Z", z_bearing)
+            elif msg_type == cls.MSG_STATUS:
+                code = cls.STATUS_STRUCT.unpack(body)[1]
+                status = cls.STATUS_CODES[code] if code < len(cls.STATUS_CODES) else str(code)
+                cls.status_handle.set(status)
+                logger.info("Updated car status: %s", status)
+                event = ("CAR.STATUS", status)
+            elif msg_type == cls.MSG_ACK:
+                event = ("CAR.ACK", cls.ACK_STRUCT.unpack(body)[1])
+            else:
+                logger.debug("Unhandled car message type: %s", msg_type)
+        except struct.error as e:
+            logger.error("Error decoding car message: %s", e)
+        return event
+
+    @classmethod
+    def encode_move(cls, direction: str, distance: int = 10, seq: int = None):
+        """
+        Encodes a movement command as a binary move packet.
+
+        Args:
+            direction: Direction to move ('F', 'B', 'L', 'R')
+            distance: Distance value or angle (depends on direction)
+            seq: Sequence number for the msgId field; allocated if not given
+
+        Returns:
+            Framed packet bytes for the car
+        """
+        if direction not in definitions.MOVES:
+            logger.warning("Invalid direction: %s", direction)
+            return None
+        move_mode, move_dir = cls.MOVE_TABLE[direction]
+        msg_id = cls.next_msg_id() if seq is None else seq
+        body = cls.MOVE_STRUCT.pack(cls.MSG_MOVE, msg_id, move_mode, move_dir, 0, distance)
+        return cls.pack(body)
+
+    @classmethod
+    def encode_stop(cls, seq: int = None):
+        """Encodes a stop packet for the car."""
+        msg_id = cls.next_msg_id() if seq is None else seq
+        return cls.pack(cls.STOP_STRUCT.pack(cls.MSG_STOP, msg_id))
+
+    @classmethod
+    def encode_ack(cls, seq: int):
+        """Encodes an ACK packet (car side; used for emulation)."""
+        return cls.pack(cls.ACK_STRUCT.pack(cls.MSG_ACK, seq))
+
+    @classmethod
+    def encode_range(cls, range_value: float):
+        """Encodes a RANGE telemetry packet (car side; used for emulation)."""
+        return cls.pack(cls.RANGE_STRUCT.pack(cls.MSG_RANGE, round(range_value * cls.RANGE_SCALE)))
+
+    @classmethod
+    def encode_gyro(cls, z_bearing: float):
+        """Encodes a GYRO telemetry packet (car side; used for emulation)."""
+        return cls.pack(cls.GYRO_STRUCT.pack(cls.MSG_GYRO, round(z_bearing * cls.GYRO_SCALE)))
+
+    @classmethod
+    def encode_status(cls, status: str):
+        """Encodes a STATUS telemetry packet (car side; used for emulation)."""
+        return cls.pack(cls.STATUS_STRUCT.pack(cls.MSG_STATUS, cls.STATUS_CODES.index(status)))
 
 class CarInterface(AbstractSerialInterface):
-    def __init__(self, port, baudrate=115200, timeout=1):
-        super().__init__(port, baudrate, timeout)
-        self.msg_protocol_cls = CarMessageProtocol
+    def __init__(self, port, baudrate=115200, timeout=1, io_mode=IO_MODE_EVENT,
+                 msg_protocol_cls=CarMessageProtocol, auto_reconnect=False):
+        # Set before the base constructor, which builds the framer from it.
+        self.msg_protocol_cls = msg_protocol_cls
+        self._listeners = []
+        super().__init__(port, baudrate, timeout, io_mode, auto_reconnect=auto_reconnect)
+
+    def create_framer(self):
+        """Framing follows the protocol: newline text or COBS binary."""
+        return StreamFramer(self.msg_protocol_cls.FRAMING)
         
     def set_shared_resources(self, shared_resources):
         self.sharedResources = shared_resources
@@ -104,52 +308,174 @@ class CarInterface(AbstractSerialInterface):
         """Initialize protocol and shared resources"""
         self.msg_protocol_cls.init_shared_resources()
         
+    def add_listener(self, callback):
+        """
+        Register callback(key, value), called on the RX thread for every decoded
+        message, e.g. ("CAR.STATUS", "DONE") or ("CAR.ACK", 7).
+        """
+        self._listeners.append(callback)
+
     def rx_callback(self, data):
         """Process received data using the protocol decoder"""
-        logger.debug(f"Car RX: {data}")
-        self.msg_protocol_cls.decode_message(data)
+        logger.debug("Car RX: %s", data)
+        event = self.msg_protocol_cls.decode_message(data)
+        if event is not None:
+            for listener in self._listeners:
+                listener(*event)
 
 class Car:
-    def __init__(self, port):
-        self.interface = CarInterface(port=port, baudrate=115200)
+    def __init__(self, port, binary=False, reliable=False, window_size=4, ack_timeout=0.2,
+                 auto_reconnect=False, pose_estimator=None, io_mode=IO_MODE_EVENT):
+        """
+        Args:
+            port: Serial port of the STM32
+            binary: Use CarBinaryProtocol instead of the ASCII protocol
+            reliable: Send every command with a sequence number and retransmit
+                until the car ACKs it; requires firmware that sends ACKs
+            window_size: Number of unacknowledged commands allowed in flight
+            ack_timeout: Seconds to wait for an ACK before retransmitting
+            auto_reconnect: Reopen the port in the background whenever it drops
+            pose_estimator: PoseEstimator fed with issued moves and telemetry;
+                a default one publishing CAR.POSE is created if omitted
+            io_mode: communication.IO_MODE_*; IO_MODE_ASYNC needs
+                interface.attach_loop() before connect()
+        """
+        protocol_cls = CarBinaryProtocol if binary else CarMessageProtocol
+        self.interface = CarInterface(port=port, baudrate=115200, msg_protocol_cls=protocol_cls,
+                                      io_mode=io_mode, auto_reconnect=auto_reconnect)
         self.interface.set_shared_resources(sharedResources)
         self.interface.setup_protocol()
+        # History of numeric telemetry; SharedRsc only holds the latest value.
+        self.telemetry = car_telemetry_store()
+        self.interface.add_listener(self.telemetry.on_car_event)
+        sharedResources.set("CAR.TELEMETRY", self.telemetry)
+        # Resolves the handles returned by move() / stop() from STATUS and ACK messages.
+        self.tracker = CommandTracker()
+        self.interface.add_listener(self.tracker.on_car_event)
+        self.pose = pose_estimator or PoseEstimator(shared_resources=sharedResources)
+        self.interface.add_listener(self.pose.on_car_event)
+        self.link = None
+        if reliable:
+            self.link = CommandWindow(self.send_command, window_size=window_size, ack_timeout=ack_timeout,
+                                      on_failure=self._on_link_failure)
+            self.interface.add_listener(self._on_car_event)
+
+    def _on_car_event(self, key, value):
+        if key == "CAR.ACK":
+            self.link.ack(value)
+
+    def _on_link_failure(self, seqs):
+        """
+        CommandWindow on_failure callback: seqs[0] was never acknowledged and
+        the later commands were dropped with it.
+        """
+        handles = [self.tracker.on_failure(seqs[0])]
+        handles += [self.tracker.on_failure(seq, "was dropped after an unacknowledged command")
+                    for seq in seqs[1:]]
+        if any(handle is not None and handle.command != "STOP" for handle in handles):
+            # The car may hold later moves waiting for the lost one; a STOP resets its sequence.
+            logger.warning("Car command link lost sync; stopping the car")
+            self.stop()
 
     def connect(self):
         """Connect to the car hardware"""
         self.interface.connect()
+        if self.link is not None:
+            self.link.start()
 
     def disconnect(self):
         """Disconnect from the car hardware"""
+        if self.link is not None:
+            self.link.stop()
         self.interface.disconnect()
 
-    def send_command(self, command: str):
+    def send_command(self, command: str, priority=PRIORITY_CONTROL, flush=False):
         """
         Standardized API to send any command to the car.
         
         Args:
             command: The formatted command string to send
+            priority: TX lane (communication.PRIORITY_*); lower is sent first
+            flush: Drop commands still queued in lower-priority lanes
         """
+        if priority is None:
+            priority = PRIORITY_CONTROL
         if isinstance(command, str):
             command = command.encode('utf-8')
-        self.interface.tx(command)
-        logger.info(f"Sent command to Car: {command}")
+        self.interface.tx(command, priority, flush)
+        logger.info("Sent command to Car: %s", command)
 
-    def move(self, direction: str, distance: int = 10):
+    def move(self, direction: str, distance: int = 10, timeout: float = None):
         """
         Sends a move command to the car using the standardized protocol.
         
         Args:
             direction: Direction to move ('F', 'B', 'L', 'R')
             distance: Distance value or angle (depends on direction)
+            timeout: Fail the returned handle with TimeoutError if the car has
+                not reported completion after this many seconds
+
+        Returns:
+            CommandHandle resolving to "DONE" when the car reports completion
+        """
+        protocol = self.interface.msg_protocol_cls
+        handle = CommandHandle(f"{direction}{distance}")
+        if direction not in definitions.MOVES:
+            logger.error("Failed to generate move command for direction: %s", direction)
+            handle._resolve(exception=ValueError(f"Invalid direction: {direction}"))
+            return handle
+        if self.link is not None:
+            # The handle is tracked inside encode, i.e. under the window lock
+            # and before the command can be sent, so no ACK can be missed.
+            def encode(seq):
+                handle.seq = seq
+                self.tracker.track_move(handle, timeout)
+                self.pose.on_command(direction, distance)
+                return protocol.encode_move(direction, distance, seq)
+            self.link.submit(encode)
+            return handle
+        command = protocol.encode_move(direction, distance)
+        self.tracker.track_move(handle, timeout)
+        self.pose.on_command(direction, distance)
+        self.send_command(command)
+        return handle
+
+    def stop(self, flush=True, timeout: float = None):
+        """
+        Sends a stop command to the car on the emergency TX lane, ahead of
+        any queued moves. Outstanding move handles fail with CommandAborted.
+
+        Args:
+            flush: Also discard moves that are still queued (superseded by the stop)
+            timeout: Fail the returned handle with TimeoutError after this many seconds
+
+        Returns:
+            CommandHandle resolving when the car reports it is idle
         """
-        command = CarMessageProtocol.encode_move(direction, distance)
-        if command:
-            self.send_command(command)
-        else:
-            logger.error(f"Failed to generate move command for direction: {direction}")
+        protocol = self.interface.msg_protocol_cls
+        handle = CommandHandle("STOP")
+        if self.link is not None:
+            if flush:
+                # Moves still awaiting an ACK are superseded by the stop.
+                self.link.clear()
+
+            def encode(seq):
+                handle.seq = seq
+                self.tracker.track_stop(handle, timeout)
+                self.pose.on_stop()
+                return protocol.encode_stop(seq)
+            # Not queued behind pending moves: the stop enters the window and is written at once.
+            self.link.submit(encode, PRIORITY_EMERGENCY, urgent=True, flush=flush)
+            return handle
+        command = protocol.encode_stop()
+        self.tracker.track_stop(handle, timeout)
+        self.pose.on_stop()
+        self.send_command(command, PRIORITY_EMERGENCY, flush)
+        return handle
 
-    def stop(self):
-        """Sends a stop command to the car."""
-        command = CarMessageProtocol.encode_stop()
-        self.send_command(command)
\ No newline at end of file
+    def stop_latency(self):
+        """
+        Enqueue-to-write latency statistics of the emergency lane
+        (count, last, max, total in seconds).
+        """
+        return dict(self.interface.tx_stats[PRIORITY_EMERGENCY])
\ No newline at end of file
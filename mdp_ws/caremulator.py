@@ -0,0 +1,346 @@
+import argparse
+import logging
+import os
+import pty
+import random
+import re
+import select
+import threading
+import time
+import tty
+from collections import deque
+
+from car import CarBinaryProtocol
+from communication import StreamFramer, FRAME_COBS
+
+logger = logging.getLogger("CarEmulator")
+
+# ASCII command grammar, as produced by CarMessageProtocol: fixed-width
+# moves or STOP, with the optional "#nnn" sequence suffix of the reliable link.
+TEXT_COMMAND_RE = re.compile(rb"(SF|SB|TL|TR)(\d{3})(?:#(\d{3}))?|STOP(?:#(\d{3}))?")
+MAX_TEXT_COMMAND = len(b"SF000#000")
+TEXT_SUFFIX_WAIT = 0.005  # Seconds to wait for a "#nnn" suffix before executing a bare command
+
+TEXT_TO_MOVE = {b"SF": "F", b"SB": "B", b"TL": "L", b"TR": "R"}
+SEQ_MODULO = 256  # Matches CommandWindow's default seq_modulo
+
+
+class CarEmulator:
+    """
+    Pseudo-terminal STM32 stand-in.
+
+    Opens a PTY pair and behaves like the car on the slave end, so
+    `Car(port=emulator.port)` works unchanged. Moves are executed one after
+    another with durations derived from `speed` and `turn_rate`; the car
+    reports "STATUS MOVING" / "STATUS DONE", acknowledges sequence-numbered
+    commands (executing them in sequence order, as the firmware must for the
+    sliding window) and streams GYRO and RANGE telemetry at `telemetry_hz`.
+
+    Args:
+        binary: Speak CarBinaryProtocol instead of the ASCII protocol
+        telemetry_hz: GYRO+RANGE samples per second (0 disables telemetry)
+        speed: Straight-line speed in distance units per second
+        turn_rate: Turning rate in degrees per second
+        drop_rate: Probability of silently ignoring a received command,
+            to exercise retransmission
+        seed: Random seed for drop_rate
+        gap_timeout: Seconds commands are held waiting for a missing sequence
+            number before they are discarded and the sequence restarts at the
+            next command received; longer than the host retransmits for
+            (CommandWindow: ack_timeout * (max_retries + 1)), which fails them
+    """
+
+    def __init__(self, binary=False, telemetry_hz=50, speed=20.0, turn_rate=90.0, drop_rate=0.0,
+                 seed=None, gap_timeout=2.0):
+        self.binary = binary
+        self.telemetry_hz = telemetry_hz
+        self.speed = speed
+        self.turn_rate = turn_rate
+        self.drop_rate = drop_rate
+        self.gap_timeout = gap_timeout
+        self._random = random.Random(seed)
+
+        self.master_fd, self.slave_fd = pty.openpty()
+        tty.setraw(self.slave_fd)  # No echo or line discipline, like a real UART
+        self.port = os.ttyname(self.slave_fd)
+
+        self._framer = StreamFramer(FRAME_COBS)
+        self._text_buf = b""
+        self._text_pending = False
+        self._write_lock = threading.Lock()
+        self._cond = threading.Condition()
+        self._moves = deque()  # (direction, distance)
+        self._recent_seqs = deque(maxlen=64)  # Sequence numbers already executed
+        self._held = {}  # seq -> (direction, distance) received ahead of a gap
+        self._expected_seq = 0  # Next sequence number to execute (None: take the next one received)
+        self._gap_since = None  # When commands started waiting for a missing sequence number
+        self._abort = False
+        self._running = False
+        self._threads = []
+
+        # Simulated state
+        self.bearing = 0.0
+        self.range = 100.0
+        self.status = "IDLE"
+
+        self.stats = {"commands": 0, "dropped": 0, "moves_done": 0, "telemetry": 0, "rx_bytes": 0,
+                      "gap_timeouts": 0}
+
+    def start(self):
+        self._running = True
+        self._threads = [
+            threading.Thread(target=self._rx_loop, daemon=True),
+            threading.Thread(target=self._motion_loop, daemon=True),
+        ]
+        if self.telemetry_hz > 0:
+            self._threads.append(threading.Thread(target=self._telemetry_loop, daemon=True))
+        for thread in self._threads:
+            thread.start()
+        logger.info("Car emulator on %s (binary=%s, telemetry %s Hz)", self.port, self.binary, self.telemetry_hz)
+
+    def stop(self):
+        self._running = False
+        with self._cond:
+            self._cond.notify_all()
+        for thread in self._threads:
+            if thread is not threading.current_thread():
+                thread.join(1.0)
+        for fd in (self.master_fd, self.slave_fd):
+            try:
+                os.close(fd)
+            except OSError:
+                pass
+
+    # Output
+
+    def _write(self, data: bytes):
+        with self._write_lock:
+            try:
+                os.write(self.master_fd, data)
+            except OSError:
+                pass
+
+    def send_status(self, status: str):
+        self.status = status
+        if self.binary:
+            self._write(CarBinaryProtocol.encode_status(status))
+        else:
+            self._write(f"STATUS {status}\n".encode())
+
+    def send_ack(self, seq: int):
+        if self.binary:
+            self._write(CarBinaryProtocol.encode_ack(seq))
+        else:
+            self._write(f"ACK {seq:03d}\n".encode())
+
+    def _telemetry_packet(self):
+        if self.binary:
+            return CarBinaryProtocol.encode_gyro(self.bearing) + CarBinaryProtocol.encode_range(self.range)
+        return f"GYRO: {self.bearing:.2f}\nRANGE {self.range:.1f}\n".encode()
+
+    # Input
+
+    def _rx_loop(self):
+        while self._running:
+            # While an ASCII command might still be waiting for its "#nnn"
+            # suffix, poll briefly; otherwise block (bounded so stop() is noticed).
+            timeout = TEXT_SUFFIX_WAIT if self._text_pending else 0.2
+            try:
+                readable, _, _ = select.select([self.master_fd], [], [], timeout)
+                data = os.read(self.master_fd, 4096) if readable else b""
+            except (OSError, ValueError):
+                return
+            self._check_gap()
+            if not data:
+                if self._text_pending:
+                    self._handle_text(b"", flush=True)
+                continue
+            self.stats["rx_bytes"] += len(data)
+            if self.binary:
+                for frame in self._framer.feed(data):
+                    self._handle_binary(frame)
+            else:
+                self._handle_text(data)
+
+    def _handle_text(self, data: bytes, flush=False):
+        buf = self._text_buf + data
+        pos = 0
+        self._text_pending = False
+        while True:
+            match = TEXT_COMMAND_RE.search(buf, pos)
+            if match is None:
+                # Keep a possibly incomplete command at the end.
+                self._text_buf = buf[max(pos, len(buf) - MAX_TEXT_COMMAND):]
+                return
+            seq = match.group(3) if match.group(1) else match.group(4)
+            tail = buf[match.end():match.end() + 1]
+            if seq is None and not flush and len(buf) - match.end() < 4 and b"#".startswith(tail):
+                # A "#nnn" suffix may still be on its way.
+                self._text_buf = buf[match.start():]
+                self._text_pending = True
+                return
+            pos = match.end()
+            seq = int(seq) if seq else None
+            if match.group(1):
+                self._command(TEXT_TO_MOVE[match.group(1)], int(match.group(2)), seq)
+            else:
+                self._command("STOP", 0, seq)
+
+    def _handle_binary(self, frame: bytes):
+        body = CarBinaryProtocol.unpack(frame)
+        if body is None:
+            return
+        if body[0] == CarBinaryProtocol.MSG_MOVE:
+            _, msg_id, move_mode, move_dir, _, target = CarBinaryProtocol.MOVE_STRUCT.unpack(body)
+            if move_mode == CarBinaryProtocol.MOVE_MODE_STRAIGHT:
+                direction = "F" if move_dir > 0 else "B"
+            else:
+                direction = "R" if move_dir > 0 else "L"
+            self._command(direction, target, msg_id)
+        elif body[0] == CarBinaryProtocol.MSG_STOP:
+            self._command("STOP", 0, CarBinaryProtocol.STOP_STRUCT.unpack(body)[1])
+
+    def _command(self, direction, distance, seq):
+        self.stats["commands"] += 1
+        if self.drop_rate and self._random.random() < self.drop_rate:
+            self.stats["dropped"] += 1
+            return
+        if seq is None:
+            self._execute_command(direction, distance)
+            return
+        self.send_ack(seq)
+        if seq in self._recent_seqs or seq in self._held:
+            # Retransmission of a command whose ACK was lost: acknowledge again, do not repeat it.
+            return
+        if self._expected_seq is None:
+            self._expected_seq = seq
+        elif (seq - self._expected_seq) % SEQ_MODULO >= SEQ_MODULO // 2:
+            # Sent before a STOP that was written ahead of it: already superseded.
+            return
+        if direction == "STOP":
+            # STOP is executed at once and supersedes everything the host has not yet delivered.
+            self._held.clear()
+            self._gap_since = None
+            self._expected_seq = (seq + 1) % SEQ_MODULO
+            self._recent_seqs.append(seq)
+            self._execute_command(direction, distance)
+            return
+        # Moves are executed in sequence order; later ones wait for a retransmitted gap.
+        self._held[seq] = (direction, distance)
+        while self._expected_seq in self._held:
+            held_direction, held_distance = self._held.pop(self._expected_seq)
+            self._recent_seqs.append(self._expected_seq)
+            self._expected_seq = (self._expected_seq + 1) % SEQ_MODULO
+            self._execute_command(held_direction, held_distance)
+        if not self._held:
+            self._gap_since = None
+        elif self._gap_since is None:
+            self._gap_since = time.monotonic()
+
+    def _check_gap(self):
+        """
+        Give up on a missing sequence number the host has stopped retransmitting.
+        """
+        if self._gap_since is None or time.monotonic() - self._gap_since < self.gap_timeout:
+            return
+        logger.warning("Sequence number %d missing for %.1f s; discarding %d held commands",
+                       self._expected_seq, self.gap_timeout, len(self._held))
+        self.stats["gap_timeouts"] += 1
+        self._held.clear()
+        self._gap_since = None
+        self._expected_seq = None
+
+    def _execute_command(self, direction, distance):
+        with self._cond:
+            if direction == "STOP":
+                self._moves.clear()
+                self._abort = True
+            else:
+                self._moves.append((direction, distance))
+            self._cond.notify_all()
+
+    # Motion model
+
+    def _motion_loop(self):
+        while self._running:
+            with self._cond:
+                while self._running and not self._moves and not self._abort:
+                    self._cond.wait()
+                if not self._running:
+                    return
+                if self._abort:
+                    self._abort = False
+                    self.send_status("IDLE")
+                    continue
+                direction, distance = self._moves.popleft()
+            self._execute(direction, distance)
+
+    def _execute(self, direction, distance):
+        if direction in ("F", "B"):
+            duration = distance / self.speed if self.speed else 0.0
+            rate = (1 if direction == "F" else -1) * self.speed
+        else:
+            duration = distance / self.turn_rate if self.turn_rate else 0.0
+            rate = (1 if direction == "R" else -1) * self.turn_rate
+        self.send_status("MOVING")
+        start = time.monotonic()
+        last = start
+        while True:
+            with self._cond:
+                # Sleep in short steps so STOP interrupts the move promptly.
+                self._cond.wait_for(lambda: self._abort or not self._running, 0.01)
+                if self._abort or not self._running:
+                    return
+            now = time.monotonic()
+            step = min(now, start + duration) - last
+            if direction in ("F", "B"):
+                self.range = max(0.0, self.range - rate * step)
+            else:
+                self.bearing = (self.bearing + rate * step) % 360.0
+            last = now
+            if now >= start + duration:
+                break
+        self.stats["moves_done"] += 1
+        self.send_status("DONE")
+
+    def _telemetry_loop(self):
+        period = 1.0 / self.telemetry_hz
+        deadline = time.monotonic()
+        while self._running:
+            self._write(self._telemetry_packet())
+            self.stats["telemetry"] += 1
+            deadline += period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            elif delay < -1.0:
+                deadline = time.monotonic()  # Fell far behind; do not burst to catch up
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PTY-backed STM32 car emulator")
+    parser.add_argument("--binary", action="store_true", help="Speak the binary car protocol")
+    parser.add_argument("--telemetry-hz", type=float, default=50)
+    parser.add_argument("--speed", type=float, default=20.0)
+    parser.add_argument("--turn-rate", type=float, default=90.0)
+    parser.add_argument("--drop-rate", type=float, default=0.0)
+    parser.add_argument("--gap-timeout", type=float, default=2.0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    emulator = CarEmulator(binary=args.binary, telemetry_hz=args.telemetry_hz, speed=args.speed,
+                           turn_rate=args.turn_rate, drop_rate=args.drop_rate, gap_timeout=args.gap_timeout)
+    emulator.start()
+    print(f"Car emulator listening on {emulator.port}; use Car(port='{emulator.port}')")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        emulator.stop()
+        print(f"Emulator stats: {emulator.stats}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,408 @@
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque, OrderedDict
+from concurrent.futures import Future, InvalidStateError
+
+logger = logging.getLogger("CarLink")
+
+
+class CommandFailed(Exception):
+    """The car reported an error for the command, or it was never acknowledged."""
+
+
+class CommandAborted(Exception):
+    """The command was superseded by a STOP before it completed."""
+
+
+class CommandHandle(Future):
+    """
+    Future for one car command, returned by Car.move() / Car.stop().
+
+    Resolves with the final car status ("DONE" for moves, "IDLE" for stops)
+    when the car reports completion, or with CommandFailed / CommandAborted /
+    TimeoutError. Use result(timeout), add_done_callback() or cancel() as with
+    any concurrent.futures.Future; cancel() only stops waiting, it does not
+    stop the car (use Car.stop() for that).
+    """
+
+    def __init__(self, command, seq=None):
+        super().__init__()
+        self.command = command
+        self.seq = seq
+        self.issued_at = time.monotonic()
+        self.acked_at = None  # ACK received (reliable link only)
+        self.started_at = None  # Car reported MOVING
+        self.completed_at = None
+
+    @property
+    def latency(self):
+        """Seconds from issue to completion, or None while outstanding."""
+        if self.completed_at is None:
+            return None
+        return self.completed_at - self.issued_at
+
+    @property
+    def duration(self):
+        """Seconds the car spent executing the command (MOVING to completion), or None."""
+        if self.completed_at is None or self.started_at is None:
+            return None
+        return self.completed_at - self.started_at
+
+    def _resolve(self, result=None, exception=None):
+        if self.completed_at is None:
+            self.completed_at = time.monotonic()
+        try:
+            if exception is not None:
+                self.set_exception(exception)
+            else:
+                self.set_result(result)
+        except InvalidStateError:
+            pass  # Already cancelled or timed out
+
+
+class CommandTracker:
+    """
+    Matches car STATUS / ACK messages to outstanding CommandHandles.
+
+    The car executes moves in order, so STATUS MOVING starts and STATUS DONE
+    completes the oldest outstanding move. A STOP aborts every outstanding
+    move and resolves on the next STATUS IDLE (or DONE). A command that times
+    out is no longer matched, so later STATUS messages resolve later commands.
+    All timeouts are served by one timer thread from a deadline heap.
+    """
+
+    def __init__(self):
+        self._moves = deque()
+        self._stops = deque()
+        self._by_seq = {}
+        self._lock = threading.Lock()
+        self._timer_cond = threading.Condition(self._lock)
+        self._deadlines = []  # Heap of (deadline, tie-breaker, handle, timeout)
+        self._tie = itertools.count()
+        self._timer_thread = None
+
+    def track_move(self, handle, timeout=None):
+        with self._lock:
+            self._moves.append(handle)
+            if handle.seq is not None:
+                self._by_seq[handle.seq] = handle
+        self._arm_timeout(handle, timeout)
+
+    def track_stop(self, handle, timeout=None):
+        with self._lock:
+            aborted = list(self._moves)
+            self._moves.clear()
+            self._stops.append(handle)
+            if handle.seq is not None:
+                self._by_seq[handle.seq] = handle
+        for move in aborted:
+            move._resolve(exception=CommandAborted(f"{move.command} superseded by STOP"))
+        self._arm_timeout(handle, timeout)
+
+    def _arm_timeout(self, handle, timeout):
+        if timeout is None:
+            return
+        with self._timer_cond:
+            heapq.heappush(self._deadlines, (time.monotonic() + timeout, next(self._tie), handle, timeout))
+            if self._timer_thread is None:
+                self._timer_thread = threading.Thread(target=self._timer_loop, name="CommandTimeouts",
+                                                      daemon=True)
+                self._timer_thread.start()
+            self._timer_cond.notify()
+
+    def _timer_loop(self):
+        while True:
+            expired = []
+            with self._timer_cond:
+                now = time.monotonic()
+                while self._deadlines and (self._deadlines[0][2].done() or self._deadlines[0][0] <= now):
+                    _, _, handle, timeout = heapq.heappop(self._deadlines)
+                    if not handle.done():
+                        self._forget(handle)
+                        expired.append((handle, timeout))
+                if not expired:
+                    wait = self._deadlines[0][0] - now if self._deadlines else None
+                    self._timer_cond.wait(wait)
+            for handle, timeout in expired:
+                handle._resolve(exception=TimeoutError(f"{handle.command} not completed within {timeout} s"))
+
+    def _forget(self, handle):
+        """
+        Stop matching STATUS / ACK messages to `handle`. Caller holds the lock.
+        """
+        if handle in self._moves:
+            self._moves.remove(handle)
+        elif handle in self._stops:
+            self._stops.remove(handle)
+        if handle.seq is not None and self._by_seq.get(handle.seq) is handle:
+            del self._by_seq[handle.seq]
+
+    def on_car_event(self, key, value):
+        """CarInterface listener."""
+        if key == "CAR.ACK":
+            with self._lock:
+                handle = self._by_seq.pop(value, None)
+            if handle is not None:
+                handle.acked_at = time.monotonic()
+        elif key == "CAR.STATUS":
+            self._on_status(value)
+
+    def _on_status(self, status):
+        with self._lock:
+            if status == "MOVING":
+                for handle in self._moves:
+                    if handle.started_at is None:
+                        handle.started_at = time.monotonic()
+                        break
+                return
+            if status in ("DONE", "ERROR") and self._moves:
+                done = [self._moves.popleft()]
+            elif status in ("IDLE", "DONE") and self._stops:
+                done = list(self._stops)
+                self._stops.clear()
+            else:
+                return
+        for handle in done:
+            if status == "ERROR":
+                handle._resolve(exception=CommandFailed(f"Car reported ERROR for {handle.command}"))
+            else:
+                handle._resolve(status)
+
+    def on_failure(self, seq, reason="was not acknowledged by the car"):
+        """
+        Fail the handle of a command the CommandWindow dropped.
+
+        Returns:
+            The failed CommandHandle, or None if `seq` was not tracked
+        """
+        with self._lock:
+            handle = self._by_seq.get(seq)
+            if handle is None:
+                return None
+            self._forget(handle)
+        handle._resolve(exception=CommandFailed(f"{handle.command} {reason}"))
+        return handle
+
+
+class CommandWindow:
+    """
+    Sliding-window retransmit for sequence-numbered car commands.
+
+    Each submitted command is given the next sequence number and encoded
+    with it. Up to `window_size` commands are in flight at once; further
+    commands wait in order until an ACK frees a slot. A command that is not
+    acknowledged within `ack_timeout` seconds is sent again (same sequence
+    number, so the car can discard duplicates) up to `max_retries` times,
+    after which it is dropped. Because a retransmitted command can arrive
+    after later ones, the car must execute commands in sequence order; a
+    STOP is executed at once and resets it. Commands after a dropped one can
+    therefore never execute: they are dropped with it, and all of them are
+    reported through `on_failure` so the owner can resync the car (Car sends
+    a STOP).
+    A STOP is submitted `urgent`, so it can overtake pending commands with
+    lower sequence numbers; the car discards those when they arrive.
+    """
+
+    def __init__(self, send, window_size=4, ack_timeout=0.2, max_retries=5, seq_modulo=256,
+                 on_failure=None):
+        if not 0 < window_size <= seq_modulo // 2:
+            raise ValueError("window_size must be between 1 and seq_modulo / 2")
+        self._send = send  # callable(bytes, priority, flush=False)
+        self.window_size = window_size
+        self.ack_timeout = ack_timeout
+        self.max_retries = max_retries
+        self.seq_modulo = seq_modulo
+        self.on_failure = on_failure  # callable(seqs): dropped sequence numbers, oldest first
+
+        self._next_seq = 0
+        self._pending = deque()  # (seq, payload, priority) waiting for a window slot
+        self._in_flight = OrderedDict()  # seq -> [payload, sent_at, deadline, retries, priority]
+        self._cond = threading.Condition()
+        self._running = False
+        self._timer_thread = None
+
+        self.stats = {
+            "sent": 0,
+            "retransmits": 0,
+            "acked": 0,
+            "failed": 0,
+            "duplicate_acks": 0,
+            "last_rtt": None,
+        }
+
+    def start(self):
+        """
+        Start the retransmit timer thread.
+        """
+        with self._cond:
+            if self._running:
+                return
+            self._running = True
+        self._timer_thread = threading.Thread(target=self._timer_loop, daemon=True)
+        self._timer_thread.start()
+
+    def stop(self):
+        """
+        Stop the retransmit timer thread. Unacknowledged commands are kept.
+        """
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._timer_thread is not None:
+            self._timer_thread.join()
+            self._timer_thread = None
+
+    def submit(self, encode, priority=None, urgent=False, flush=False):
+        """
+        Queue a command for transmission.
+
+        Args:
+            encode: callable(seq) returning the framed command bytes for that sequence number
+            priority: TX lane passed to `send` for the first transmission and every retransmit
+            urgent: Put the command in the window at once, ahead of pending
+                commands and even if the window is full (for STOP)
+            flush: Passed to `send` with the first transmission of an urgent
+                command, so commands still queued in lower TX lanes are dropped
+
+        Returns:
+            The sequence number assigned to the command
+        """
+        with self._cond:
+            seq = self._next_seq
+            self._next_seq = (seq + 1) % self.seq_modulo
+            payload = encode(seq)
+            if urgent:
+                now = time.monotonic()
+                self._in_flight[seq] = [payload, now, now + self.ack_timeout, 0, priority]
+                self.stats["sent"] += 1
+                self._cond.notify_all()
+            else:
+                self._pending.append((seq, payload, priority))
+                to_send = self._fill_window()
+        if urgent:
+            self._send(payload, priority, flush)
+        else:
+            self._transmit(to_send)
+        return seq
+
+    def ack(self, seq):
+        """
+        Mark a command as acknowledged by the car and slide the window.
+        """
+        now = time.monotonic()
+        with self._cond:
+            entry = self._in_flight.pop(seq, None)
+            if entry is None:
+                self.stats["duplicate_acks"] += 1
+                return
+            self.stats["acked"] += 1
+            if entry[3] == 0:
+                # RTT is only unambiguous for commands that were sent once.
+                self.stats["last_rtt"] = now - entry[1]
+            to_send = self._fill_window()
+            self._cond.notify_all()
+        self._transmit(to_send)
+
+    def clear(self):
+        """
+        Forget every pending and in-flight command, e.g. after a STOP.
+        """
+        with self._cond:
+            self._pending.clear()
+            self._in_flight.clear()
+            self._cond.notify_all()
+
+    def in_flight(self):
+        with self._cond:
+            return list(self._in_flight)
+
+    def wait_idle(self, timeout=None):
+        """
+        Block until every submitted command has been acknowledged or dropped.
+        Returns True if the window drained within `timeout`.
+        """
+        with self._cond:
+            return self._cond.wait_for(lambda: not self._in_flight and not self._pending, timeout)
+
+    def _age(self, seq):
+        """
+        Sort key putting outstanding sequence numbers oldest first, across wrap-around.
+        """
+        return (seq - self._next_seq) % self.seq_modulo
+
+    def _drop_from(self, first):
+        """
+        Remove `first` and every command submitted after it. Caller holds the lock.
+
+        Returns:
+            The removed sequence numbers, oldest first
+        """
+        cutoff = self._age(first)
+        dropped = [seq for seq in self._in_flight if self._age(seq) >= cutoff]
+        for seq in dropped:
+            del self._in_flight[seq]
+        kept = deque()
+        for item in self._pending:
+            if self._age(item[0]) >= cutoff:
+                dropped.append(item[0])
+            else:
+                kept.append(item)
+        self._pending = kept
+        return sorted(dropped, key=self._age)
+
+    def _fill_window(self):
+        """
+        Move pending commands into the window. Caller holds the lock.
+        """
+        to_send = []
+        now = time.monotonic()
+        while self._pending and len(self._in_flight) < self.window_size:
+            seq, payload, priority = self._pending.popleft()
+            self._in_flight[seq] = [payload, now, now + self.ack_timeout, 0, priority]
+            to_send.append((payload, priority))
+        if to_send:
+            self.stats["sent"] += len(to_send)
+            self._cond.notify_all()  # New deadline for the timer thread
+        return to_send
+
+    def _transmit(self, payloads):
+        for payload, priority in payloads:
+            self._send(payload, priority)
+
+    def _timer_loop(self):
+        while True:
+            to_send = []
+            failed = []
+            with self._cond:
+                if not self._running:
+                    return
+                now = time.monotonic()
+                expired = [seq for seq, entry in self._in_flight.items()
+                           if entry[2] <= now and entry[3] >= self.max_retries]
+                if expired:
+                    failed = self._drop_from(min(expired, key=self._age))
+                next_deadline = None
+                for entry in self._in_flight.values():
+                    if entry[2] <= now:
+                        entry[3] += 1
+                        entry[2] = now + self.ack_timeout
+                        to_send.append((entry[0], entry[4]))
+                        self.stats["retransmits"] += 1
+                    if next_deadline is None or entry[2] < next_deadline:
+                        next_deadline = entry[2]
+                if failed:
+                    self.stats["failed"] += len(failed)
+                    to_send.extend(self._fill_window())
+                    self._cond.notify_all()
+                if not to_send and not failed:
+                    wait = None if next_deadline is None else max(0.0, next_deadline - now)
+                    self._cond.wait(wait)
+            if failed:
+                logger.error("Car command %d dropped after %d retries; dropping %d later commands with it",
+                             failed[0], self.max_retries, len(failed) - 1)
+                if self.on_failure:
+                    self.on_failure(failed)
+            self._transmit(to_send)
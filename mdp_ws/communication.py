@@ -1,21 +1,268 @@
+import asyncio
+import binascii
+import logging
+import os
 import serial
 import threading
 import time
 from abc import ABC, abstractmethod
 from collections import deque
 
+# I/O modes.
+# IO_MODE_POLL: legacy behaviour, RX/TX threads poll `in_waiting` / the TX buffer every 100 ms.
+# IO_MODE_EVENT: RX/TX threads block on serial reads (bounded by `timeout`) and wake TX on a condition variable.
+# IO_MODE_ASYNC: no I/O threads; the port's file descriptor is registered with an asyncio
+#   event loop (attach_loop) and read/written non-blocking from loop callbacks.
+logger = logging.getLogger("Serial")
+
+IO_MODE_POLL = "poll"
+IO_MODE_EVENT = "event"
+IO_MODE_ASYNC = "async"
+IO_MODES = [IO_MODE_POLL, IO_MODE_EVENT, IO_MODE_ASYNC]
+
+# TX priority lanes, highest first. The TX thread always drains a higher lane
+# before a lower one, so an emergency message never waits behind queued traffic.
+PRIORITY_EMERGENCY = 0  # e.g. STOP
+PRIORITY_CONTROL = 1  # e.g. moves; default
+PRIORITY_BULK = 2  # e.g. telemetry / map uploads
+PRIORITIES = [PRIORITY_EMERGENCY, PRIORITY_CONTROL, PRIORITY_BULK]
+
+# Delimiter modes for StreamFramer.
+# FRAME_NEWLINE: frames are terminated by b"\n" (a trailing b"\r" is stripped); used by the car.
+# FRAME_COMMENT: frames are enclosed in b"/*" ... b"*/" (delimiters kept); used by the Android app.
+# FRAME_COBS: COBS-encoded frames terminated by a zero byte; used by the binary car protocol.
+FRAME_NEWLINE = "newline"
+FRAME_COMMENT = "comment"
+FRAME_COBS = "cobs"
+FRAME_MODES = [FRAME_NEWLINE, FRAME_COMMENT, FRAME_COBS]
+
+
+def crc16(data, crc=0xFFFF):
+    """
+    CRC-16/CCITT-FALSE (poly 0x1021, init 0xFFFF) of `data`.
+    """
+    return binascii.crc_hqx(data, crc)
+
+
+def cobs_encode(data):
+    """
+    Consistent Overhead Byte Stuffing: return `data` with every zero byte
+    removed, so b"\x00" can be used as the frame delimiter. The delimiter
+    itself is not appended.
+    """
+    out = bytearray()
+    for block in bytes(data).split(b"\x00"):
+        while len(block) >= 254:
+            # A full block carries no implied zero.
+            out.append(0xFF)
+            out += block[:254]
+            block = block[254:]
+        out.append(len(block) + 1)
+        out += block
+    return bytes(out)
+
+
+def cobs_decode(data):
+    """
+    Inverse of cobs_encode. Raises ValueError on malformed input.
+    """
+    out = bytearray()
+    idx = 0
+    end = len(data)
+    while idx < end:
+        code = data[idx]
+        if code == 0 or idx + code > end:
+            raise ValueError("Malformed COBS frame")
+        out += data[idx + 1:idx + code]
+        idx += code
+        if code != 0xFF and idx < end:
+            out.append(0)
+    return bytes(out)
+
+
+class StreamFramer:
+    """
+    Incremental byte-stream framer.
+
+    Bytes are appended to a preallocated buffer as they arrive and complete
+    frames are cut out with memoryview slices, so a read that holds several
+    messages yields all of them and a message split across reads is held
+    until its end delimiter arrives. A frame that would overflow
+    `max_frame_size` is dropped whole: the buffered bytes and everything up
+    to and including its end delimiter, so no truncated tail is delivered.
+    """
+
+    def __init__(self, mode=FRAME_NEWLINE, max_frame_size=4096):
+        if mode not in FRAME_MODES:
+            raise ValueError(f"Unknown framing mode: {mode}")
+        self.mode = mode
+        self.max_frame_size = max_frame_size
+        self._buf = bytearray(max_frame_size)
+        self._view = memoryview(self._buf)
+        self._start = 0  # First unconsumed byte
+        self._end = 0  # One past the last buffered byte
+        self._discarding = False  # Inside an oversized frame: drop up to its end delimiter
+        self.dropped_bytes = 0
+
+    def reset(self):
+        """
+        Discard any partially received frame.
+        """
+        self._start = 0
+        self._end = 0
+        self._discarding = False
+
+    def feed(self, data):
+        """
+        Append received bytes and return the list of complete frames (bytes).
+        """
+        frames = []
+        data = memoryview(data)
+        while len(data):
+            if self._end == self.max_frame_size:
+                self._compact()
+                if self._end == self.max_frame_size:
+                    # A whole buffer without a delimiter: nothing in it can be a frame.
+                    self.dropped_bytes += self._end
+                    self.reset()
+                    self._discarding = True
+            n = min(len(data), self.max_frame_size - self._end)
+            self._view[self._end:self._end + n] = data[:n]
+            self._end += n
+            data = data[n:]
+            if self._discarding and not self._skip_oversized():
+                continue
+            if self.mode == FRAME_COMMENT:
+                self._split_comments(frames)
+            else:
+                self._split_lines(frames)
+        if self._start == self._end:
+            self._start = self._end = 0
+        return frames
+
+    def _compact(self):
+        """
+        Move the pending partial frame to the front of the buffer.
+        """
+        pending = self._end - self._start
+        if self._start:
+            self._buf[:pending] = self._view[self._start:self._end].tobytes()
+            self._start = 0
+            self._end = pending
+
+    def _skip_oversized(self):
+        """
+        Drop buffered bytes up to and including the end delimiter of the
+        oversized frame. Returns True once it has been passed.
+        """
+        buf = self._buf
+        if self.mode == FRAME_COMMENT:
+            delimiter = b"*/"
+        else:
+            delimiter = b"\n" if self.mode == FRAME_NEWLINE else b"\x00"
+        idx = buf.find(delimiter, self._start, self._end)
+        if idx < 0:
+            # Keep a trailing b"*" that may be the first half of the closer.
+            keep = 1 if len(delimiter) == 2 and self._end > self._start and buf[self._end - 1] == 0x2A else 0
+            self.dropped_bytes += self._end - keep - self._start
+            self._start = self._end - keep
+            return False
+        self.dropped_bytes += idx + len(delimiter) - self._start
+        self._start = idx + len(delimiter)
+        self._discarding = False
+        return True
+
+    def _split_lines(self, frames):
+        buf = self._buf
+        newline = self.mode == FRAME_NEWLINE
+        delimiter = b"\n" if newline else b"\x00"
+        while True:
+            idx = buf.find(delimiter, self._start, self._end)
+            if idx < 0:
+                return
+            stop = idx
+            if newline and stop > self._start and buf[stop - 1] == 0x0D:  # b"\r"
+                stop -= 1
+            if stop > self._start:
+                frames.append(self._view[self._start:stop].tobytes())
+            self._start = idx + 1
+
+    def _split_comments(self, frames):
+        buf = self._buf
+        while True:
+            begin = buf.find(b"/*", self._start, self._end)
+            if begin < 0:
+                # Keep a trailing b"/" that may be the first half of the next opener.
+                keep = 1 if self._end > self._start and buf[self._end - 1] == 0x2F else 0
+                self.dropped_bytes += self._end - keep - self._start
+                self._start = self._end - keep
+                return
+            self.dropped_bytes += begin - self._start
+            self._start = begin
+            close = buf.find(b"*/", begin + 2, self._end)
+            if close < 0:
+                return
+            frames.append(self._view[begin:close + 2].tobytes())
+            self._start = close + 2
+
+
 class AbstractSerialInterface(ABC):
-    def __init__(self, port, baudrate=115200, timeout=1):
+    def __init__(self, port, baudrate=115200, timeout=1, io_mode=IO_MODE_EVENT,
+                 auto_reconnect=False, max_tx_backlog=256, reconnect_delay=(0.1, 5.0)):
+        """
+        Args:
+            port: Device node, e.g. /dev/ttyUSB0 or /dev/rfcomm0
+            baudrate: Serial baud rate
+            timeout: Read timeout in seconds; also bounds how long the I/O threads take to stop
+            io_mode: IO_MODE_EVENT, IO_MODE_POLL or IO_MODE_ASYNC; the latter
+                needs attach_loop() before connect(), and connect()/disconnect()
+                must then run on that event loop
+            auto_reconnect: Supervise the link: connect() returns immediately and a
+                background thread (re)opens the port with exponential backoff
+            max_tx_backlog: Maximum queued TX messages; the oldest lowest-priority
+                message is dropped beyond this, e.g. during an outage
+            reconnect_delay: (initial, maximum) backoff between reopen attempts in seconds
+        """
+        if io_mode not in IO_MODES:
+            raise ValueError(f"Unknown io_mode: {io_mode}")
         self.port = port
         self.baudrate = baudrate
         self.timeout = timeout
+        self.io_mode = io_mode
         self.serial_connection = None
         self.is_connected = False
         self._rx_thread = None
         self._tx_thread = None
         self._rx_callback = None
-        self._tx_buffer = deque()  # TX buffer (FIFO queue)
+        self._tx_lanes = [deque() for _ in PRIORITIES]  # TX buffer: one FIFO of (data, enqueue time) per priority
+        # Enqueue-to-write latency per priority, in seconds
+        self.tx_stats = {p: {"count": 0, "last": None, "max": 0.0, "total": 0.0, "flushed": 0} for p in PRIORITIES}
         self._tx_lock = threading.Lock()  # Lock for thread-safe access to the TX buffer
+        self._tx_cond = threading.Condition(self._tx_lock)  # Signalled when data is added to the TX buffer
+        self.framer = self.create_framer()  # Splits the RX byte stream into messages; None passes chunks through
+        self.recorder = None  # Optional capture.WireRecorder for RX chunks and TX writes
+        # IO_MODE_ASYNC state
+        self.loop = None
+        self._fd = None
+        self._tx_scheduled = False  # A flush is queued on the loop
+        self._tx_inflight = None  # (unwritten memoryview, batch) of a partially written batch
+        self._async_wake = None  # asyncio.Event for the async supervisor
+        self._supervisor_task = None
+
+        self.auto_reconnect = auto_reconnect
+        self.max_tx_backlog = max_tx_backlog
+        self.reconnect_delay = reconnect_delay
+        self._supervising = False
+        self._supervisor_thread = None
+        self._supervisor_wake = threading.Event()  # Set when the link drops or supervision stops
+        self.link_stats = {
+            "reconnects": 0,  # Successful reopens after a lost link
+            "failed_attempts": 0,  # Reopen attempts that raised
+            "link_losses": 0,
+            "downtime_total": 0.0,  # Seconds spent disconnected after a loss (completed outages)
+            "down_since": None,  # time.monotonic() of the current outage, if any
+            "tx_dropped": 0,  # Messages discarded because the TX backlog was full
+        }
 
     @abstractmethod
     def rx_callback(self, data):
@@ -26,37 +273,289 @@ class AbstractSerialInterface(ABC):
         """
         pass
 
+    def create_framer(self):
+        """
+        Return the StreamFramer used to split received bytes into messages.
+        Subclasses override this; the default passes raw chunks through.
+        """
+        return None
+
+    def attach_loop(self, loop):
+        """
+        Event loop used in IO_MODE_ASYNC; connect()/disconnect() must then run on it.
+        """
+        self.loop = loop
+
     def connect(self):
         """
         Establish serial connection.
+        With auto_reconnect, start the supervisor instead and return immediately.
+        """
+        if self.auto_reconnect:
+            if self.io_mode == IO_MODE_ASYNC:
+                self._start_async_supervisor()
+            else:
+                self._start_supervisor()
+        elif not self.is_connected:
+            self._open()
+
+    def _open(self):
+        """
+        Open the port and start the I/O threads (or register it with the
+        event loop in IO_MODE_ASYNC). Returns True on success.
         """
-        if not self.is_connected:
-            try:
-                self.serial_connection = serial.Serial(
-                    self.port, baudrate=self.baudrate, timeout=self.timeout
-                )
-                self.is_connected = True
-                print(f"{self.port} Connected; {self.baudrate} baud.")
-                self._start_rx_thread()
-                self._start_tx_thread()  # Start the TX thread when connected
-            except Exception:
-                pass
+        asynchronous = self.io_mode == IO_MODE_ASYNC
+        if asynchronous and self.loop is None:
+            raise RuntimeError("IO_MODE_ASYNC needs attach_loop() before connect()")
+        try:
+            self.serial_connection = serial.Serial(
+                self.port, baudrate=self.baudrate, timeout=0 if asynchronous else self.timeout
+            )
+        except Exception as e:
+            logger.warning("%s Connect failed: %s", self.port, e)
+            return False
+        self.is_connected = True
+        if self.framer is not None:
+            self.framer.reset()
+        logger.info("%s Connected; %s baud.", self.port, self.baudrate)
+        if asynchronous:
+            self._fd = self.serial_connection.fileno()
+            self.loop.add_reader(self._fd, self._on_readable)
+            with self._tx_cond:
+                self._tx_inflight = None
+                self._tx_scheduled = False
+                if any(self._tx_lanes):
+                    self._schedule_tx()
+            return True
+        self._start_rx_thread()
+        self._start_tx_thread()  # Start the TX thread when connected
+        return True
 
     def disconnect(self):
         """
         Close serial connection.
         """
+        if self._supervisor_thread is not None:
+            self._supervising = False
+            self._supervisor_wake.set()
+            self._supervisor_thread.join()
+            self._supervisor_thread = None
+        if self._supervisor_task is not None:
+            self._supervising = False
+            self._supervisor_task.cancel()
+            self._supervisor_task = None
         if self.is_connected:
             self.is_connected = False
-            if self._rx_thread is not None:
-                self._rx_thread.join()  # Wait for the RX thread to finish.
-            if self._tx_thread is not None:
-                self._tx_thread.join()  # Wait for the TX thread to finish.
+            with self._tx_cond:
+                self._tx_cond.notify_all()  # Wake the TX thread so it can exit.
+            self._join_io_threads()
+            self._unregister_fd()
             if self.serial_connection:
                 self.serial_connection.close()
-                print(f"{self.port} Disconnected")
+                logger.info("%s Disconnected", self.port)
         else:
-            print(f"{self.port} No active connection to disconnect.")
+            self._unregister_fd()
+            logger.info("%s No active connection to disconnect.", self.port)
+
+    def _join_io_threads(self):
+        current = threading.current_thread()
+        for thread in (self._rx_thread, self._tx_thread):
+            if thread is not None and thread is not current:
+                thread.join()  # Wait for the I/O thread to finish.
+
+    def _link_lost(self, error):
+        """
+        Called from an I/O thread when the port fails, e.g. the USB device was unplugged.
+        Stops both I/O threads and wakes the supervisor.
+        """
+        with self._tx_cond:
+            if not self.is_connected:
+                return
+            self.is_connected = False
+            self._tx_cond.notify_all()
+        self.link_stats["link_losses"] += 1
+        self.link_stats["down_since"] = time.monotonic()
+        logger.warning("%s Link lost: %s", self.port, error)
+        self._supervisor_wake.set()
+        if self._async_wake is not None:
+            self._async_wake.set()
+
+    def _start_supervisor(self):
+        if self._supervising:
+            return
+        self._supervising = True
+        self._supervisor_wake.clear()
+        self._supervisor_thread = threading.Thread(target=self._supervise, daemon=True)
+        self._supervisor_thread.start()
+
+    def _supervise(self):
+        """
+        Keep the link open: reopen after a loss with exponential backoff,
+        polling for the device node while it is absent (hot-plug).
+        """
+        initial_delay, max_delay = self.reconnect_delay
+        delay = initial_delay
+        while self._supervising:
+            if self.is_connected:
+                self._supervisor_wake.wait()
+                self._supervisor_wake.clear()
+                continue
+            # Tear down what is left of the previous connection.
+            self._join_io_threads()
+            if self.serial_connection is not None and self.serial_connection.is_open:
+                try:
+                    self.serial_connection.close()
+                except Exception:
+                    pass
+            if not os.path.exists(self.port):
+                # Device node gone: wait for it to reappear without growing the backoff.
+                self._supervisor_wake.wait(initial_delay)
+                continue
+            if self._open():
+                self._note_reconnected()
+                delay = initial_delay
+                continue
+            self.link_stats["failed_attempts"] += 1
+            self._supervisor_wake.wait(delay)
+            delay = min(delay * 2, max_delay)
+
+    def _note_reconnected(self):
+        down_since = self.link_stats["down_since"]
+        if down_since is not None:
+            self.link_stats["reconnects"] += 1
+            self.link_stats["downtime_total"] += time.monotonic() - down_since
+            self.link_stats["down_since"] = None
+
+    def _start_async_supervisor(self):
+        if self._supervising:
+            return
+        self._supervising = True
+        self._async_wake = asyncio.Event()
+        self._supervisor_task = self.loop.create_task(self._supervise_async())
+
+    async def _supervise_async(self):
+        """
+        _supervise() as a coroutine on the event loop, for IO_MODE_ASYNC.
+        """
+        initial_delay, max_delay = self.reconnect_delay
+        delay = initial_delay
+        while self._supervising:
+            if self.is_connected:
+                await self._async_wake.wait()
+                self._async_wake.clear()
+                continue
+            self._unregister_fd()
+            if self.serial_connection is not None and self.serial_connection.is_open:
+                try:
+                    self.serial_connection.close()
+                except Exception:
+                    pass
+            if not os.path.exists(self.port):
+                await self._wait_async_wake(initial_delay)
+                continue
+            if self._open():
+                self._note_reconnected()
+                delay = initial_delay
+                continue
+            self.link_stats["failed_attempts"] += 1
+            await self._wait_async_wake(delay)
+            delay = min(delay * 2, max_delay)
+
+    async def _wait_async_wake(self, timeout):
+        try:
+            await asyncio.wait_for(self._async_wake.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        self._async_wake.clear()
+
+    def _unregister_fd(self):
+        if self._fd is not None and self.loop is not None:
+            self.loop.remove_reader(self._fd)
+            self.loop.remove_writer(self._fd)
+        self._fd = None
+
+    def _on_readable(self):
+        """
+        IO_MODE_ASYNC reader callback: drain what the port has and dispatch it.
+        """
+        try:
+            data = os.read(self._fd, 4096)
+        except BlockingIOError:
+            return
+        except OSError as e:
+            self._async_link_lost(e)
+            return
+        if not data:
+            # A readable tty with nothing to read has been hung up.
+            self._async_link_lost(OSError("port hung up"))
+            return
+        self._handle_rx(data)
+
+    def _async_link_lost(self, error):
+        self._unregister_fd()
+        with self._tx_cond:
+            if self._tx_inflight is not None:
+                self._requeue_tx(self._tx_inflight[1])
+                self._tx_inflight = None
+        self._link_lost(error)
+
+    def _schedule_tx(self):
+        """
+        Queue a flush on the event loop unless one is pending. Caller holds the TX lock.
+        Messages queued in the same loop iteration go out in one write.
+        """
+        if self._tx_scheduled or self._tx_inflight is not None or not self.is_connected:
+            return
+        self._tx_scheduled = True
+        self.loop.call_soon_threadsafe(self._flush_tx_async)
+
+    def _flush_tx_async(self):
+        """
+        Write pending TX data without blocking; a partial write continues
+        from a writer callback when the port can take more.
+        """
+        with self._tx_cond:
+            self._tx_scheduled = False
+            if not self.is_connected:
+                return
+            if self._tx_inflight is None:
+                batch = self._pop_tx()
+                if not batch:
+                    return
+                data = b"".join(entry[0] for entry in batch)
+                self._tx_inflight = (memoryview(data), batch)
+            view, batch = self._tx_inflight
+        try:
+            written = os.write(self._fd, view)
+        except BlockingIOError:
+            written = 0
+        except OSError as e:
+            self._async_link_lost(e)
+            return
+        if written < len(view):
+            with self._tx_cond:
+                self._tx_inflight = (view[written:], batch)
+            self.loop.add_writer(self._fd, self._flush_tx_async)
+            return
+        self.loop.remove_writer(self._fd)
+        data = view.obj
+        if self.recorder is not None:
+            self.recorder.record_tx(self.port, data)
+        self._record_tx(batch)
+        logger.debug("%s tx: %s", self.port, data)
+        with self._tx_cond:
+            self._tx_inflight = None
+            if any(self._tx_lanes):
+                self._schedule_tx()
+
+    def get_link_stats(self):
+        """
+        Copy of link_stats with `downtime_total` including the ongoing outage.
+        """
+        stats = dict(self.link_stats)
+        if stats["down_since"] is not None:
+            stats["downtime_total"] += time.monotonic() - stats["down_since"]
+        return stats
 
     def _start_rx_thread(self):
         """
@@ -64,16 +563,30 @@ class AbstractSerialInterface(ABC):
         """
         def receive_data():
             while self.is_connected:
-                if self.serial_connection.in_waiting > 0:
-                    data = self.serial_connection.read(self.serial_connection.in_waiting)
-                    if self._rx_callback:
-                        print(f"{self.port} Data received: {data}")
-                        self._rx_callback(data)
-                    else:
-                        self.rx_callback(data)
+                try:
+                    waiting = self.serial_connection.in_waiting
+                    data = self.serial_connection.read(waiting) if waiting > 0 else None
+                except Exception as e:
+                    self._link_lost(e)
+                    return
+                if data:
+                    self._handle_rx(data)
                 time.sleep(0.1)
 
-        self._rx_thread = threading.Thread(target=receive_data)
+        def receive_data_event():
+            while self.is_connected:
+                # Blocks until at least one byte arrives or `timeout` expires,
+                # then picks up whatever else is already waiting.
+                try:
+                    data = self.serial_connection.read(max(1, self.serial_connection.in_waiting))
+                except Exception as e:
+                    self._link_lost(e)
+                    return
+                if data:
+                    self._handle_rx(data)
+
+        target = receive_data_event if self.io_mode == IO_MODE_EVENT else receive_data
+        self._rx_thread = threading.Thread(target=target)
         self._rx_thread.daemon = True
         self._rx_thread.start()
 
@@ -84,32 +597,148 @@ class AbstractSerialInterface(ABC):
         def transmit_data():
             while self.is_connected:
                 with self._tx_lock:
-                    if self._tx_buffer:
-                        data = self._tx_buffer.popleft()  # Get data from TX buffer
-                        self.serial_connection.write(data)
-                        print(f"{self.port} tx: {data}")
+                    batch = self._pop_tx(single=True)  # Get data from TX buffer
+                    if batch:
+                        data = batch[0][0]
+                        try:
+                            self.serial_connection.write(data)
+                        except Exception as e:
+                            self._requeue_tx(batch)
+                            error = e
+                        else:
+                            error = None
+                            if self.recorder is not None:
+                                self.recorder.record_tx(self.port, data)
+                            self._record_tx(batch)
+                            logger.debug("%s tx: %s", self.port, data)
+                if batch and error is not None:
+                    self._link_lost(error)
+                    return
                 time.sleep(0.1)
 
-        self._tx_thread = threading.Thread(target=transmit_data)
+        def transmit_data_event():
+            while self.is_connected:
+                with self._tx_cond:
+                    while self.is_connected and not any(self._tx_lanes):
+                        self._tx_cond.wait(self.timeout)
+                    # Coalesce everything pending into a single write, highest priority first.
+                    batch = self._pop_tx()
+                # The blocking write happens outside the lock so producers never wait on the UART.
+                if batch:
+                    data = b"".join(entry[0] for entry in batch)
+                    try:
+                        self.serial_connection.write(data)
+                    except Exception as e:
+                        # Keep the batch for the next connection.
+                        with self._tx_cond:
+                            self._requeue_tx(batch)
+                        self._link_lost(e)
+                        return
+                    if self.recorder is not None:
+                        self.recorder.record_tx(self.port, data)
+                    self._record_tx(batch)
+                    logger.debug("%s tx: %s", self.port, data)
+
+        target = transmit_data_event if self.io_mode == IO_MODE_EVENT else transmit_data
+        self._tx_thread = threading.Thread(target=target)
         self._tx_thread.daemon = True
         self._tx_thread.start()
 
+    def _pop_tx(self, single=False):
+        """
+        Remove queued messages in priority order. Caller holds the TX lock.
+        Returns a list of (data, enqueue time, priority).
+        """
+        batch = []
+        for priority, lane in enumerate(self._tx_lanes):
+            while lane:
+                data, queued_at = lane.popleft()
+                batch.append((data, queued_at, priority))
+                if single:
+                    return batch
+        return batch
+
+    def _requeue_tx(self, batch):
+        """
+        Put an unsent batch back at the front of its lanes. Caller holds the TX lock.
+        """
+        for data, queued_at, priority in reversed(batch):
+            self._tx_lanes[priority].appendleft((data, queued_at))
+
+    def _record_tx(self, batch):
+        """
+        Update enqueue-to-write latency statistics for a completed write.
+        """
+        now = time.monotonic()
+        for _, queued_at, priority in batch:
+            stats = self.tx_stats[priority]
+            latency = now - queued_at
+            stats["count"] += 1
+            stats["last"] = latency
+            stats["total"] += latency
+            if latency > stats["max"]:
+                stats["max"] = latency
+
+    def _handle_rx(self, data):
+        """
+        Dispatch received data to the custom callback if set, else to `rx_callback`.
+        With a framer, each complete message is dispatched separately.
+        """
+        if self.recorder is not None:
+            self.recorder.record_rx(self.port, data)
+        frames = self.framer.feed(data) if self.framer is not None else (data,)
+        for frame in frames:
+            if self._rx_callback:
+                logger.debug("%s Data received: %s", self.port, frame)
+                self._rx_callback(frame)
+            else:
+                self.rx_callback(frame)
+
+    def set_recorder(self, recorder):
+        """
+        Capture every RX chunk and TX write with `recorder` (a capture.WireRecorder); None stops capturing.
+        """
+        self.recorder = recorder
+
     def set_rx_callback(self, callback):
         """
         Set a custom RX callback function.
         """
         self._rx_callback = callback
 
-    def tx(self, data):
+    def tx(self, data, priority=PRIORITY_CONTROL, flush=False):
         """
         Add data to the TX buffer.
+
+        Args:
+            data: Bytes (or str, encoded as UTF-8) to send
+            priority: TX lane; lower values are sent first
+            flush: Drop everything still queued in lower-priority lanes,
+                e.g. moves superseded by a STOP
         """
-        if self.is_connected:
-            with self._tx_lock:
-                self._tx_buffer.append(data)  # Add data to TX buffer
-                # print(f"{self.port} Data added to TX buffer: {data}")
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        # A supervised link keeps buffering through short outages.
+        if self.is_connected or self._supervising:
+            with self._tx_cond:
+                if flush:
+                    for lower in PRIORITIES[priority + 1:]:
+                        self.tx_stats[lower]["flushed"] += len(self._tx_lanes[lower])
+                        self._tx_lanes[lower].clear()
+                if sum(len(lane) for lane in self._tx_lanes) >= self.max_tx_backlog:
+                    # Drop the oldest message of the lowest non-empty priority.
+                    for lane in reversed(self._tx_lanes):
+                        if lane:
+                            lane.popleft()
+                            self.link_stats["tx_dropped"] += 1
+                            break
+                self._tx_lanes[priority].append((data, time.monotonic()))  # Add data to TX buffer
+                if self.io_mode == IO_MODE_ASYNC:
+                    self._schedule_tx()
+                else:
+                    self._tx_cond.notify()
         else:
-            print(f"{self.port} Not connected. Cannot transmit data.")
+            logger.warning("%s Not connected. Cannot transmit data.", self.port)
 
     def rx(self):
         """
@@ -119,6 +748,6 @@ class AbstractSerialInterface(ABC):
             data = self.serial_connection.read(self.serial_connection.in_waiting)
             return data
         else:
-            print(f"{self.port} Not connected. Cannot receive data.")
+            logger.warning("%s Not connected. Cannot receive data.", self.port)
             return None
 
@@ -0,0 +1,203 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger("Events")
+
+EVENT_STOP = "EVENT.STOP"
+
+
+class TaskEvent:
+    """
+    Something the TaskServer should react to: a SharedRsc key that was
+    written (value as written), a timer that fired (key = timer name), or
+    EVENT_STOP. `t_ns` is when it happened (monotonic ns).
+    """
+    __slots__ = ("key", "value", "t_ns")
+
+    def __init__(self, key, value=None, t_ns=None):
+        self.key = key
+        self.value = value
+        self.t_ns = time.monotonic_ns() if t_ns is None else t_ns
+
+    def __repr__(self):
+        return f"TaskEvent({self.key!r}, {self.value!r})"
+
+
+class EventSource:
+    """
+    Single blocking stream of TaskEvents for the TaskServer.
+
+    Events come from SharedRsc subscriptions on `keys` (delivered in the
+    writer's thread), one-shot timers (`schedule`) and explicit `post` calls.
+    Keys kept in a shared-memory backend are written by other processes
+    without local notifications; those are watched by a small polling thread
+    every `backend_poll` seconds. A backend change is dispatched once, by
+    whichever of the subscription and the watcher sees it first, so local
+    writes to those keys are not delivered twice.
+
+    By default consumers block in `next()`. After `attach_loop(loop)` the
+    source feeds an asyncio queue instead: consume with `await next_async()`,
+    and timers run as loop callbacks.
+
+    Args:
+        shared_resources: SharedRsc to subscribe to
+        keys: Keys whose writes become events
+        backend_poll: Poll interval for keys held in a shared-memory backend
+    """
+
+    def __init__(self, shared_resources, keys, backend_poll=0.005):
+        self.shared_resources = shared_resources
+        self.keys = tuple(keys)
+        self.backend_poll = backend_poll
+        self._events = deque()
+        self._timers = []  # heap of (due t_ns, tie-break, name)
+        self._timer_ids = itertools.count()
+        self._cancelled = set()
+        self._cond = threading.Condition()
+        self._watcher = None
+        self._watching = False
+        self._backend = None
+        # Watched key -> [last change count dispatched, dispatched by the watcher]
+        self._seen = {}
+        self._seen_lock = threading.Lock()
+        self._loop = None
+        self._loop_thread = None
+        self._async_events = None
+        self._async_timers = {}  # name -> asyncio.TimerHandle
+
+    def attach_loop(self, loop):
+        """
+        Deliver events to `next_async()` on `loop`; call from the loop's thread.
+        """
+        self._loop = loop
+        self._loop_thread = threading.get_ident()
+        self._async_events = asyncio.Queue()
+
+    def start(self):
+        self.shared_resources.subscribe(self.keys, self._on_change)
+        backend = self.shared_resources.get_backend()
+        watched = [key for key in self.keys if backend is not None and key in backend.keys]
+        if watched:
+            self._backend = backend
+            self._seen = {key: [backend.change_count(key), False] for key in watched}
+            self._watching = True
+            self._watcher = threading.Thread(target=self._watch_backend, args=(backend, watched),
+                                             name="EventWatcher", daemon=True)
+            self._watcher.start()
+
+    def close(self):
+        self.shared_resources.unsubscribe(self.keys, self._on_change)
+        self._watching = False
+        if self._watcher is not None:
+            self._watcher.join()
+            self._watcher = None
+
+    def _on_change(self, key, value, version):
+        seen = self._seen.get(key)
+        if seen is not None:
+            count = self._backend.change_count(key)
+            with self._seen_lock:
+                if count == seen[0] and seen[1]:
+                    # The watcher got to this local write first.
+                    seen[1] = False
+                    return
+                seen[0], seen[1] = count, False
+        self.post(key, value)
+
+    def _watch_backend(self, backend, keys):
+        seen = self._seen
+        while self._watching:
+            time.sleep(self.backend_poll)
+            for key in keys:
+                count = backend.change_count(key)
+                with self._seen_lock:
+                    if count == seen[key][0]:
+                        continue
+                    seen[key][0], seen[key][1] = count, True
+                self.post(key, self.shared_resources.get(key))
+
+    def post(self, key, value=None, t_ns=None):
+        event = TaskEvent(key, value, t_ns)
+        if self._loop is not None:
+            if threading.get_ident() == self._loop_thread:
+                self._async_events.put_nowait(event)
+            else:
+                self._loop.call_soon_threadsafe(self._async_events.put_nowait, event)
+            return
+        with self._cond:
+            self._events.append(event)
+            self._cond.notify()
+
+    async def next_async(self):
+        """
+        Next event, on the attached loop.
+        """
+        return await self._async_events.get()
+
+    def _schedule_async(self, delay, name):
+        handle = self._async_timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+        due = time.monotonic_ns() + int(delay * 1e9)
+        self._async_timers[name] = self._loop.call_later(delay, self._fire_async, name, due)
+
+    def _fire_async(self, name, due):
+        self._async_timers.pop(name, None)
+        self._async_events.put_nowait(TaskEvent(name, None, due))
+
+    def _cancel_async(self, name):
+        handle = self._async_timers.pop(name, None)
+        if handle is not None:
+            handle.cancel()
+
+    def schedule(self, delay, name):
+        """
+        Deliver TaskEvent(name) after `delay` seconds; rescheduling a name replaces the pending timer.
+        """
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._schedule_async, delay, name)
+            return
+        due = time.monotonic_ns() + int(delay * 1e9)
+        with self._cond:
+            self._cancelled.discard(name)
+            self._timers = [timer for timer in self._timers if timer[2] != name]
+            heapq.heapify(self._timers)
+            heapq.heappush(self._timers, (due, next(self._timer_ids), name))
+            self._cond.notify()
+
+    def cancel(self, name):
+        if self._loop is not None:
+            self._loop.call_soon_threadsafe(self._cancel_async, name)
+            return
+        with self._cond:
+            if any(timer[2] == name for timer in self._timers):
+                self._cancelled.add(name)
+
+    def next(self, timeout=None):
+        """
+        Block until the next event or until `timeout` seconds pass (then None).
+        Due timers are delivered in order, with t_ns set to their due time.
+        """
+        deadline = None if timeout is None else time.monotonic_ns() + int(timeout * 1e9)
+        with self._cond:
+            while True:
+                now = time.monotonic_ns()
+                while self._timers and self._timers[0][0] <= now:
+                    due, _, name = heapq.heappop(self._timers)
+                    if name in self._cancelled:
+                        self._cancelled.discard(name)
+                        continue
+                    self._events.append(TaskEvent(name, None, due))
+                if self._events:
+                    return self._events.popleft()
+                wake = self._timers[0][0] if self._timers else None
+                if deadline is not None:
+                    if now >= deadline:
+                        return None
+                    wake = deadline if wake is None else min(wake, deadline)
+                self._cond.wait(None if wake is None else (wake - now) / 1e9)
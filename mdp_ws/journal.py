@@ -0,0 +1,553 @@
+import argparse
+import bisect
+import contextlib
+import contextvars
+import logging
+import mmap
+import os
+import pickle
+import queue
+import struct
+import threading
+import time
+from collections import deque
+from queue import Queue
+
+import numpy as np
+
+from state import QueueLike
+
+logger = logging.getLogger("Journal")
+
+# File layout: MAGIC, then records of RECORD_HEADER followed by a pickled payload:
+#   J_SET       (key, value, source)
+#   J_PUT       (key, item, source)
+#   J_GET       (key, item, source)
+#   J_SNAPSHOT  ({key: value}, SharedRsc version)
+MAGIC = b"MDPJRN01"
+RECORD_HEADER = struct.Struct("<QBI")  # monotonic ns, kind, payload length
+
+J_SET = 0
+J_PUT = 1
+J_GET = 2
+J_SNAPSHOT = 3
+KIND_NAMES = {J_SET: "SET", J_PUT: "PUT", J_GET: "GET", J_SNAPSHOT: "SNAPSHOT"}
+
+# Values that are recorded as they are without any checks.
+_PLAIN_TYPES = (float, int, str, bytes, bool, tuple, type(None))
+# Other values recorded by value; anything else (interfaces, telemetry stores) becomes Unrecorded.
+_DATA_TYPES = (list, dict, np.ndarray, np.generic)
+
+# Source recorded with a change: set with journal_source(), else the writing thread's name.
+_source = contextvars.ContextVar("journal_source", default=None)
+
+
+@contextlib.contextmanager
+def journal_source(name):
+    """
+    Record the changes made inside the block as coming from `name`, whichever
+    thread or event loop they run on (e.g. the TaskServer under the asyncio runtime).
+    """
+    token = _source.set(name)
+    try:
+        yield
+    finally:
+        _source.reset(token)
+
+
+def current_source():
+    return _source.get() or threading.current_thread().name
+
+
+class QueueState:
+    """
+    Recorded form of a queue-valued key: its capacity and contents.
+    """
+
+    def __init__(self, maxsize, items):
+        self.maxsize = maxsize
+        self.items = list(items)
+
+    def __repr__(self):
+        return f"QueueState(maxsize={self.maxsize}, items={self.items!r})"
+
+    def to_queue(self):
+        q = Queue(self.maxsize)
+        for item in self.items:
+            q.put_nowait(item)
+        return q
+
+
+class Unrecorded:
+    """
+    Placeholder for a value that cannot be pickled (e.g. the telemetry store).
+    """
+
+    def __init__(self, type_name, text):
+        self.type_name = type_name
+        self.text = text
+
+    def __repr__(self):
+        return f"<unrecorded {self.type_name}>"
+
+
+def freeze(val):
+    """
+    Picklable stand-in for a stored value, taken at the time of the write.
+    """
+    if type(val) in _PLAIN_TYPES:
+        return val
+    if isinstance(val, QueueLike):
+        if isinstance(val, Queue):
+            with val.mutex:
+                return QueueState(val.maxsize, val.queue)
+        # Shared-memory channels cannot be inspected without consuming them.
+        return QueueState(getattr(val, "capacity", 0), ())
+    if isinstance(val, (_DATA_TYPES, QueueState, Unrecorded)):
+        return val
+    return Unrecorded(type(val).__name__, repr(val)[:200])
+
+
+def thaw(val):
+    """
+    Live value for a recorded one: queues are rebuilt, everything else is returned as is.
+    """
+    if isinstance(val, QueueState):
+        return val.to_queue()
+    return val
+
+
+class StateJournal:
+    """
+    Append-only binary journal of SharedRsc changes.
+
+    Installed with `SharedRsc.set_journal()`, it receives every write, queue
+    put and take (under the store lock, so the journal order is the order in
+    which the changes happened) and only timestamps and queues them; a
+    background thread pickles and writes batches, and every
+    `snapshot_interval` seconds appends a full snapshot so readers can seek
+    without replaying the whole file.
+
+    Args:
+        path: Journal file
+        store: The SharedRsc being journaled (for snapshots)
+        snapshot_interval: Seconds between full snapshots
+        flush_interval: Seconds between batched writes
+        exclude: Key prefixes not to journal, e.g. ("CAR.GYRO.",) to drop sensor-rate telemetry
+    """
+
+    def __init__(self, path, store, snapshot_interval=5.0, flush_interval=0.05, exclude=()):
+        self.path = path
+        self.store = store
+        self.snapshot_interval = snapshot_interval
+        self.flush_interval = flush_interval
+        self.exclude = tuple(exclude)
+        self._queue = deque()  # (t_ns, kind, payload); deque.append is thread-safe
+        self._file = open(path, "wb")
+        self._file.write(MAGIC)
+        self._stop = threading.Event()
+        self.records = 0
+        self._next_snapshot = 0.0
+        self._writer = threading.Thread(target=self._write_loop, name="Journal", daemon=True)
+
+    def start(self):
+        """
+        Snapshot the current state, then journal changes from here on.
+        """
+        with self.store.transaction():
+            self.snapshot()
+            self.store.set_journal(self)
+        self._next_snapshot = time.monotonic() + self.snapshot_interval
+        self._writer.start()
+        return self
+
+    def record_set(self, key, val):
+        if not key.startswith(self.exclude):
+            self._queue.append((time.monotonic_ns(), J_SET,
+                                (key, freeze(val), current_source())))
+
+    def record_put(self, key, item):
+        self._queue.append((time.monotonic_ns(), J_PUT, (key, item, current_source())))
+
+    def record_get(self, key, item):
+        self._queue.append((time.monotonic_ns(), J_GET, (key, item, current_source())))
+
+    def snapshot(self):
+        """
+        Queue a full snapshot of the store.
+        """
+        with self.store.transaction():
+            values = {key: freeze(self.store.get(key)) for key in self.store.keys()}
+            self._queue.append((time.monotonic_ns(), J_SNAPSHOT, (values, self.store.version)))
+
+    def close(self):
+        self.store.set_journal(None)
+        self._stop.set()
+        if self._writer.is_alive():
+            self._writer.join()
+        self._drain()
+        self._file.close()
+        logger.info("Journal %s closed; %d records", self.path, self.records)
+
+    def _write_loop(self):
+        while not self._stop.wait(self.flush_interval):
+            if time.monotonic() >= self._next_snapshot:
+                self.snapshot()
+                self._next_snapshot = time.monotonic() + self.snapshot_interval
+            self._drain()
+
+    def _drain(self):
+        chunks = []
+        pending = self._queue
+        while pending:
+            t_ns, kind, payload = pending.popleft()
+            try:
+                data = pickle.dumps(payload, protocol=pickle.HIGHEST_PROTOCOL)
+            except Exception:
+                data = pickle.dumps(self._placeholder(kind, payload), protocol=pickle.HIGHEST_PROTOCOL)
+            chunks.append(RECORD_HEADER.pack(t_ns, kind, len(data)))
+            chunks.append(data)
+            self.records += 1
+        if chunks:
+            self._file.write(b"".join(chunks))
+            self._file.flush()
+
+    @staticmethod
+    def _placeholder(kind, payload):
+        def safe(val):
+            try:
+                pickle.dumps(val)
+                return val
+            except Exception:
+                return Unrecorded(type(val).__name__, repr(val)[:200])
+        if kind == J_SNAPSHOT:
+            values, version = payload
+            return {key: safe(val) for key, val in values.items()}, version
+        key, val, source = payload
+        return key, safe(val), source
+
+
+class JournalReader:
+    """
+    Memory-mapped reader for a StateJournal file.
+
+    Opening scans the record headers once to index the snapshots; `state_at`
+    then starts from the nearest earlier snapshot.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self._file = open(path, "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        if size < len(MAGIC):
+            raise ValueError(f"{path} is not a journal file")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self._map[:len(MAGIC)] != MAGIC:
+            raise ValueError(f"{path} is not a journal file")
+        self.snapshot_times = []
+        self.snapshot_offsets = []
+        self.start_t = self.end_t = None
+        for offset, t_ns, kind, length in self._headers(len(MAGIC)):
+            if self.start_t is None:
+                self.start_t = t_ns
+            self.end_t = t_ns
+            if kind == J_SNAPSHOT:
+                self.snapshot_times.append(t_ns)
+                self.snapshot_offsets.append(offset)
+
+    def _headers(self, offset):
+        end = len(self._map)
+        unpack_from = RECORD_HEADER.unpack_from
+        header_size = RECORD_HEADER.size
+        while offset + header_size <= end:
+            t_ns, kind, length = unpack_from(self._map, offset)
+            if offset + header_size + length > end:
+                logger.warning("Truncated record at end of %s", self.path)
+                return
+            yield offset, t_ns, kind, length
+            offset += header_size + length
+
+    def records(self, offset=None):
+        """
+        Yield (t_ns, kind, payload) from `offset` (default: the first record).
+        """
+        header_size = RECORD_HEADER.size
+        for start, t_ns, kind, length in self._headers(len(MAGIC) if offset is None else offset):
+            yield t_ns, kind, pickle.loads(self._map[start + header_size:start + header_size + length])
+
+    def __iter__(self):
+        return self.records()
+
+    def state_at(self, t_ns):
+        """
+        {key: value} as of monotonic time t_ns (queues as QueueState).
+        """
+        i = bisect.bisect_right(self.snapshot_times, t_ns) - 1
+        values = {}
+        offset = self.snapshot_offsets[i] if i >= 0 else None
+        for rec_t, kind, payload in self.records(offset):
+            if rec_t > t_ns:
+                break
+            apply_record(values, kind, payload)
+        return values
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+
+def apply_record(values, kind, payload):
+    """
+    Apply one journal record to a {key: value} state with queues as QueueState.
+    """
+    if kind == J_SNAPSHOT:
+        values.clear()
+        values.update(payload[0])
+        return
+    key, val, _ = payload
+    if kind == J_SET:
+        values[key] = val
+    elif isinstance(values.get(key), QueueState):
+        items = values[key].items
+        if kind == J_PUT:
+            items.append(val)
+        elif items:
+            items.pop(0)
+
+
+class ReplayCar:
+    """
+    Stands in for Car during a replay: records the commands TaskServer issues.
+    """
+
+    def __init__(self):
+        from pose import PoseEstimator
+        self.commands = []
+        self.pose = PoseEstimator()
+
+    def move(self, direction, distance=10, timeout=None):
+        from carlink import CommandHandle
+        self.commands.append(("MOVE", direction, distance))
+        handle = CommandHandle(f"{direction}{distance}")
+        handle._resolve("DONE")
+        return handle
+
+    def stop(self, flush=True, timeout=None):
+        from carlink import CommandHandle
+        self.commands.append(("STOP",))
+        handle = CommandHandle("STOP")
+        handle._resolve("IDLE")
+        return handle
+
+
+class _ListJournal:
+    """
+    In-memory journal of what the replayed TaskServer does while `capturing`.
+    """
+
+    def __init__(self):
+        self.entries = []
+        self.capturing = False
+
+    def record_set(self, key, val):
+        if self.capturing:
+            self.entries.append((J_SET, key, freeze(val)))
+
+    def record_put(self, key, item):
+        if self.capturing:
+            self.entries.append((J_PUT, key, item))
+
+    def record_get(self, key, item):
+        if self.capturing:
+            self.entries.append((J_GET, key, item))
+
+
+def _comparable(entry):
+    kind, key, val = entry
+    if isinstance(val, QueueState):
+        val = ("QueueState", val.maxsize, tuple(val.items))
+    elif isinstance(val, Unrecorded):
+        val = ("Unrecorded", val.type_name)
+    return kind, key, val
+
+
+def _restore(store, key, val):
+    """
+    Write a recorded value into the replay store. MAP.ARENA is rebuilt from
+    MAP.STR; other Unrecorded values leave the store's value as it is.
+    """
+    from arenamap import ArenaMap
+    if isinstance(val, Unrecorded):
+        if key != "MAP.ARENA":
+            return
+        text = store.get("MAP.STR")
+        try:
+            val = ArenaMap.from_string(text) if text else None
+        except ValueError:
+            val = None
+    store.set(key, thaw(val))
+
+
+def replay_taskserver(path, speed=0.0, source=None):
+    """
+    Drive a fresh TaskServer through the inputs recorded in a journal.
+
+    Records from sources other than `source` are applied to SharedRsc
+    in order and each one on an event key is dispatched to the TaskServer
+    as its event loop would (timers and job completions are not recorded). What the replayed
+    TaskServer writes and takes is compared with what the recorded one did.
+
+    Args:
+        path: Journal file
+        speed: Playback rate relative to real time; 0 replays as fast as possible
+        source: Journal source of the recorded TaskServer; default TaskServer.JOURNAL_SOURCE
+
+    Returns:
+        dict with steps, step time, recorded and replay durations, car commands
+        and the first divergence from the recorded TaskServer (None if identical)
+    """
+    from sharedResources import SharedRsc
+    from state import install_state
+    from taskserver import TaskServer
+    from events import TaskEvent
+
+    if source is None:
+        source = TaskServer.JOURNAL_SOURCE
+    reader = JournalReader(path)
+    recorded = []
+    replayed = _ListJournal()
+    car = ReplayCar()
+    server = None
+    steps = 0
+    busy = 0.0
+    wall_start = time.monotonic()
+
+    def step(event=None):
+        nonlocal steps, busy
+        replayed.capturing = True
+        begin = time.perf_counter()
+        try:
+            server.step(event)
+        finally:
+            busy += time.perf_counter() - begin
+            replayed.capturing = False
+        steps += 1
+
+    try:
+        for t_ns, kind, payload in reader:
+            if speed > 0:
+                delay = (t_ns - reader.start_t) / 1e9 / speed - (time.monotonic() - wall_start)
+                if delay > 0:
+                    time.sleep(delay)
+            if kind == J_SNAPSHOT:
+                if server is None:
+                    # Initial state (MAP.ARENA last, as it is rebuilt from MAP.STR),
+                    # then start the TaskServer on top of it with its initial step.
+                    install_state(SharedRsc)
+                    for key, val in sorted(payload[0].items(), key=lambda item: item[0] == "MAP.ARENA"):
+                        _restore(SharedRsc, key, val)
+                    SharedRsc.set_journal(replayed)
+                    server = TaskServer(car, None, SharedRsc)
+                    step()
+                continue
+            if server is None:
+                continue
+            key, val, tag = payload
+            if tag == source:
+                recorded.append((kind, key, freeze(val)))
+                continue
+            try:
+                if kind == J_SET:
+                    _restore(SharedRsc, key, val)
+                elif kind == J_PUT:
+                    SharedRsc.put(key, val)
+                elif kind == J_GET:
+                    SharedRsc.take(key)
+            except (queue.Full, queue.Empty):
+                # The replayed TaskServer consumed requests at different times than the recorded one.
+                logger.warning("Could not apply %s %s at %.3f s", KIND_NAMES[kind], key,
+                               (t_ns - reader.start_t) / 1e9)
+            if key in TaskServer.EVENT_KEYS:
+                step(TaskEvent(key, SharedRsc.get(key), t_ns))
+    finally:
+        SharedRsc.set_journal(None)
+        reader.close()
+
+    wall = time.monotonic() - wall_start
+    divergence = None
+    recorded_cmp = [_comparable(entry) for entry in recorded]
+    produced_cmp = [_comparable(entry) for entry in replayed.entries]
+    for i, (expected, actual) in enumerate(zip(recorded_cmp, produced_cmp)):
+        if expected != actual:
+            divergence = {"index": i, "recorded": expected, "replayed": actual}
+            break
+    if divergence is None and len(recorded_cmp) != len(produced_cmp):
+        n = min(len(recorded_cmp), len(produced_cmp))
+        divergence = {"index": n,
+                      "recorded": recorded_cmp[n] if n < len(recorded_cmp) else None,
+                      "replayed": produced_cmp[n] if n < len(produced_cmp) else None}
+    recorded_s = (reader.end_t - reader.start_t) / 1e9 if reader.start_t is not None else 0.0
+    return {
+        "steps": steps,
+        "step_time_s": busy,
+        "recorded_s": recorded_s,
+        "replay_s": wall,
+        "speedup": recorded_s / wall if wall > 0 else None,
+        "car_commands": car.commands,
+        "divergence": divergence,
+    }
+
+
+def dump(path):
+    reader = JournalReader(path)
+    try:
+        for t_ns, kind, payload in reader:
+            rel = (t_ns - reader.start_t) / 1e6
+            if kind == J_SNAPSHOT:
+                print(f"{rel:12.3f} ms  SNAPSHOT  version={payload[1]} keys={len(payload[0])}")
+            else:
+                key, val, source = payload
+                print(f"{rel:12.3f} ms  {KIND_NAMES[kind]:<8}  {key} = {val!r}  [{source}]")
+    finally:
+        reader.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or replay SharedRsc journals")
+    sub = parser.add_subparsers(dest="command", required=True)
+    dump_parser = sub.add_parser("dump", help="Print every record")
+    dump_parser.add_argument("path")
+    state_parser = sub.add_parser("state", help="Print the state at a point in time")
+    state_parser.add_argument("path")
+    state_parser.add_argument("--at", type=float, default=None,
+                              help="Seconds from the start of the journal (default: the end)")
+    replay_parser = sub.add_parser("replay", help="Drive a TaskServer through the recorded inputs")
+    replay_parser.add_argument("path")
+    replay_parser.add_argument("--speed", type=float, default=0.0, help="0 = as fast as possible")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.WARNING)
+    if args.command == "dump":
+        dump(args.path)
+    elif args.command == "state":
+        reader = JournalReader(args.path)
+        try:
+            t_ns = reader.end_t if args.at is None else reader.start_t + int(args.at * 1e9)
+            for key, val in sorted(reader.state_at(t_ns).items()):
+                print(f"{key} = {val!r}")
+        finally:
+            reader.close()
+    else:
+        result = replay_taskserver(args.path, speed=args.speed)
+        print(f"Replayed {result['recorded_s']:.2f} s in {result['replay_s']:.3f} s "
+              f"({result['speedup'] or 0:.0f}x); {result['steps']} TaskServer steps, "
+              f"{result['step_time_s'] * 1e3:.1f} ms in handlers")
+        print(f"Car commands: {result['car_commands']}")
+        if result["divergence"] is None:
+            print("TaskServer behaviour matches the recording")
+        else:
+            print(f"Divergence: {result['divergence']}")
+
+
+if __name__ == "__main__":
+    main()
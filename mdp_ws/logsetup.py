@@ -0,0 +1,152 @@
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from collections import deque
+
+LOG_FORMAT = "%(asctime)s %(levelname)s %(name)s: %(message)s"
+
+
+class LazyQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that enqueues the record untouched.
+
+    The stock handler formats the message in the calling thread so records
+    can be pickled; the listener here lives in the same process, so message
+    formatting is left to the listener thread and the I/O threads only pay
+    for creating the record.
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Per-logger token bucket: each logger name (subsystem) may emit `rate`
+    records per second with bursts of up to `burst`. Suppressed records are
+    counted and reported on the next record that gets through.
+    Records at `exempt_level` or above always pass.
+    """
+
+    def __init__(self, rate=20.0, burst=50, exempt_level=logging.ERROR, overrides=None):
+        super().__init__()
+        self.rate = rate
+        self.burst = burst
+        self.exempt_level = exempt_level
+        self.overrides = overrides or {}  # logger name -> (rate, burst)
+        self._buckets = {}  # logger name -> [tokens, last refill, suppressed]
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= self.exempt_level:
+            return True
+        rate, burst = self.overrides.get(record.name, (self.rate, self.burst))
+        now = time.monotonic()
+        with self._lock:
+            bucket = self._buckets.get(record.name)
+            if bucket is None:
+                bucket = self._buckets[record.name] = [burst, now, 0]
+            bucket[0] = min(burst, bucket[0] + (now - bucket[1]) * rate)
+            bucket[1] = now
+            if bucket[0] < 1.0:
+                bucket[2] += 1
+                return False
+            bucket[0] -= 1.0
+            suppressed = bucket[2]
+            bucket[2] = 0
+        if suppressed:
+            record.msg = f"[{suppressed} earlier records suppressed] {record.msg}"
+        return True
+
+
+class RingBufferHandler(logging.Handler):
+    """
+    Keeps the last `capacity` formatted lines in memory for inspection at runtime.
+    """
+
+    def __init__(self, capacity=1000):
+        super().__init__()
+        self.lines = deque(maxlen=capacity)
+
+    def emit(self, record):
+        try:
+            self.lines.append(self.format(record))
+        except Exception:
+            self.handleError(record)
+
+    def recent(self, n=None):
+        lines = list(self.lines)
+        return lines if n is None else lines[-n:]
+
+
+class LoggingPipeline:
+    """
+    Non-blocking logging: every logger feeds a queue through LazyQueueHandler
+    (rate-limited per subsystem) and a QueueListener thread formats and writes
+    records to the console and the in-memory ring buffer.
+    """
+
+    def __init__(self, level=logging.INFO, ring_size=1000, rate=20.0, burst=50, rate_overrides=None,
+                 handlers=None):
+        self.queue = queue.SimpleQueue()
+        self.ring = RingBufferHandler(ring_size)
+        formatter = logging.Formatter(LOG_FORMAT)
+        outputs = list(handlers) if handlers is not None else [logging.StreamHandler()]
+        for handler in outputs + [self.ring]:
+            handler.setFormatter(formatter)
+        self.queue_handler = LazyQueueHandler(self.queue)
+        self.rate_limiter = RateLimitFilter(rate, burst, overrides=rate_overrides)
+        self.queue_handler.addFilter(self.rate_limiter)
+        self.listener = logging.handlers.QueueListener(self.queue, *outputs, self.ring,
+                                                       respect_handler_level=True)
+        self.level = level
+
+    def start(self):
+        root = logging.getLogger()
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+        root.addHandler(self.queue_handler)
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        """
+        Flush queued records and stop the listener thread.
+        """
+        self.listener.stop()
+        logging.getLogger().removeHandler(self.queue_handler)
+
+    def recent(self, n=None):
+        return self.ring.recent(n)
+
+
+_pipeline = None
+
+
+def setup_logging(level=logging.INFO, **kwargs):
+    """
+    Install the process-wide LoggingPipeline (replacing logging.basicConfig) and return it.
+    Keyword arguments are passed to LoggingPipeline.
+    """
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+    _pipeline = LoggingPipeline(level=level, **kwargs)
+    _pipeline.start()
+    return _pipeline
+
+
+def shutdown_logging():
+    global _pipeline
+    if _pipeline is not None:
+        _pipeline.stop()
+        _pipeline = None
+
+
+def recent_log_lines(n=None):
+    """
+    Most recent formatted log lines from the ring buffer, oldest first.
+    """
+    return _pipeline.recent(n) if _pipeline is not None else []
@@ -0,0 +1,165 @@
+import json
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+
+class Histogram:
+    """
+    Fixed-memory histogram of durations in seconds.
+
+    Bins are log-spaced between `lo` and `hi` (`bins_per_decade` per factor
+    of ten), plus one underflow and one overflow bin, so recording is O(1)
+    and memory does not grow with the number of samples. Percentiles are
+    resolved to the upper edge of their bin (about 12% with the default 20
+    bins per decade) and never exceed the exact maximum.
+
+    Args:
+        lo: Smallest resolved duration in seconds
+        hi: Largest resolved duration in seconds
+        bins_per_decade: Resolution
+    """
+
+    def __init__(self, lo=1e-6, hi=10.0, bins_per_decade=20):
+        self.lo = lo
+        self.hi = hi
+        self.bins_per_decade = bins_per_decade
+        self._log_lo = math.log10(lo)
+        self.bins = int(math.ceil(math.log10(hi / lo) * bins_per_decade))
+        # Upper edge of every bin; index 0 is the underflow bin, index bins + 1 the overflow bin.
+        self.edges = np.concatenate(([lo], lo * 10.0 ** (np.arange(1, self.bins + 1) / bins_per_decade),
+                                     [math.inf]))
+        self.counts = np.zeros(self.bins + 2, dtype=np.int64)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        if seconds < self.lo:
+            i = 0
+        else:
+            i = min(int((math.log10(seconds) - self._log_lo) * self.bins_per_decade) + 1, self.bins + 1)
+        self.counts[i] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, pct):
+        """
+        Upper bound of the `pct` percentile in seconds (0.0 if empty).
+        """
+        if self.count == 0:
+            return 0.0
+        rank = max(1, int(math.ceil(pct / 100.0 * self.count)))
+        i = int(np.searchsorted(np.cumsum(self.counts), rank))
+        return min(float(self.edges[i]), self.max)
+
+    def summary(self):
+        """
+        {"count", "mean_ms", "p50_ms", "p90_ms", "p99_ms", "max_ms"}
+        """
+        mean = self.total / self.count if self.count else 0.0
+        return {"count": self.count,
+                "mean_ms": mean * 1e3,
+                "p50_ms": self.percentile(50) * 1e3,
+                "p90_ms": self.percentile(90) * 1e3,
+                "p99_ms": self.percentile(99) * 1e3,
+                "max_ms": self.max * 1e3}
+
+    def to_dict(self):
+        """
+        Raw bins for offline analysis: non-empty bins as [upper edge s, count].
+        """
+        nonzero = np.flatnonzero(self.counts)
+        return {"lo": self.lo, "hi": self.hi, "bins_per_decade": self.bins_per_decade,
+                "count": self.count, "total": self.total, "max": self.max,
+                "bins": [[float(self.edges[i]), int(self.counts[i])] for i in nonzero]}
+
+
+class LoopTiming:
+    """
+    Timing of the TaskServer dispatch loop, kept in fixed-memory histograms.
+
+    - jitter: per event key, how late the handler started after the event
+      happened (for timers: after their due time)
+    - handler: per mode, execution time of loop_<mode>()
+    - setup: per mode, execution time of setup_<mode>() on mode changes
+    - overruns: per mode, handler runs that took longer than `deadline`;
+      the most recent `overrun_log` of them are kept with their event key
+
+    Records come from the dispatch thread only; `summary()` may be called
+    from any thread and reads the histograms without locking, so a
+    concurrent query can be off by the sample being recorded.
+
+    Args:
+        deadline: Handler time in seconds above which a run counts as an overrun
+        overrun_log: Number of recent overruns kept
+        histogram: Keyword arguments for every Histogram
+    """
+
+    def __init__(self, deadline=0.02, overrun_log=64, **histogram):
+        self.deadline = deadline
+        self.jitter = {}
+        self.handler = {}
+        self.setup = {}
+        self.overruns = {}
+        self.recent_overruns = deque(maxlen=overrun_log)  # (t_ns, mode, event key, seconds)
+        self.started_ns = time.monotonic_ns()
+        self._histogram = histogram
+        self._lock = threading.Lock()
+
+    def _get(self, table, name):
+        hist = table.get(name)
+        if hist is None:
+            with self._lock:
+                hist = table[name] = Histogram(**self._histogram)
+        return hist
+
+    def record_jitter(self, key, seconds):
+        self._get(self.jitter, key).record(seconds)
+
+    def record_setup(self, mode, seconds):
+        self._get(self.setup, mode).record(seconds)
+
+    def record_handler(self, mode, seconds, event_key=None):
+        self._get(self.handler, mode).record(seconds)
+        if seconds > self.deadline:
+            self.overruns[mode] = self.overruns.get(mode, 0) + 1
+            self.recent_overruns.append((time.monotonic_ns(), mode, event_key, seconds))
+
+    def busy_fraction(self):
+        """
+        Share of wall time since creation spent in handlers and setups.
+        """
+        busy = sum(hist.total for table in (self.handler, self.setup) for hist in list(table.values()))
+        elapsed = (time.monotonic_ns() - self.started_ns) / 1e9
+        return busy / elapsed if elapsed > 0 else 0.0
+
+    def summary(self):
+        """
+        Percentile summaries of every histogram, overrun counts and the most recent overruns.
+        """
+        with self._lock:
+            tables = {name: list(table.items()) for name, table in
+                      (("jitter", self.jitter), ("handler", self.handler), ("setup", self.setup))}
+        result = {name: {key: hist.summary() for key, hist in items} for name, items in tables.items()}
+        result["overruns"] = dict(self.overruns)
+        result["recent_overruns"] = [{"t_ns": t_ns, "mode": mode, "event": key, "ms": seconds * 1e3}
+                                     for t_ns, mode, key, seconds in list(self.recent_overruns)]
+        result["deadline_ms"] = self.deadline * 1e3
+        result["busy_fraction"] = self.busy_fraction()
+        return result
+
+    def dump(self, path):
+        """
+        Write the summary and the raw histogram bins to `path` as JSON.
+        """
+        with self._lock:
+            raw = {name: {key: hist.to_dict() for key, hist in table.items()} for name, table in
+                   (("jitter", self.jitter), ("handler", self.handler), ("setup", self.setup))}
+        with open(path, "w") as f:
+            json.dump({"summary": self.summary(), "histograms": raw}, f, indent=1)
@@ -1,15 +1,24 @@
+import argparse
+import asyncio
 import logging
+import os
+import sys
 import time
 import threading
 from car import Car
 from androidapp import AndroidApp
 from taskserver import TaskServer
 from sharedResources import sharedResources
+from state import install_state
+from shmstate import SharedMemoryState
+from journal import StateJournal
+from plancache import PlanCache
+from tour import planner_pool, close_planner_pool
+from capture import WireRecorder
+from communication import IO_MODE_EVENT, IO_MODE_ASYNC
+from logsetup import setup_logging, shutdown_logging
 import definitions
 
-# Set logging level to INFO
-logging.basicConfig(level=logging.INFO)
-
 # Mapping of option numbers to command strings.
 COMMAND_OPTIONS = {
     "1": "/*TASKMODE=MANUAL*/",
@@ -61,7 +70,7 @@ def terminal_interface(android_app: AndroidApp, stop_event: threading.Event):
                 break
             command = COMMAND_OPTIONS.get(choice)
             if command:
-                logging.info(f"Simulating reception of command: {command}")
+                logging.info("Simulating reception of command: %s", command)
                 # Simulate the Android interface receiving the command.
                 android_app.interface.rx_callback(command)
             else:
@@ -70,34 +79,118 @@ def terminal_interface(android_app: AndroidApp, stop_event: threading.Event):
             logging.error("Error in terminal input: %s", e)
             stop_event.set()
 
+async def run_asyncio(car: Car, android_app: AndroidApp, task_server: TaskServer):
+    """
+    Asyncio runtime: both serial links, the TaskServer and the terminal menu run
+    on one event loop in the main thread. Returns once "exit" is entered.
+    """
+    loop = asyncio.get_running_loop()
+    stop = asyncio.Event()
+    car.interface.attach_loop(loop)
+    android_app.interface.attach_loop(loop)
+    car.connect()
+    android_app.connect()
+    server = loop.create_task(task_server.run_async())
+
+    def on_terminal_input():
+        choice = sys.stdin.readline()
+        if not choice or choice.strip().lower() == "exit":
+            stop.set()
+            return
+        command = COMMAND_OPTIONS.get(choice.strip())
+        if command:
+            logging.info("Simulating reception of command: %s", command)
+            android_app.interface.rx_callback(command)
+        else:
+            print("Invalid option. Please try again.")
+        display_menu()
+
+    logging.info("Terminal interface started. Use the menu options to send commands.")
+    display_menu()
+    loop.add_reader(sys.stdin.fileno(), on_terminal_input)
+    try:
+        await stop.wait()
+    finally:
+        loop.remove_reader(sys.stdin.fileno())
+        task_server.stop()
+        await server
+        # The links are registered with this loop, so release them before it closes.
+        car.disconnect()
+        android_app.disconnect()
+
 def main():
+    parser = argparse.ArgumentParser(description="MDP RPi control stack")
+    parser.add_argument("--capture", help="Record all car and Android serial traffic to this file")
+    parser.add_argument("--shm", metavar="NAME",
+                        help="Share telemetry, CV detections and request queues with other processes "
+                             "(e.g. the vision pipeline) in this shared memory block")
+    parser.add_argument("--journal", help="Journal every shared resource change to this file "
+                                          "(inspect/replay with journal.py)")
+    parser.add_argument("--timing", help="Dump TaskServer loop timing histograms to this JSON file at shutdown")
+    parser.add_argument("--plan-cache", metavar="DIR", default=os.path.expanduser("~/.cache/mdp34/plans"),
+                        help="Keep TASK1 plans in this directory across runs (\"\" for memory only)")
+    parser.add_argument("--runtime", choices=("threads", "asyncio"), default="threads",
+                        help="threads: I/O threads per link and a TaskServer thread; "
+                             "asyncio: everything on one event loop")
+    args = parser.parse_args()
+
+    # Set logging level to INFO; records are written by a background listener thread.
+    setup_logging(logging.INFO)
+
+    # Typed state: schema keys are validated and unknown CAR./TASK./APP./MAP./CV. keys raise KeyError.
+    install_state(sharedResources)
+    shm_state = None
+    if args.shm:
+        shm_state = SharedMemoryState(args.shm, create=True)
+        sharedResources.set_backend(shm_state)
+
+    # Start the TASK1 planner workers up front; they are reused for every plan.
+    if (os.cpu_count() or 1) > 1:
+        planner_pool().warm()
+
     # Instantiate devices using the standardized APIs.
-    car = Car(port='/dev/ttyUSB0')
-    android_app = AndroidApp(port='/dev/rfcomm0')
+    # Both links reconnect in the background after a USB glitch or an Android reconnect.
+    io_mode = IO_MODE_ASYNC if args.runtime == "asyncio" else IO_MODE_EVENT
+    car = Car(port='/dev/ttyUSB0', auto_reconnect=True, io_mode=io_mode)
+    android_app = AndroidApp(port='/dev/rfcomm0', auto_reconnect=True, io_mode=io_mode)
     
+    journal = None
+    if args.journal:
+        # Started before the TaskServer so that a replay sees its setup.
+        journal = StateJournal(args.journal, sharedResources).start()
+
     # Create and set up the TaskServer.
-    task_server = TaskServer(car, android_app, sharedResources)
+    task_server = TaskServer(car, android_app, sharedResources, plan_cache=PlanCache(args.plan_cache or None))
     task_server.setup()
 
+    recorder = None
+    if args.capture:
+        recorder = WireRecorder(args.capture)
+        car.interface.set_recorder(recorder)
+        android_app.interface.set_recorder(recorder)
+
     stop_event = threading.Event()
     terminal_thread = threading.Thread(target=terminal_interface, args=(android_app, stop_event), daemon=True)
 
     try:
-        # Connect devices using their public methods.
-        if not car.interface.is_connected:
-            car.connect()
-        if not android_app.interface.is_connected:
-            android_app.connect()
+        if args.runtime == "asyncio":
+            asyncio.run(run_asyncio(car, android_app, task_server))
+        else:
+            # Connect devices using their public methods.
+            if not car.interface.is_connected:
+                car.connect()
+            if not android_app.interface.is_connected:
+                android_app.connect()
 
-        # Start the TaskServer loop in its own thread.
-        task_server.start()
+            # Start the TaskServer loop in its own thread.
+            task_server.start()
 
-        # Start the terminal interface thread.
-        terminal_thread.start()
+            # Start the terminal interface thread.
+            terminal_thread.start()
 
-        # Keep the main thread active until "exit" is entered.
-        while not stop_event.is_set():
-            time.sleep(1)
+            # Keep the main thread active until "exit" is entered.
+            while not stop_event.is_set():
+                time.sleep(1)
 
     except KeyboardInterrupt:
         logging.info("KeyboardInterrupt received. Shutting down...")
@@ -106,9 +199,21 @@ def main():
     finally:
         # Cleanly stop the TaskServer and disconnect devices.
         task_server.stop()
+        close_planner_pool()
         car.disconnect()
         android_app.disconnect()
+        logging.info("Car link stats: %s", car.interface.get_link_stats())
+        logging.info("Android link stats: %s", android_app.interface.get_link_stats())
+        if recorder is not None:
+            recorder.close()
+        if args.timing:
+            task_server.timing.dump(args.timing)
+        if journal is not None:
+            journal.close()
+        if shm_state is not None:
+            shm_state.close()
         logging.info("Shutdown complete.")
+        shutdown_logging()
 
 if __name__ == "__main__":
     main()
@@ -0,0 +1,175 @@
+import hashlib
+import inspect
+import json
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+import planner
+import tour
+
+logger = logging.getLogger("PlanCache")
+
+# Bump when planner or ordering code changes its results without changing a parameter.
+PLAN_CACHE_VERSION = 1
+
+
+def map_fingerprint(obstacles):
+    """
+    Canonical hash of an obstacle table: independent of the order obstacles were sent in.
+    """
+    table = np.asarray(obstacles, dtype=np.int32).reshape(-1, 4)
+    table = table[np.lexsort(table.T[::-1])]
+    return hashlib.blake2b(np.ascontiguousarray(table).tobytes(), digest_size=16).hexdigest()
+
+
+def _defaults(fn, skip):
+    return {name: p.default for name, p in inspect.signature(fn).parameters.items()
+            if name not in skip and p.default is not inspect.Parameter.empty}
+
+
+def plan_params(arena, params):
+    """
+    Every parameter that shapes a TASK1 plan, with defaults filled in, so a
+    change of either a passed value or a code default changes the cache key.
+    """
+    effective = {}
+    effective.update(_defaults(planner.Planner.__init__, ("self", "arena")))
+    effective.update(_defaults(planner.capture_pose, ("planner", "obstacle")))
+    effective.update(_defaults(tour.plan_task1, ("arena", "workers", "progress")))
+    effective["detour_limit"] = tour.DETOUR_LIMIT
+    effective.update(params)
+    effective.update(resolution=arena.resolution, length=arena.length, width=arena.width,
+                     clearance=arena.clearance, headings=arena.headings, version=PLAN_CACHE_VERSION)
+    return effective
+
+
+class PlanCache:
+    """
+    TASK1 plans (visiting order plus command sequences) keyed by map fingerprint
+    and planner parameters.
+
+    Plans are kept in an in-memory LRU of `capacity` entries and, with a
+    `directory`, as one pickle per key on disk (LRU by modification time,
+    at most `disk_capacity` files). Entries written under another
+    PLAN_CACHE_VERSION are ignored and removed.
+
+    Args:
+        directory: Where to persist plans; None keeps them in memory only
+        capacity: In-memory entries
+        disk_capacity: Files kept in `directory`
+    """
+
+    def __init__(self, directory=None, capacity=32, disk_capacity=256):
+        self.directory = directory
+        self.capacity = capacity
+        self.disk_capacity = disk_capacity
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0}
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    def key(self, arena, params=None):
+        params = plan_params(arena, params or {})
+        text = json.dumps(params, sort_keys=True, default=repr)
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(map_fingerprint(arena.obstacles).encode())
+        digest.update(text.encode())
+        return digest.hexdigest()
+
+    def _file(self, key):
+        return os.path.join(self.directory, key + ".plan")
+
+    def get(self, key):
+        """
+        Cached legs for `key`, or None.
+        """
+        with self._lock:
+            legs = self._memory.get(key)
+            if legs is not None:
+                self._memory.move_to_end(key)
+                self.stats["hits"] += 1
+                return legs
+        legs = self._load(key)
+        with self._lock:
+            if legs is None:
+                self.stats["misses"] += 1
+                return None
+            self.stats["disk_hits"] += 1
+            self._remember(key, legs)
+        return legs
+
+    def put(self, key, legs):
+        with self._lock:
+            self._remember(key, legs)
+        if self.directory:
+            self._store(key, legs)
+
+    def _remember(self, key, legs):
+        self._memory[key] = legs
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.capacity:
+            self._memory.popitem(last=False)
+
+    def _load(self, key):
+        if not self.directory:
+            return None
+        path = self._file(key)
+        try:
+            with open(path, "rb") as f:
+                entry = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            logger.warning("Dropping unreadable plan %s: %s", path, e)
+            self._remove(path)
+            return None
+        if entry.get("version") != PLAN_CACHE_VERSION or entry.get("key") != key:
+            self._remove(path)
+            return None
+        os.utime(path)  # Most recently used
+        return entry["legs"]
+
+    def _store(self, key, legs):
+        path = self._file(key)
+        entry = {"version": PLAN_CACHE_VERSION, "key": key, "created": time.time(), "legs": legs}
+        tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        with open(tmp, "wb") as f:
+            pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, path)
+        self._evict_disk()
+
+    def _evict_disk(self):
+        files = [os.path.join(self.directory, name) for name in os.listdir(self.directory)
+                 if name.endswith(".plan")]
+        if len(files) <= self.disk_capacity:
+            return
+        files.sort(key=lambda path: os.stat(path).st_mtime)
+        for path in files[:len(files) - self.disk_capacity]:
+            self._remove(path)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+    def plan_task1(self, arena, progress=None, workers=None, **params):
+        """
+        tour.plan_task1() through the cache.
+        """
+        key = self.key(arena, params)
+        legs = self.get(key)
+        if legs is not None:
+            logger.info("Plan cache hit for %s", arena)
+            return legs
+        legs = tour.plan_task1(arena, workers=workers, progress=progress, **params)
+        self.put(key, legs)
+        return legs
@@ -0,0 +1,396 @@
+import functools
+import heapq
+import logging
+import math
+
+import numpy as np
+
+from arenamap import FACING_NONE, FACING_THETA, MAP_CELL, OBSTACLE_SIZE
+
+logger = logging.getLogger("Planner")
+
+TWO_PI = 2 * math.pi
+SQRT2 = math.sqrt(2.0)
+# Centre of the 40x40 cm start zone in the bottom-left corner, facing +y.
+START_POSE = (20.0, 20.0, math.pi / 2)
+
+
+class MotionPrimitive:
+    """
+    One car move from a lattice state, relative to its start cell.
+
+    Args:
+        command: Car move direction ('F', 'B', 'L', 'R')
+        value: Distance in cm for straights, angle in degrees for turns
+        dx, dy: Displacement in grid cells
+        dh: Heading change in lattice heading steps
+        cost: Search cost (arc length in cm, weighted for turns and reversing)
+        swept: int array (k, 3) of (cspace heading, dy, dx) sampled along the move
+    """
+    __slots__ = ("command", "value", "dx", "dy", "dh", "cost", "swept")
+
+    def __init__(self, command, value, dx, dy, dh, cost, swept):
+        self.command = command
+        self.value = value
+        self.dx = dx
+        self.dy = dy
+        self.dh = dh
+        self.cost = cost
+        self.swept = swept
+
+    def __repr__(self):
+        return f"MotionPrimitive({self.command}{self.value}, d=({self.dx}, {self.dy}), dh={self.dh})"
+
+
+@functools.lru_cache(maxsize=None)
+def motion_lattice(resolution, headings, cspace_headings, turn_radius, step, turn_angles,
+                   turn_cost, reverse_cost):
+    """
+    Motion primitives for every lattice heading, computed once per parameter set.
+
+    Straights move `step` cm forward (F) or back (B); turns (L/R) drive
+    forward along an arc of `turn_radius` through each of `turn_angles`
+    degrees. End points are rounded to whole grid cells, so they are exact
+    when the radius and step are multiples of the resolution. Swept samples
+    are taken every half cell along the path, with the heading rounded to the
+    configuration space's `cspace_headings`.
+
+    Returns:
+        Tuple indexed by lattice heading of tuples of MotionPrimitive
+    """
+    lattice = []
+    for h in range(headings):
+        theta = TWO_PI * h / headings
+        moves = []
+        for command, sign in (("F", 1.0), ("B", -1.0)):
+            weight = 1.0 if sign > 0 else reverse_cost
+            samples = max(2, int(math.ceil(step / (resolution / 2.0))) + 1)
+            path = [(sign * s * math.cos(theta), sign * s * math.sin(theta), theta)
+                    for s in np.linspace(0.0, step, samples)]
+            moves.append((command, int(step), path, 0, step * weight))
+        for angle in turn_angles:
+            phi = math.radians(angle)
+            arc = turn_radius * phi
+            dh = int(round(phi / TWO_PI * headings))
+            if dh == 0:
+                raise ValueError(f"Turn of {angle} degrees is below the lattice heading step")
+            samples = max(2, int(math.ceil(arc / (resolution / 2.0))) + 1)
+            for command, side in (("L", 1.0), ("R", -1.0)):
+                path = []
+                for a in np.linspace(0.0, phi, samples):
+                    t = theta + side * a
+                    path.append((side * turn_radius * (math.sin(t) - math.sin(theta)),
+                                 side * turn_radius * (math.cos(theta) - math.cos(t)), t))
+                moves.append((command, int(angle), path, int(side) * dh, arc * turn_cost))
+        primitives = []
+        for command, value, path, dh, cost in moves:
+            swept = np.unique(np.array(
+                [(int(round(t / TWO_PI * cspace_headings)) % cspace_headings,
+                  int(math.floor(y / resolution + 0.5)), int(math.floor(x / resolution + 0.5)))
+                 for x, y, t in path], dtype=np.int64), axis=0)
+            end_x, end_y, _ = path[-1]
+            primitives.append(MotionPrimitive(command, value, int(round(end_x / resolution)),
+                                              int(round(end_y / resolution)), dh, cost, swept))
+        lattice.append(tuple(primitives))
+    return tuple(lattice)
+
+
+class Path:
+    """
+    Result of Planner.plan().
+
+    Attributes:
+        commands: Car moves as (direction, value), consecutive straights merged
+        poses: (x, y, theta) after every primitive, starting with the start pose
+        cost: Search cost of the path
+        expansions: Number of states expanded by the search
+    """
+    __slots__ = ("commands", "poses", "cost", "expansions")
+
+    def __init__(self, commands, poses, cost, expansions):
+        self.commands = commands
+        self.poses = poses
+        self.cost = cost
+        self.expansions = expansions
+
+    def __repr__(self):
+        moves = " ".join(f"{d}{v}" for d, v in self.commands)
+        return f"Path({moves}, cost={self.cost:.1f})"
+
+
+class Planner:
+    """
+    Hybrid A* over (x, y, heading) for the car's move set on an ArenaMap.
+
+    States are grid cells of the map with `headings` discrete headings
+    (4 for 90 degree turns). For every heading and primitive, the set of
+    cells from which that primitive stays collision-free is precomputed
+    from the map's configuration space, so each expansion is a few list
+    lookups. The heuristic is the obstacle-aware shortest 8-connected grid
+    distance to the goal (cached per goal cell), which never overestimates
+    the length of a lattice path.
+
+    Args:
+        arena: ArenaMap to plan in
+        turn_radius: Radius of L/R turns in cm
+        step: Length of one F/B straight in cm
+        turn_angles: Turn angles (degrees) the car executes
+        turn_cost: Cost per cm of turning relative to driving straight
+        reverse_cost: Cost per cm of reversing relative to driving forward
+        goal_tolerance: Goal cells within this many cells (per axis) are accepted
+    """
+
+    def __init__(self, arena, turn_radius=25.0, step=5.0, turn_angles=(90,), turn_cost=1.3,
+                 reverse_cost=1.2, goal_tolerance=0):
+        self.arena = arena
+        self.resolution = arena.resolution
+        self.n = arena.size
+        self.headings = int(round(360 / math.gcd(360, *[int(a) for a in turn_angles])))
+        if arena.headings % self.headings:
+            raise ValueError(f"Map has {arena.headings} headings; need a multiple of {self.headings}")
+        self.goal_tolerance = goal_tolerance
+        # Extra cost any reasonable path may need beyond the grid distance: two full turning circles.
+        self.detour_slack = 4 * math.pi * turn_radius * turn_cost
+        self.lattice = motion_lattice(self.resolution, self.headings, arena.headings, float(turn_radius),
+                                      float(step), tuple(turn_angles), float(turn_cost), float(reverse_cost))
+        self._valid = self._precompute_valid()
+        self._heuristics = {}  # goal cell -> flat list of distances in cm
+
+    def _precompute_valid(self):
+        n = self.n
+        reach = max(int(np.abs(p.swept[:, 1:]).max()) for moves in self.lattice for p in moves)
+        padded = np.ones((self.arena.headings, n + 2 * reach, n + 2 * reach), dtype=bool)
+        padded[:, reach:reach + n, reach:reach + n] = self.arena.cspace
+        valid = []
+        for moves in self.lattice:
+            per_heading = []
+            for primitive in moves:
+                ok = np.ones((n, n), dtype=bool)
+                for hc, dy, dx in primitive.swept:
+                    ok &= ~padded[hc, reach + dy:reach + dy + n, reach + dx:reach + dx + n]
+                per_heading.append(ok.ravel().tolist())
+            valid.append(per_heading)
+        return valid
+
+    # Conversions
+
+    def state_of(self, pose):
+        """
+        Lattice state (ix, iy, h) nearest to pose (x, y, theta).
+        """
+        x, y, theta = pose
+        ix, iy = self.arena.cell(x, y)
+        return ix, iy, int(round(theta / TWO_PI * self.headings)) % self.headings
+
+    def pose_of(self, state):
+        ix, iy, h = state
+        x, y = self.arena.cell_center(ix, iy)
+        return x, y, TWO_PI * h / self.headings
+
+    def is_free(self, state):
+        ix, iy, h = state
+        if not (0 <= ix < self.n and 0 <= iy < self.n):
+            return False
+        return not self.arena.cspace[h * (self.arena.headings // self.headings), iy, ix]
+
+    def heuristic(self, gx, gy):
+        """
+        Shortest 8-connected distance in cm from every cell to (gx, gy),
+        through cells where the car fits at some heading (inf elsewhere).
+        """
+        dist = self._heuristics.get((gx, gy))
+        if dist is not None:
+            return dist
+        n = self.n
+        passable = (~self.arena.cspace.all(axis=0)).ravel().tolist()
+        dist = [math.inf] * (n * n)
+        start = gy * n + gx
+        dist[start] = 0.0
+        heap = [(0.0, start)]
+        res = self.resolution
+        neighbours = [(dx, dy, res * (SQRT2 if dx and dy else 1.0))
+                      for dx in (-1, 0, 1) for dy in (-1, 0, 1) if dx or dy]
+        while heap:
+            d, cell = heapq.heappop(heap)
+            if d > dist[cell]:
+                continue
+            cy, cx = divmod(cell, n)
+            for dx, dy, cost in neighbours:
+                x, y = cx + dx, cy + dy
+                if 0 <= x < n and 0 <= y < n:
+                    nxt = y * n + x
+                    nd = d + cost
+                    if nd < dist[nxt] and passable[nxt]:
+                        dist[nxt] = nd
+                        heapq.heappush(heap, (nd, nxt))
+        self._heuristics[(gx, gy)] = dist
+        return dist
+
+    def lower_bound(self, start, goal):
+        """
+        Cost no path from pose `start` to pose `goal` can beat (inf if cut off).
+        """
+        sx, sy, _ = self.state_of(start)
+        gx, gy, _ = self.state_of(goal)
+        if not (0 <= sx < self.n and 0 <= sy < self.n and 0 <= gx < self.n and 0 <= gy < self.n):
+            return math.inf
+        return self.heuristic(gx, gy)[sy * self.n + sx]
+
+    # Search
+
+    def plan(self, start, goal, max_expansions=100000, bound=math.inf):
+        """
+        Cheapest command sequence from pose `start` to pose `goal`.
+
+        Args:
+            start, goal: (x, y, theta) in cm / radians; snapped to the lattice
+            max_expansions: Give up after expanding this many states
+            bound: Give up once every remaining path would cost more than this
+
+        Returns:
+            Path, or None if the goal is unreachable (or beyond `bound`)
+        """
+        n = self.n
+        cells = n * n
+        sx, sy, sh = self.state_of(start)
+        gx, gy, gh = self.state_of(goal)
+        if not self.is_free((sx, sy, sh)):
+            logger.warning("Start pose %s is in collision", start)
+            return None
+        tol = self.goal_tolerance
+        h2d = self.heuristic(gx, gy)
+        if h2d[sy * n + sx] == math.inf:
+            return None
+        lattice = self.lattice
+        valid = self._valid
+        headings = self.headings
+        size = headings * cells
+        g = [math.inf] * size
+        parent = [None] * size
+        s0 = sh * cells + sy * n + sx
+        g[s0] = 0.0
+        heap = [(h2d[sy * n + sx], 0.0, s0)]
+        expansions = 0
+        while heap:
+            f, cost, s = heapq.heappop(heap)
+            if cost > g[s]:
+                continue
+            if f > bound:
+                return None
+            h, cell = divmod(s, cells)
+            iy, ix = divmod(cell, n)
+            if h == gh and abs(ix - gx) <= tol and abs(iy - gy) <= tol:
+                return self._path(s, parent, cost, expansions)
+            expansions += 1
+            if expansions > max_expansions:
+                logger.warning("Planning gave up after %d expansions", expansions)
+                return None
+            ok = valid[h]
+            for k, primitive in enumerate(lattice[h]):
+                if not ok[k][cell]:
+                    continue
+                x = ix + primitive.dx
+                y = iy + primitive.dy
+                if not (0 <= x < n and 0 <= y < n):
+                    continue
+                nh = (h + primitive.dh) % headings
+                ncell = y * n + x
+                ns = nh * cells + ncell
+                nc = cost + primitive.cost
+                if nc < g[ns]:
+                    g[ns] = nc
+                    parent[ns] = (s, primitive)
+                    heapq.heappush(heap, (nc + h2d[ncell], nc, ns))
+        return None
+
+    def _path(self, s, parent, cost, expansions):
+        cells = self.n * self.n
+        primitives = []
+        states = []
+        while True:
+            h, cell = divmod(s, cells)
+            iy, ix = divmod(cell, self.n)
+            states.append((ix, iy, h))
+            if parent[s] is None:
+                break
+            s, primitive = parent[s]
+            primitives.append(primitive)
+        primitives.reverse()
+        states.reverse()
+        commands = []
+        for primitive in primitives:
+            if commands and primitive.command in "FB" and commands[-1][0] == primitive.command:
+                commands[-1] = (primitive.command, commands[-1][1] + primitive.value)
+            else:
+                commands.append((primitive.command, primitive.value))
+        return Path(commands, [self.pose_of(state) for state in states], cost, expansions)
+
+    def plan_route(self, start, goals):
+        """
+        Plan start -> goals[0] -> goals[1] -> ..., skipping unreachable goals.
+
+        Returns:
+            (list of (goal index, Path), end pose)
+        """
+        legs = []
+        pose = start
+        for i, goal in enumerate(goals):
+            path = self.plan(pose, goal)
+            if path is None:
+                logger.warning("Goal %d %s unreachable from %s; skipped", i, goal, pose)
+                continue
+            legs.append((i, path))
+            pose = path.poses[-1]
+        return legs, pose
+
+
+def capture_pose(planner, obstacle, standoff=30.0, min_standoff=20.0, max_standoff=50.0, max_offset=10.0):
+    """
+    Pose from which the camera sees an obstacle's image face.
+
+    The preferred pose stands on the face's outward normal, `standoff` cm
+    from the face (reference point to face) and facing the obstacle. If that
+    pose is in collision (e.g. next to a wall), the nearest free pose is used
+    with the distance anywhere in [min_standoff, max_standoff] and up to
+    `max_offset` cm of sideways offset, preferring small offsets.
+
+    Args:
+        planner: Planner whose lattice the pose is snapped to
+        obstacle: Row (id, x, y, facing) of the obstacle table
+
+    Returns:
+        (x, y, theta) on the lattice, or None if the face has no image or no pose fits
+    """
+    _, ox, oy, facing = (int(v) for v in obstacle)
+    if facing == FACING_NONE:
+        return None
+    normal = FACING_THETA[facing]
+    nx, ny = math.cos(normal), math.sin(normal)
+    cx = (ox + 0.5) * MAP_CELL
+    cy = (oy + 0.5) * MAP_CELL
+    step = planner.resolution
+    distances = np.arange(min_standoff, max_standoff + step / 2, step)
+    offsets = np.arange(-max_offset, max_offset + step / 2, step)
+    candidates = sorted(((abs(o), abs(d - standoff), d, o) for d in distances for o in offsets))
+    for _, _, distance, offset in candidates:
+        reach = OBSTACLE_SIZE / 2.0 + distance
+        pose = (cx + reach * nx - offset * ny, cy + reach * ny + offset * nx, (normal + math.pi) % TWO_PI)
+        state = planner.state_of(pose)
+        if planner.is_free(state):
+            return planner.pose_of(state)
+    return None
+
+
+def capture_poses(planner, obstacles, **kwargs):
+    """
+    {obstacle id: capture pose} for every obstacle with a reachable image face pose.
+    """
+    poses = {}
+    for row in obstacles:
+        pose = capture_pose(planner, row, **kwargs)
+        if pose is None:
+            logger.warning("No capture pose for obstacle %d", int(row[0]))
+        else:
+            poses[int(row[0])] = pose
+    return poses
+
@@ -0,0 +1,218 @@
+import logging
+import math
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+from telemetry import TelemetryStore
+
+logger = logging.getLogger("Pose")
+
+TWO_PI = 2 * math.pi
+
+
+class PoseEstimator:
+    """
+    Dead-reckoning (x, y, theta) estimate from issued moves and gyro telemetry.
+
+    Heading comes from the GYRO z-bearing (degrees, clockwise positive);
+    theta is in radians, counter-clockwise from +x. Position advances along
+    the heading while a straight move is executing, at the nominal `speed`
+    per gyro sample and snapped to the commanded distance on STATUS DONE.
+    Turns move the car along an arc of `turn_radius` as the measured heading
+    changes, and STATUS DONE completes the arc to the commanded heading; the
+    part of the turn the gyro has not reported yet is then treated as seen.
+    Gyro samples while no move is executing only rebase the bearing; they do
+    not rotate the pose. Each update is a constant-time EKF-style prediction
+    of the 3x3 covariance.
+
+    Feed it with `on_command` / `on_stop` for issued commands and register
+    `on_car_event` as a CarInterface listener. The latest pose is published
+    as CAR.POSE = (x, y, theta in degrees) in shared resources and the pose
+    history is kept for `pose_at(t_ns)` lookups (e.g. to tag camera frames).
+
+    Args:
+        x, y, theta: Initial pose (distance units of the move commands, radians)
+        speed: Nominal straight-line speed, distance units per second
+        turn_radius: Turning radius of TL/TR moves
+        distance_noise: Std-dev of travelled distance per unit travelled
+        heading_noise: Std-dev of heading drift, radians per sqrt(second)
+        history: Number of pose samples retained for pose_at()
+    """
+
+    def __init__(self, x=0.0, y=0.0, theta=math.pi / 2, speed=20.0, turn_radius=25.0,
+                 distance_noise=0.05, heading_noise=0.01, history=4096, shared_resources=None):
+        self.speed = speed
+        self.turn_radius = turn_radius
+        self.distance_noise = distance_noise
+        self.heading_noise = heading_noise
+        self.shared_resources = shared_resources
+
+        self._lock = threading.Lock()
+        self._moves = deque()  # [direction, distance, remaining, started, turned (radians)]
+        self._last_bearing = None
+        self._last_t = None
+
+        self.history = TelemetryStore(history)
+        self._hx = self.history.add_channel("POSE.X")
+        self._hy = self.history.add_channel("POSE.Y")
+        self._htheta = self.history.add_channel("POSE.THETA", period=TWO_PI)
+        self.reset(x, y, theta)
+
+    def reset(self, x=0.0, y=0.0, theta=math.pi / 2):
+        """
+        Set the pose and clear the covariance, e.g. at the start position.
+        """
+        with self._lock:
+            self.x = x
+            self.y = y
+            self.theta = theta % TWO_PI
+            self.P = np.zeros((3, 3))
+            self._moves.clear()
+            self._publish(time.monotonic_ns())
+
+    # Inputs
+
+    def on_command(self, direction, distance):
+        """
+        A move was issued to the car; it starts on the next STATUS MOVING.
+        """
+        with self._lock:
+            self._moves.append([direction, float(distance), float(distance), False, 0.0])
+
+    def on_stop(self):
+        """
+        A STOP was issued: the current move ends where the car is now.
+        """
+        with self._lock:
+            aborted = self._moves[0] if self._moves and self._moves[0][3] else None
+            self._moves.clear()
+            if aborted is not None and aborted[0] in ("F", "B"):
+                # Unknown how far it got: inflate along-track uncertainty by the remaining distance.
+                self._add_along_track_variance(aborted[2] ** 2 / 4)
+
+    def on_car_event(self, key, value, t_ns=None):
+        """
+        CarInterface listener.
+        """
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        if key == "CAR.GYRO.Z":
+            self._on_gyro(value, t_ns)
+        elif key == "CAR.STATUS":
+            self._on_status(value, t_ns)
+
+    def _on_gyro(self, bearing, t_ns):
+        with self._lock:
+            if self._last_bearing is None:
+                self._last_bearing = bearing
+                self._last_t = t_ns
+                return
+            # Shortest signed change; bearing is clockwise, theta counter-clockwise.
+            delta_deg = (bearing - self._last_bearing + 180.0) % 360.0 - 180.0
+            dtheta = -math.radians(delta_deg)
+            dt = max(0.0, (t_ns - self._last_t) / 1e9)
+            self._last_bearing = bearing
+            self._last_t = t_ns
+
+            move = self._moves[0] if self._moves and self._moves[0][3] else None
+            if move is None:
+                return
+            if move[0] in ("F", "B"):
+                ds = min(self.speed * dt, move[2])
+                move[2] -= ds
+                if move[0] == "B":
+                    ds = -ds
+            else:
+                ds = self._chord(dtheta)
+                move[4] += dtheta
+            self._step(ds, dtheta, dt)
+            self._publish(t_ns)
+
+    def _on_status(self, status, t_ns):
+        with self._lock:
+            if status == "MOVING":
+                for move in self._moves:
+                    if not move[3]:
+                        move[3] = True
+                        break
+                return
+            if status != "DONE" or not self._moves:
+                return
+            direction, distance, remaining, _, turned = self._moves.popleft()
+            if direction in ("F", "B"):
+                ds = remaining if direction == "F" else -remaining
+                self._step(ds, 0.0, 0.0)
+            else:
+                # The car turns to the commanded angle; gyro samples may lag
+                # behind DONE, so finish the arc from the heading measured so far.
+                sign = 1 if direction == "L" else -1
+                dtheta = math.radians(distance) * sign - turned
+                ds = self._chord(dtheta) * (1 if dtheta * sign >= 0 else -1)
+                self._step(ds, dtheta, 0.0)
+                if self._last_bearing is not None:
+                    # Samples still on their way report this rotation again; rebase so
+                    # they are not counted once the next move is executing.
+                    self._last_bearing = (self._last_bearing - math.degrees(dtheta)) % 360.0
+            self._publish(t_ns)
+
+    # Model
+
+    def _chord(self, dtheta):
+        """
+        Straight-line length of a turn by `dtheta` on the turning circle; with
+        _step()'s mean heading this is exact for any size of heading change.
+        """
+        return 2 * self.turn_radius * math.sin(abs(dtheta) / 2)
+
+    def _step(self, ds, dtheta, dt):
+        """
+        Advance `ds` along the mean heading while turning by `dtheta`. Caller holds the lock.
+        """
+        heading = self.theta + dtheta / 2
+        c = math.cos(heading)
+        s = math.sin(heading)
+        self.x += ds * c
+        self.y += ds * s
+        self.theta = (self.theta + dtheta) % TWO_PI
+
+        # P = F P F^T + G Q G^T, with F the Jacobian w.r.t. the state and
+        # G mapping (distance, heading) noise into the state.
+        F = np.array([[1.0, 0.0, -ds * s], [0.0, 1.0, ds * c], [0.0, 0.0, 1.0]])
+        G = np.array([[c, -ds * s / 2], [s, ds * c / 2], [0.0, 1.0]])
+        Q = np.diag([(self.distance_noise * ds) ** 2, self.heading_noise ** 2 * dt])
+        self.P = F @ self.P @ F.T + G @ Q @ G.T
+
+    def _add_along_track_variance(self, variance):
+        c = math.cos(self.theta)
+        s = math.sin(self.theta)
+        g = np.array([c, s, 0.0])
+        self.P = self.P + variance * np.outer(g, g)
+
+    def _publish(self, t_ns):
+        self._hx.append(self.x, t_ns)
+        self._hy.append(self.y, t_ns)
+        self._htheta.append(self.theta, t_ns)
+        if self.shared_resources is not None:
+            self.shared_resources.set("CAR.POSE", (self.x, self.y, math.degrees(self.theta)))
+
+    # Queries
+
+    def pose(self):
+        """
+        Current (x, y, theta) with theta in radians.
+        """
+        with self._lock:
+            return self.x, self.y, self.theta
+
+    def covariance(self):
+        with self._lock:
+            return self.P.copy()
+
+    def pose_at(self, t_ns):
+        """
+        (x, y, theta) at monotonic time t_ns, interpolated from the pose history.
+        """
+        return self._hx.value_at(t_ns), self._hy.value_at(t_ns), self._htheta.value_at(t_ns)
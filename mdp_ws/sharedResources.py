@@ -1,18 +1,320 @@
+import logging
+import threading
+from contextlib import contextmanager
 from queue import Queue
 
+from state import StateHandle, KeyHandle
+
+logger = logging.getLogger("SharedRsc")
+
 
 class SharedRsc:
+    """
+    Process-wide key/value store shared by the interfaces and the TaskServer.
+
+    Every write takes the next value of a global sequence counter as the
+    key's version, so consumers can tell what changed since they last looked
+    (`changed_since`) or block until it does (`wait_for_change`) instead of
+    polling. `transaction()` / `update()` apply several keys atomically:
+    readers of `snapshot()` never see half of a compound update, and waiters
+    and subscribers are notified once, after the whole update.
+
+    Queue-valued keys (e.g. TASK.MODE.REQ) keep their Queue; producers use
+    `put()` so that consumers waiting on the key are woken.
+
+    Optionally, typed records from state.py can be installed (`install()`);
+    their keys are then validated and stored in slots, and `handle(key)`
+    gives hot paths a precomputed accessor.
+    """
     data = {}
+    versions = {}  # key -> sequence number of its last write
+    version = 0  # sequence number of the last write to any key
+    _lock = threading.RLock()
+    _changed = threading.Condition(_lock)
+    _subscribers = {}  # key -> [callback(key, value, version)]
+    _pending = None  # keys written by the open transaction
+    _handles = {}  # key -> StateHandle for keys stored in installed state records
+    _strict_prefixes = ()  # key prefixes that must be in the schema
+    _backend = None  # shmstate.SharedMemoryState holding cross-process keys
+    _journal = None  # journal.StateJournal recording changes
 
     def __init__(self):
         pass
 
     @classmethod
     def set(cls, key: str, val):
-        cls.data[key] = val    
-    
+        cls._set(key, cls._handles.get(key), val)
+
+    @classmethod
+    def _set_handle(cls, handle, val):
+        cls._set(handle.key, handle, val)
+
+    @classmethod
+    def _set(cls, key, handle, val):
+        with cls._lock:
+            cls._write(key, handle, val)
+            if cls._pending is not None:
+                # Part of an open transaction; it notifies on exit.
+                cls._touch(key)
+                return
+            # Single-key fast path of transaction(): telemetry is written at sensor rate.
+            cls.version += 1
+            version = cls.versions[key] = cls.version
+            cls._changed.notify_all()
+            callbacks = cls._subscribers.get(key)
+            if callbacks:
+                callbacks = list(callbacks)
+        if callbacks:
+            cls._run_callbacks([(callback, key, val, version) for callback in callbacks])
+
+    @classmethod
+    def _write(cls, key, handle, val):
+        if cls._backend is not None and key in cls._backend.keys:
+            val = cls._backend.write(key, val)
+        if handle is not None:
+            handle.write(val)
+        elif cls._strict_prefixes and key.startswith(cls._strict_prefixes):
+            raise KeyError(f"{key} is not in the state schema")
+        else:
+            cls.data[key] = val
+        if cls._journal is not None:
+            cls._journal.record_set(key, val)
+
     @classmethod
     def get(cls, key):
+        if cls._backend is not None and key in cls._backend.keys:
+            return cls._backend.read(key)
+        handle = cls._handles.get(key)
+        if handle is not None:
+            return handle.get()
+        if cls._strict_prefixes and key.startswith(cls._strict_prefixes):
+            raise KeyError(f"{key} is not in the state schema")
         return cls.data.get(key, None)
 
+    @classmethod
+    def install(cls, record, strict=True):
+        """
+        Store the keys of a state.StateRecord in its slots from now on.
+        Values already set for those keys are moved into the record.
+
+        Args:
+            record: StateRecord instance
+            strict: Also reject unknown keys under the record's key prefixes
+        """
+        with cls._lock:
+            for attr, key, types, choices in record.FIELDS:
+                handle = StateHandle(key, record, attr, types, choices, cls._set_handle)
+                if key in cls.data:
+                    handle.write(cls.data.pop(key))
+                cls._handles[key] = handle
+                prefix = key.split(".", 1)[0] + "."
+                if strict and prefix not in cls._strict_prefixes:
+                    cls._strict_prefixes += (prefix,)
+        return record
+
+    @classmethod
+    def handle(cls, key: str):
+        """
+        Precomputed accessor with get()/set() for `key`: a StateHandle for
+        schema keys, otherwise a KeyHandle that goes through get/set.
+        """
+        handle = cls._handles.get(key)
+        if handle is None or (cls._backend is not None and key in cls._backend.keys):
+            # Backend keys may be written by another process: always read through get().
+            return KeyHandle(key, cls)
+        return handle
+
+    @classmethod
+    def get_backend(cls):
+        return cls._backend
+
+    @classmethod
+    def set_backend(cls, backend):
+        """
+        Keep the keys of a shmstate.SharedMemoryState in shared memory so that
+        other processes see them. Install it before creating the interfaces and
+        the TaskServer so that their handles read through the backend.
+
+        Values already set locally are copied into the backend; queue-type keys
+        are replaced by the backend's channels. Writes made by other processes
+        do not bump local versions or wake wait_for_change().
+        """
+        with cls._lock:
+            cls._backend = backend
+            for key in backend.keys:
+                handle = cls._handles.get(key)
+                local = handle.get() if handle is not None else cls.data.get(key)
+                if local is not None or key in backend.channels:
+                    cls._write(key, handle, local)
+
+    @classmethod
+    def get_versioned(cls, key):
+        """
+        (value, version) of a key, read atomically; version is 0 if never written.
+        """
+        with cls._lock:
+            return cls.get(key), cls.versions.get(key, 0)
+
+    @classmethod
+    def snapshot(cls, keys):
+        """
+        Consistent {key: value} view of several keys.
+        """
+        with cls._lock:
+            return {key: cls.get(key) for key in keys}
+
+    @classmethod
+    def update(cls, values: dict):
+        """
+        Write several keys atomically.
+        """
+        with cls.transaction():
+            for key, val in values.items():
+                cls._write(key, cls._handles.get(key), val)
+                cls._touch(key)
+
+    @classmethod
+    def notify(cls, key: str):
+        """
+        Bump a key's version without replacing its value, e.g. after mutating a Queue in place.
+        """
+        with cls.transaction():
+            cls._touch(key)
+
+    @classmethod
+    def put(cls, key: str, item):
+        """
+        put_nowait() on the Queue stored at `key` and wake its waiters.
+        Raises queue.Full like put_nowait.
+        """
+        with cls._lock:
+            cls.get(key).put_nowait(item)
+            if cls._journal is not None:
+                cls._journal.record_put(key, item)
+        cls.notify(key)
+
+    @classmethod
+    def take(cls, key: str):
+        """
+        get_nowait() on the Queue stored at `key`. Raises queue.Empty like get_nowait.
+        Consumers use this rather than the Queue directly so that takes are journaled.
+        """
+        with cls._lock:
+            item = cls.get(key).get_nowait()
+            if cls._journal is not None:
+                cls._journal.record_get(key, item)
+        return item
+
+    @classmethod
+    def keys(cls):
+        with cls._lock:
+            backend_keys = cls._backend.keys if cls._backend is not None else ()
+            return sorted(set(cls.data) | set(cls._handles) | set(backend_keys))
+
+    @classmethod
+    def set_journal(cls, journal):
+        """
+        Record every write, queue put and take into a journal.StateJournal (None to stop).
+        """
+        with cls._lock:
+            cls._journal = journal
+
+    @classmethod
+    @contextmanager
+    def transaction(cls):
+        """
+        Hold the store for a compound update. Nested transactions join the
+        outer one; waiters and subscribers are notified when the outermost
+        transaction exits.
+        """
+        with cls._lock:
+            outer = cls._pending is None
+            if outer:
+                cls._pending = {}
+            try:
+                yield cls
+            finally:
+                if outer:
+                    written = cls._pending
+                    cls._pending = None
+                    if written:
+                        cls._changed.notify_all()
+                        calls = [(callback, key, cls.get(key), version)
+                                 for key, version in written.items()
+                                 for callback in cls._subscribers.get(key, ())]
+                    else:
+                        calls = ()
+        if outer:
+            cls._run_callbacks(calls)
+
+    @staticmethod
+    def _run_callbacks(calls):
+        # Callbacks run in the writer's thread, outside the lock.
+        for callback, key, val, version in calls:
+            try:
+                callback(key, val, version)
+            except Exception:
+                logger.exception("Subscriber for %s failed", key)
+
+    @classmethod
+    def _touch(cls, key):
+        cls.version += 1
+        cls.versions[key] = cls.version
+        cls._pending[key] = cls.version
+
+    @classmethod
+    def changed_since(cls, keys, since: int):
+        """
+        {key: version} of the keys written after version `since`.
+        """
+        with cls._lock:
+            return {key: cls.versions[key] for key in keys if cls.versions.get(key, 0) > since}
+
+    @classmethod
+    def wait_for_change(cls, keys, timeout: float = None, since: int = None):
+        """
+        Block until one of `keys` is written after version `since`.
+
+        Args:
+            keys: Keys to watch
+            timeout: Seconds to wait; None waits indefinitely
+            since: Version the caller has already seen (e.g. SharedRsc.version
+                read before its last check); defaults to the current version
+
+        Returns:
+            {key: version} of the changed keys; empty on timeout
+        """
+        with cls._lock:
+            if since is None:
+                since = cls.version
+            changed = {}
+
+            def check():
+                changed.update(cls.changed_since(keys, since))
+                return changed
+
+            cls._changed.wait_for(check, timeout)
+            return changed
+
+    @classmethod
+    def subscribe(cls, keys, callback):
+        """
+        Call callback(key, value, version) after every write to one of `keys`.
+        """
+        if isinstance(keys, str):
+            keys = [keys]
+        with cls._lock:
+            for key in keys:
+                cls._subscribers.setdefault(key, []).append(callback)
+
+    @classmethod
+    def unsubscribe(cls, keys, callback):
+        if isinstance(keys, str):
+            keys = [keys]
+        with cls._lock:
+            for key in keys:
+                callbacks = cls._subscribers.get(key, [])
+                if callback in callbacks:
+                    callbacks.remove(callback)
+
 sharedResources = SharedRsc()
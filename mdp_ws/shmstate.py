@@ -0,0 +1,369 @@
+import logging
+import pickle
+import queue
+import struct
+import threading
+import time
+import zlib
+from multiprocessing import resource_tracker, shared_memory
+
+import numpy as np
+
+from state import QueueLike
+
+logger = logging.getLogger("ShmState")
+
+MAGIC = b"MDPSHM01"
+HEADER = struct.Struct("<8sI")  # magic, layout checksum
+SEQ = struct.Struct("<Q")
+
+# Numeric keys: (SharedRsc key, struct format of the value(s), Python type of a single value).
+# Multi-value keys (CAR.POSE) are stored and returned as tuples.
+NUMERIC_KEYS = (
+    ("CAR.RANGE", "d", float),
+    ("CAR.GYRO.Z", "d", float),
+    ("CAR.POSE", "3d", tuple),
+    ("CV.FRAME.T", "q", int),
+)
+# Queue-type keys: (SharedRsc key, capacity, maximum pickled item size).
+# Capacities match the Queue(1)s the protocols create.
+CHANNEL_KEYS = (
+    ("TASK.MODE.REQ", 1, 64),
+    ("TASK.STATUS.REQ", 1, 64),
+    ("APP.MOVE.REQ", 1, 64),
+)
+DETECTIONS_KEY = "CV.DETECTIONS"
+DETECTION_COLUMNS = ("class_id", "confidence", "x1", "y1", "x2", "y2")
+MAX_DETECTIONS = 32
+
+
+def _align(offset, size=8):
+    return (offset + size - 1) // size * size
+
+
+class SeqlockSlot:
+    """
+    One fixed-size record guarded by a sequence counter.
+
+    The single writer makes the counter odd, writes the payload and makes it
+    even again; readers retry until they see the same even counter before
+    and after copying the payload, so they never return a torn value and
+    never block the writer. Writers in one process are serialised by a
+    local lock; each key must be written from one process only.
+    """
+
+    def __init__(self, buf, offset, fmt):
+        self.buf = buf
+        self.offset = offset
+        self.body = struct.Struct("<q" + fmt)  # write time (monotonic ns), value(s)
+        self.size = _align(SEQ.size + self.body.size)
+        self._lock = threading.Lock()
+
+    def write(self, values, t_ns=None):
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        with self._lock:
+            seq = SEQ.unpack_from(self.buf, self.offset)[0]
+            SEQ.pack_into(self.buf, self.offset, seq + 1)
+            self.body.pack_into(self.buf, self.offset + SEQ.size, t_ns, *values)
+            SEQ.pack_into(self.buf, self.offset, seq + 2)
+
+    def read(self):
+        """
+        (seq, t_ns, values); seq is 0 if never written.
+        """
+        while True:
+            seq = SEQ.unpack_from(self.buf, self.offset)[0]
+            if seq & 1:
+                time.sleep(0)
+                continue
+            t_ns, *values = self.body.unpack_from(self.buf, self.offset + SEQ.size)
+            if SEQ.unpack_from(self.buf, self.offset)[0] == seq:
+                return seq, t_ns, values
+
+
+class DetectionTable:
+    """
+    Seqlock-guarded table of up to `rows` detections of DETECTION_COLUMNS,
+    written by the vision process and read as a (n, 6) float64 array.
+    """
+
+    def __init__(self, buf, offset, rows):
+        self.buf = buf
+        self.offset = offset
+        self.rows = rows
+        self.header = struct.Struct("<QqI")  # seq, frame time (monotonic ns), row count
+        self.table_offset = offset + _align(self.header.size)
+        self.size = _align(self.header.size) + rows * len(DETECTION_COLUMNS) * 8
+        self.table = np.ndarray((rows, len(DETECTION_COLUMNS)), dtype=np.float64, buffer=buf,
+                                offset=self.table_offset)
+        self._lock = threading.Lock()
+
+    def write(self, detections, t_ns=None):
+        detections = np.asarray(detections, dtype=np.float64).reshape(-1, len(DETECTION_COLUMNS))
+        if len(detections) > self.rows:
+            logger.warning("Dropping %d detections beyond the table size", len(detections) - self.rows)
+            detections = detections[:self.rows]
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        n = len(detections)
+        with self._lock:
+            seq = SEQ.unpack_from(self.buf, self.offset)[0]
+            SEQ.pack_into(self.buf, self.offset, seq + 1)
+            self.table[:n] = detections
+            self.header.pack_into(self.buf, self.offset, seq + 1, t_ns, n)
+            SEQ.pack_into(self.buf, self.offset, seq + 2)
+
+    def read(self):
+        """
+        (seq, frame t_ns, detections array copy).
+        """
+        while True:
+            seq, t_ns, n = self.header.unpack_from(self.buf, self.offset)
+            if seq & 1:
+                time.sleep(0)
+                continue
+            rows = self.table[:n].copy()
+            if SEQ.unpack_from(self.buf, self.offset)[0] == seq:
+                return seq, t_ns, rows
+
+
+class ShmChannel:
+    """
+    Bounded single-consumer message ring in shared memory with the subset
+    of the queue.Queue interface used for request keys (put_nowait,
+    get_nowait, blocking get/put with timeout, empty, full, qsize).
+
+    Items are pickled into fixed-size slots. Producers in one process are
+    serialised by a local lock; there must be one consuming process.
+    Blocking calls poll with a short backoff since there is no cross-process
+    condition variable.
+    """
+    POLL_MAX = 0.002
+
+    def __init__(self, buf, offset, key, capacity, item_size):
+        self.buf = buf
+        self.offset = offset
+        self.key = key
+        self.capacity = capacity
+        self.item_size = item_size
+        self.counters = struct.Struct("<QQ")  # head (items ever put), tail (items ever taken)
+        self.entry = struct.Struct("<H")  # pickled length
+        self.entries_offset = offset + self.counters.size
+        self.entry_size = _align(self.entry.size + item_size)
+        self.size = self.counters.size + capacity * self.entry_size
+        self._put_lock = threading.Lock()
+        self._get_lock = threading.Lock()
+
+    def _counts(self):
+        return self.counters.unpack_from(self.buf, self.offset)
+
+    def qsize(self):
+        head, tail = self._counts()
+        return head - tail
+
+    def empty(self):
+        return self.qsize() == 0
+
+    def full(self):
+        return self.qsize() >= self.capacity
+
+    def put_nowait(self, item):
+        data = pickle.dumps(item, protocol=pickle.HIGHEST_PROTOCOL)
+        if len(data) > self.item_size:
+            raise ValueError(f"{self.key} item too large ({len(data)} > {self.item_size} bytes)")
+        with self._put_lock:
+            head, tail = self._counts()
+            if head - tail >= self.capacity:
+                raise queue.Full
+            entry = self.entries_offset + (head % self.capacity) * self.entry_size
+            self.entry.pack_into(self.buf, entry, len(data))
+            self.buf[entry + self.entry.size:entry + self.entry.size + len(data)] = data
+            # Publishing the new head makes the entry visible to the consumer.
+            SEQ.pack_into(self.buf, self.offset, head + 1)
+
+    def get_nowait(self):
+        with self._get_lock:
+            head, tail = self._counts()
+            if head == tail:
+                raise queue.Empty
+            entry = self.entries_offset + (tail % self.capacity) * self.entry_size
+            length = self.entry.unpack_from(self.buf, entry)[0]
+            item = pickle.loads(self.buf[entry + self.entry.size:entry + self.entry.size + length])
+            SEQ.pack_into(self.buf, self.offset + SEQ.size, tail + 1)
+            return item
+
+    def _poll(self, attempt, block, timeout, deadline, error):
+        if not block or (timeout is not None and time.monotonic() >= deadline):
+            raise error
+        time.sleep(min(self.POLL_MAX, 0.0001 * 2 ** min(attempt, 5)))
+
+    def get(self, block=True, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        attempt = 0
+        while True:
+            try:
+                return self.get_nowait()
+            except queue.Empty:
+                self._poll(attempt, block, timeout, deadline, queue.Empty)
+                attempt += 1
+
+    def put(self, item, block=True, timeout=None):
+        deadline = time.monotonic() + timeout if timeout is not None else None
+        attempt = 0
+        while True:
+            try:
+                return self.put_nowait(item)
+            except queue.Full:
+                self._poll(attempt, block, timeout, deadline, queue.Full)
+                attempt += 1
+
+    def clear(self):
+        """
+        Drop pending items (consumer side).
+        """
+        with self._get_lock:
+            head, _ = self._counts()
+            SEQ.pack_into(self.buf, self.offset + SEQ.size, head)
+
+
+QueueLike.register(ShmChannel)
+
+
+class SharedMemoryState:
+    """
+    Fixed-layout shared-memory block holding the state that crosses process
+    boundaries: NUMERIC_KEYS in seqlock slots, the CV detection table, and
+    a ShmChannel per CHANNEL_KEYS entry.
+
+    The control process creates the block and installs it as the SharedRsc
+    backend (`SharedRsc.set_backend`); a vision process attaches by name and
+    writes CV.DETECTIONS / CV.FRAME.T with `write()` (or through its own
+    SharedRsc with the backend installed), without sharing a GIL with the
+    serial and TaskServer threads.
+
+    Args:
+        name: Shared memory name; None picks a random one when creating
+        create: Create the block (control process) or attach to it
+        untrack: When attaching, stop this process's multiprocessing resource
+            tracker from unlinking the block at exit. Leave True for a
+            separately started process; pass False in children started with
+            multiprocessing from the creator, which share its tracker
+    """
+
+    def __init__(self, name=None, create=True, untrack=True):
+        layout_size = self._layout()
+        if create:
+            self.shm = shared_memory.SharedMemory(name=name, create=True, size=layout_size)
+            self.shm.buf[:layout_size] = bytes(layout_size)
+            HEADER.pack_into(self.shm.buf, 0, MAGIC, self._checksum())
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+            if untrack:
+                # Only the creator may unlink the block.
+                resource_tracker.unregister(self.shm._name, "shared_memory")
+            magic, checksum = HEADER.unpack_from(self.shm.buf, 0)
+            if magic != MAGIC or checksum != self._checksum():
+                self.shm.close()
+                raise ValueError(f"Shared memory {name} has a different state layout")
+        self.name = self.shm.name
+        self.created = create
+        self._bind(self.shm.buf)
+
+    @staticmethod
+    def _checksum():
+        return zlib.crc32(repr((NUMERIC_KEYS, CHANNEL_KEYS, DETECTION_COLUMNS, MAX_DETECTIONS)).encode())
+
+    def _layout(self, buf=None):
+        """
+        Compute the offsets of every region; with `buf`, also create the accessors.
+        Returns the total size.
+        """
+        offset = _align(HEADER.size)
+        slots = {}
+        for key, fmt, kind in NUMERIC_KEYS:
+            slot = SeqlockSlot(buf, offset, fmt)
+            slots[key] = (slot, kind)
+            offset += slot.size
+        table = DetectionTable(buf, offset, MAX_DETECTIONS) if buf is not None else None
+        offset += _align(struct.calcsize("<QqI")) + MAX_DETECTIONS * len(DETECTION_COLUMNS) * 8
+        channels = {}
+        for key, capacity, item_size in CHANNEL_KEYS:
+            channel = ShmChannel(buf, offset, key, capacity, item_size)
+            channels[key] = channel
+            offset += _align(channel.size)
+        if buf is not None:
+            self.slots = slots
+            self.detections = table
+            self.channels = channels
+        return offset
+
+    def _bind(self, buf):
+        self._layout(buf)
+        self.keys = frozenset(self.slots) | frozenset(self.channels) | {DETECTIONS_KEY}
+
+    def write(self, key, val, t_ns=None):
+        """
+        Store a value for `key`.
+
+        Returns:
+            The value SharedRsc should keep locally: the ShmChannel for
+            channel keys (writing a Queue just clears the channel), else `val`
+        """
+        if key in self.channels:
+            channel = self.channels[key]
+            if val is not channel:
+                channel.clear()
+            return channel
+        if val is None:
+            return val
+        if key == DETECTIONS_KEY:
+            self.detections.write(val, t_ns)
+            return val
+        slot, kind = self.slots[key]
+        slot.write(tuple(val) if kind is tuple else (val,), t_ns)
+        return val
+
+    def read(self, key):
+        """
+        Latest value of `key` written by any process (None if never written).
+        """
+        if key in self.channels:
+            return self.channels[key]
+        if key == DETECTIONS_KEY:
+            seq, _, rows = self.detections.read()
+            return rows if seq else None
+        slot, kind = self.slots[key]
+        seq, _, values = slot.read()
+        if not seq:
+            return None
+        return tuple(values) if kind is tuple else values[0]
+
+    def read_stamped(self, key):
+        """
+        (seq, t_ns, value) for numeric and detection keys; seq changes on every write.
+        """
+        if key == DETECTIONS_KEY:
+            return self.detections.read()
+        slot, kind = self.slots[key]
+        seq, t_ns, values = slot.read()
+        return seq, t_ns, (tuple(values) if kind is tuple else values[0])
+
+    def change_count(self, key):
+        """
+        Counter that changes on every write of `key` (puts for channel keys), for change polling.
+        """
+        if key in self.channels:
+            return self.channels[key]._counts()[0]
+        if key == DETECTIONS_KEY:
+            return SEQ.unpack_from(self.shm.buf, self.detections.offset)[0]
+        slot, _ = self.slots[key]
+        return SEQ.unpack_from(self.shm.buf, slot.offset)[0]
+
+    def close(self):
+        # Drop the numpy view before closing the mapping.
+        self.detections.table = None
+        self.slots = self.channels = self.detections = None
+        self.shm.close()
+        if self.created:
+            self.shm.unlink()
@@ -0,0 +1,181 @@
+from abc import ABC
+from queue import Queue
+
+import definitions
+
+
+class QueueLike(ABC):
+    """
+    Accepted type of queue-valued keys: queue.Queue and registered
+    look-alikes such as shmstate.ShmChannel.
+    """
+
+
+QueueLike.register(Queue)
+
+
+class StateHandle:
+    """
+    Precomputed accessor for one typed SharedRsc key.
+
+    Obtained from `SharedRsc.handle(key)` once (e.g. when a protocol sets up
+    its shared resources) so hot paths skip the key lookup: `get()` is a slot
+    read and `set()` validates, stores and bumps the key's version.
+    """
+    __slots__ = ("key", "record", "attr", "types", "choices", "_store")
+
+    def __init__(self, key, record, attr, types, choices, store):
+        self.key = key
+        self.record = record
+        self.attr = attr
+        self.types = types
+        self.choices = choices
+        self._store = store
+
+    def get(self):
+        return getattr(self.record, self.attr)
+
+    def validate(self, val):
+        """
+        Raise TypeError/ValueError unless `val` fits the field (None is always accepted).
+        """
+        if val is None:
+            return
+        if self.types is not None and not isinstance(val, self.types):
+            raise TypeError(f"{self.key} expects {self.types}, got {type(val).__name__}: {val!r}")
+        if self.choices is not None and val not in self.choices:
+            raise ValueError(f"{self.key} must be one of {self.choices}, got {val!r}")
+
+    def write(self, val):
+        """
+        Validate and store without versioning; SharedRsc calls this under its lock.
+        """
+        self.validate(val)
+        setattr(self.record, self.attr, val)
+
+    def set(self, val):
+        self._store(self, val)
+
+
+class KeyHandle:
+    """
+    Same interface as StateHandle for keys without a schema entry.
+    """
+    __slots__ = ("key", "_store")
+
+    def __init__(self, key, store):
+        self.key = key
+        self._store = store
+
+    def get(self):
+        return self._store.get(self.key)
+
+    def set(self, val):
+        self._store.set(self.key, val)
+
+
+class StateRecord:
+    """
+    Base for typed state records.
+
+    Subclasses list their fields in FIELDS as (attribute, SharedRsc key,
+    accepted types or None, allowed values or None) and declare the same
+    attributes in __slots__. Once installed with `SharedRsc.install()`, the
+    record's slots are the storage for those keys: `SharedRsc.get/set` keep
+    working, attribute reads (`state.car.gyro_z`) are plain slot reads, and
+    writes are type-checked. Writes should go through SharedRsc or a handle
+    so that they are versioned and wake waiters.
+    """
+    __slots__ = ()
+    FIELDS = ()
+
+    def __init__(self):
+        for attr, _, _, _ in self.FIELDS:
+            setattr(self, attr, None)
+
+    def keys(self):
+        return [key for _, key, _, _ in self.FIELDS]
+
+    def as_dict(self):
+        """
+        {SharedRsc key: value} of every field.
+        """
+        return {key: getattr(self, attr) for attr, key, _, _ in self.FIELDS}
+
+
+_NUMBER = (int, float)
+
+
+class CarState(StateRecord):
+    __slots__ = ("range", "gyro_z", "status", "move_req", "telemetry", "pose")
+    FIELDS = (
+        ("range", "CAR.RANGE", _NUMBER, None),
+        ("gyro_z", "CAR.GYRO.Z", _NUMBER, None),
+        ("status", "CAR.STATUS", str, None),
+        ("move_req", "CAR.MOVE.REQ", QueueLike, None),
+        ("telemetry", "CAR.TELEMETRY", None, None),
+        ("pose", "CAR.POSE", tuple, None),
+    )
+
+
+class TaskState(StateRecord):
+    __slots__ = ("mode", "status", "mode_req", "status_req", "progress")
+    FIELDS = (
+        ("mode", "TASK.MODE", str, tuple(definitions.MODES)),
+        ("status", "TASK.STATUS", str, tuple(definitions.TASKSTATUSES)),
+        ("mode_req", "TASK.MODE.REQ", QueueLike, None),
+        ("status_req", "TASK.STATUS.REQ", QueueLike, None),
+        ("progress", "TASK.PROGRESS", float, None),  # Planning progress, 0.0 to 1.0
+    )
+
+
+class AppState(StateRecord):
+    __slots__ = ("move_req", "map_str", "map_new_flag", "arena")
+    FIELDS = (
+        ("move_req", "APP.MOVE.REQ", QueueLike, None),
+        ("map_str", "MAP.STR", str, None),
+        ("map_new_flag", "MAP.NEW.FLAG", int, None),
+        ("arena", "MAP.ARENA", None, None),  # arenamap.ArenaMap parsed from MAP.STR
+    )
+
+
+class CVState(StateRecord):
+    __slots__ = ("detections", "frame_t")
+    FIELDS = (
+        ("detections", "CV.DETECTIONS", None, None),  # Latest detection table
+        ("frame_t", "CV.FRAME.T", int, None),  # Capture time (monotonic ns) of that frame
+    )
+
+
+class State:
+    """
+    The typed records for car, task, app and CV state.
+    """
+    __slots__ = ("car", "task", "app", "cv")
+
+    def __init__(self):
+        self.car = CarState()
+        self.task = TaskState()
+        self.app = AppState()
+        self.cv = CVState()
+
+    def records(self):
+        return (self.car, self.task, self.app, self.cv)
+
+
+def install_state(store, strict=True):
+    """
+    Create a State and install its records into `store` (a SharedRsc).
+
+    Args:
+        store: SharedRsc class or instance
+        strict: Reject (KeyError) keys that share a schema prefix (CAR., TASK.,
+            APP., MAP., CV.) but are not in the schema, so typos fail fast
+
+    Returns:
+        The installed State
+    """
+    state = State()
+    for record in state.records():
+        store.install(record, strict)
+    return state
@@ -1,8 +1,17 @@
+import asyncio
 import threading
+from collections import deque
 import time
 import logging
+from concurrent.futures import ThreadPoolExecutor
 from queue import Queue, Empty
 from sharedResources import SharedRsc, sharedResources
+from events import EventSource, EVENT_STOP
+from looptiming import LoopTiming
+from arenamap import ArenaMap
+from planner import START_POSE
+from plancache import PlanCache
+from journal import journal_source
 from definitions import *
 from car import Car
 from androidapp import AndroidApp
@@ -10,7 +19,23 @@ from androidapp import AndroidApp
 logger = logging.getLogger("TaskServer")
 
 class TaskServer:
-    def __init__(self, car: Car, android_app: AndroidApp, shared_resources: SharedRsc):
+    # Shared resources whose writes are dispatched to the active mode handler.
+    # Handlers that need periodic work schedule timers with self.events.schedule().
+    EVENT_KEYS = ("TASK.MODE.REQ", "APP.MOVE.REQ", "TASK.STATUS.REQ", "MAP.NEW.FLAG",
+                  "CAR.STATUS", "CV.DETECTIONS")
+    # Source of the TaskServer's own changes in a StateJournal, on any runtime.
+    JOURNAL_SOURCE = "TaskServer"
+
+    def __init__(self, car: Car, android_app: AndroidApp, shared_resources: SharedRsc,
+                 handler_deadline=0.02, plan_cache=None):
+        """
+        Args:
+            car, android_app: Devices driven by the mode handlers
+            shared_resources: SharedRsc the mode requests and state live in
+            handler_deadline: Mode handler time in seconds counted as an
+                overrun in self.timing, i.e. a handler starving the loop
+            plan_cache: PlanCache for TASK1 plans (default: in memory only)
+        """
         self.car = car
         self.android_app = android_app
         self.shared_resources = shared_resources
@@ -18,6 +43,26 @@ class TaskServer:
         self.mode_changed = False
         self._running = False
         self.loop_thread = None
+        # Precomputed accessors for the keys read on every dispatch.
+        self.mode_handle = shared_resources.handle("TASK.MODE")
+        self.events = EventSource(shared_resources, self.EVENT_KEYS)
+        # Dispatch jitter, handler/setup time per mode and overruns; see timing.summary().
+        self.timing = LoopTiming(deadline=handler_deadline)
+        self._modes = {
+            "MANUAL": (self.setup_manual, self.loop_manual),
+            "TASK1": (self.setup_task1, self.loop_task1),
+            "TASK2": (self.setup_task2, self.loop_task2),
+            "TASKB": (self.setup_taskB, self.loop_taskB),
+        }
+        self.executor = None  # Created on first submit_job()
+        # TASK1 run: its id (None while no run is active), the plan job, the
+        # remaining (obstacle id or None, direction, value) moves and the one in flight.
+        self.task1_run = None
+        self.task1_plan = None
+        self.task1_moves = deque()
+        self.task1_handle = None
+        self._task1_runs = 0
+        self.plan_cache = plan_cache if plan_cache is not None else PlanCache()
 
         # Ensure mode request queue exists
         if not self.shared_resources.get("TASK.MODE.REQ"):
@@ -25,12 +70,17 @@ class TaskServer:
 
     def setup_manual(self):
         logger.info("[TaskServer] Setting up MANUAL mode")
+        self._cancel_task1()
+        self._drop_status_requests()
         self.shared_resources.set("APP.MOVE.REQ", Queue(1))
     
-    def loop_manual(self):
+    def loop_manual(self, event=None):
         logger.debug("[TaskServer] Loop MANUAL mode")
+        if event is not None and event.key == "TASK.STATUS.REQ":
+            self._drop_status_requests()
+            return
         try:
-            move_cmd = self.shared_resources.get("APP.MOVE.REQ").get_nowait()
+            move_cmd = self.shared_resources.take("APP.MOVE.REQ")
             # Use standardized API: move_standard for Car.
             self.car.move(move_cmd)
         except Empty:
@@ -38,31 +88,145 @@ class TaskServer:
 
     def setup_task1(self):
         logger.info("[TaskServer] Setting up TASK1 mode")
-        # TODO: Initialize components specific to TASK1.
-        pass
+        self._cancel_task1()
+        # A START sent before TASK1 was selected is not acted on later.
+        self._drop_status_requests()
 
-    def loop_task1(self):
+    def loop_task1(self, event=None):
         logger.debug("[TaskServer] Loop TASK1 mode")
-        # TODO: Add processing logic for TASK1.
-        pass
+        if event is None:
+            return
+        if event.key == "TASK.STATUS.REQ":
+            try:
+                status = self.shared_resources.take("TASK.STATUS.REQ")
+            except Empty:
+                return
+            if status == "START":
+                self._start_task1()
+            elif status == "STOP":
+                self._finish_task1("stopped")
+        elif event.key == "TASK1.PROGRESS":
+            run, done, total = event.value
+            if run != self.task1_run:
+                return
+            self.shared_resources.set("TASK.PROGRESS", done / total)
+            logger.info("TASK1 planning: %d/%d cost columns", done, total)
+        elif event.key == "TASK1.PLAN" and event.value is self.task1_plan:
+            self._on_task1_plan(event.value)
+        elif event.key == "TASK1.MOVE" and event.value is self.task1_handle:
+            self._next_task1_move(event.value)
+
+    def _start_task1(self):
+        if self.task1_run is not None:
+            logger.warning("TASK1 run %d already in progress; ignoring START", self.task1_run)
+            return
+        arena = self.shared_resources.get("MAP.ARENA")
+        if arena is None:
+            logger.error("TASK1 needs a map; send MAP first")
+            return
+        self._task1_runs += 1
+        run = self.task1_run = self._task1_runs
+        self.shared_resources.set("TASK.STATUS", "IN-PROGRESS")
+        self.car.pose.reset(*START_POSE)
+        # Planning takes tens to hundreds of milliseconds (the cost matrix runs on
+        # a process pool); keep the dispatch loop responsive meanwhile. A map seen
+        # before is answered from the plan cache. Plan and progress events of a
+        # run that has since ended are dropped.
+        self.shared_resources.set("TASK.PROGRESS", 0.0)
+        self.task1_plan = self.submit_job(
+            "TASK1.PLAN", self.plan_cache.plan_task1, arena,
+            progress=lambda done, total: self.events.post("TASK1.PROGRESS", (run, done, total)))
+
+    def _on_task1_plan(self, future):
+        try:
+            legs = future.result()
+        except Exception as e:
+            logger.error("TASK1 planning failed: %s", e)
+            self._finish_task1("planning failed")
+            return
+        self.task1_plan = None
+        self.task1_moves.clear()
+        for obstacle_id, path in legs:
+            logger.info("TASK1 leg to obstacle %d: %s", obstacle_id, path)
+            for i, (direction, value) in enumerate(path.commands):
+                last = i == len(path.commands) - 1
+                self.task1_moves.append((obstacle_id if last else None, direction, value))
+        self._next_task1_move()
+
+    def _next_task1_move(self, finished=None):
+        if finished is not None:
+            if finished.exception() is not None:
+                logger.error("TASK1 move %s failed: %s", finished.command, finished.exception())
+                self._finish_task1("move failed")
+                return
+        if not self.task1_moves:
+            self._finish_task1("done")
+            return
+        obstacle_id, direction, value = self.task1_moves.popleft()
+        if obstacle_id is not None:
+            logger.info("TASK1 approaching capture pose of obstacle %d", obstacle_id)
+        handle = self.car.move(direction, value)
+        self.task1_handle = handle
+        handle.add_done_callback(lambda done: self.events.post("TASK1.MOVE", done))
+
+    def _finish_task1(self, reason):
+        if self.task1_handle is not None and not self.task1_handle.done():
+            self.car.stop()
+        run = self.task1_run
+        self.task1_run = None
+        self.task1_plan = None
+        self.task1_moves.clear()
+        self.task1_handle = None
+        self.shared_resources.set("TASK.STATUS", "STOP")
+        logger.info("TASK1 run %s %s", run, reason)
+
+    def _cancel_task1(self):
+        """
+        End an active TASK1 run on a mode change, stopping the car if it is moving.
+        """
+        if self.task1_run is not None:
+            self._finish_task1("cancelled by mode change")
+
+    def _drop_status_requests(self):
+        """
+        Discard TASK.STATUS.REQ entries the current mode does not act on, e.g. a
+        START sent in MANUAL, so they cannot fill the request queue and make
+        AndroidApp reject later requests.
+        """
+        while True:
+            try:
+                status = self.shared_resources.take("TASK.STATUS.REQ")
+            except Empty:
+                return
+            logger.warning("Ignoring task status %s (mode %s)", status, self.mode_handle.get())
 
     def setup_task2(self):
         logger.info("[TaskServer] Setting up TASK2 mode")
+        self._cancel_task1()
+        self._drop_status_requests()
         # TODO: Initialize components specific to TASK2.
         pass
 
-    def loop_task2(self):
+    def loop_task2(self, event=None):
         logger.debug("[TaskServer] Loop TASK2 mode")
+        if event is not None and event.key == "TASK.STATUS.REQ":
+            self._drop_status_requests()
+            return
         # TODO: Add processing logic for TASK2.
         pass
 
     def setup_taskB(self):
         logger.info("[TaskServer] Setting up TASKB mode")
+        self._cancel_task1()
+        self._drop_status_requests()
         # TODO: Initialize components specific to TASKB.
         pass
 
-    def loop_taskB(self):
+    def loop_taskB(self, event=None):
         logger.debug("[TaskServer] Loop TASKB mode")
+        if event is not None and event.key == "TASK.STATUS.REQ":
+            self._drop_status_requests()
+            return
         # TODO: Add processing logic for TASKB.
         pass
 
@@ -73,52 +237,153 @@ class TaskServer:
 
     def _handle_mode_change(self):
         try:
-            mode_queue = self.shared_resources.get("TASK.MODE.REQ")
-            new_mode = mode_queue.get_nowait()
-            self.shared_resources.set("TASK.MODE", new_mode)
+            new_mode = self.shared_resources.take("TASK.MODE.REQ")
+            self.mode_handle.set(new_mode)
             self.current_mode = new_mode
             self.mode_changed = True
-            logger.info(f"Switched to mode: {new_mode}")
+            logger.info("Switched to mode: %s", new_mode)
         except Empty:
             pass
 
+    def _handle_map_update(self, event):
+        """
+        Parse a new MAP.STR into MAP.ARENA (obstacle table, occupancy grid and
+        configuration space) and clear MAP.NEW.FLAG.
+        """
+        if event is None or event.key != "MAP.NEW.FLAG" or not event.value:
+            return
+        text = self.shared_resources.get("MAP.STR")
+        try:
+            arena = ArenaMap.from_string(text)
+        except ValueError as e:
+            logger.error("Rejected map: %s", e)
+        else:
+            self.shared_resources.set("MAP.ARENA", arena)
+            logger.info("Map loaded: %s", arena)
+        self.shared_resources.set("MAP.NEW.FLAG", 0)
+
+    def step(self, event=None):
+        """
+        One scheduling pass: apply a pending mode request and run the current
+        mode's handler with `event` (after its setup if the mode just changed).
+
+        Returns:
+            The mode that was run
+        """
+        self.mode_changed = False
+        self._handle_mode_change()
+        self._handle_map_update(event)
+        mode = self.mode_handle.get()
+        if mode is None:
+            mode = "MANUAL"
+            self.mode_handle.set(mode)
+        handlers = self._modes.get(mode)
+        if handlers is None:
+            logger.warning("Unknown mode: %s", mode)
+            return mode
+        setup, handler = handlers
+        if self.mode_changed:
+            start = time.perf_counter_ns()
+            setup()
+            self.timing.record_setup(mode, (time.perf_counter_ns() - start) / 1e9)
+        start = time.perf_counter_ns()
+        handler(event)
+        self.timing.record_handler(mode, (time.perf_counter_ns() - start) / 1e9,
+                                   None if event is None else event.key)
+        return mode
+
+    def submit_job(self, name, fn, *args, executor=None, **kwargs):
+        """
+        Run CPU-heavy work (planning, inference) off the dispatch thread.
+        When it finishes, TaskEvent(name, future) is dispatched to the active mode handler.
+
+        Args:
+            name: Event key for the completion
+            fn, args, kwargs: Work to run
+            executor: concurrent.futures executor; defaults to a small thread pool
+        """
+        if executor is None:
+            if self.executor is None:
+                self.executor = ThreadPoolExecutor(max_workers=2, thread_name_prefix="TaskJob")
+            executor = self.executor
+        future = executor.submit(fn, *args, **kwargs)
+        future.add_done_callback(lambda done: self.events.post(name, done))
+        return future
+
+    def dispatch(self, event):
+        """
+        Record how late the event is being handled and run one scheduling pass for it.
+        """
+        self.timing.record_jitter(event.key, (time.monotonic_ns() - event.t_ns) / 1e9)
+        return self.step(event)
+
+    def _dispatch_guarded(self, event=None):
+        """
+        dispatch() (or the initial step() when `event` is None) that logs a
+        failing handler instead of ending the loop, so STOP keeps working.
+        """
+        try:
+            with journal_source(self.JOURNAL_SOURCE):
+                if event is None:
+                    self.step()
+                else:
+                    self.dispatch(event)
+        except Exception:
+            logger.exception("Mode %s failed handling %s", self.mode_handle.get(),
+                             "setup" if event is None else event.key)
+
     def loop(self):
         self._running = True
+        # Run once so the initial mode is set up without waiting for an event.
+        self._dispatch_guarded()
         while self._running:
-            self.mode_changed = False
-            self._handle_mode_change()
-            mode = self.shared_resources.get("TASK.MODE")
-            if mode is None:
-                mode = "MANUAL"
-                self.shared_resources.set("TASK.MODE", mode)
-            if mode == "MANUAL":
-                if self.mode_changed:
-                    self.setup_manual()
-                self.loop_manual()
-            elif mode == "TASK1":
-                if self.mode_changed:
-                    self.setup_task1()
-                self.loop_task1()
-            elif mode == "TASK2":
-                if self.mode_changed:
-                    self.setup_task2()
-                self.loop_task2()
-            elif mode == "TASKB":
-                if self.mode_changed:
-                    self.setup_taskB()
-                self.loop_taskB()
-            else:
-                logger.warning("Unknown mode: %s", mode)
-            time.sleep(0.05)
+            event = self.events.next()
+            if event.key == EVENT_STOP:
+                break
+            self._dispatch_guarded(event)
+
+    async def run_async(self):
+        """
+        The event loop of loop() as a coroutine, for the asyncio runtime.
+        Handlers run on the event loop; use submit_job() for anything slow.
+        """
+        self.events.attach_loop(asyncio.get_running_loop())
+        self.events.start()
+        self._running = True
+        self._dispatch_guarded()
+        try:
+            while self._running:
+                event = await self.events.next_async()
+                if event.key == EVENT_STOP:
+                    break
+                self._dispatch_guarded(event)
+        finally:
+            self.events.close()
+            self.log_timing()
+
+    def log_timing(self):
+        summary = self.timing.summary()
+        for table in ("jitter", "setup", "handler"):
+            for key, stats in summary[table].items():
+                logger.info("%s %s: %s", table, key, stats)
+        if summary["overruns"]:
+            logger.warning("Handler overruns (> %.1f ms): %s", summary["deadline_ms"], summary["overruns"])
+        logger.info("Loop busy %.1f%% of the time", summary["busy_fraction"] * 100)
 
     def start(self):
         if self.loop_thread is None or not self.loop_thread.is_alive():
-            self.loop_thread = threading.Thread(target=self.loop, daemon=True)
+            self.events.start()
+            self.loop_thread = threading.Thread(target=self.loop, name="TaskServer", daemon=True)
             self.loop_thread.start()
             logger.info("TaskServer started.")
 
     def stop(self):
         self._running = False
+        self.events.post(EVENT_STOP)
         if self.loop_thread:
             self.loop_thread.join()
+            self.events.close()
             logger.info("TaskServer stopped.")
+            self.log_timing()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
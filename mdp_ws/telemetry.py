@@ -0,0 +1,162 @@
+import time
+
+import numpy as np
+
+
+class TelemetryChannel:
+    """
+    Fixed-capacity ring buffer of (t_ns, value) samples for one telemetry channel.
+
+    Every sample is written twice, at i and i + capacity, so the most recent
+    `capacity` samples are always one contiguous slice and window queries
+    return NumPy views without copying or unwrapping.
+
+    There must be a single writer (the car RX thread). Readers take no lock:
+    a sample becomes visible only after it is fully written, and queries
+    never look further back than `capacity - guard` samples, so a reader is
+    only at risk if the writer appends more than `guard` samples while a
+    single query is running. Returned arrays are views into the buffer;
+    copy them to keep them beyond the next `guard` appends.
+
+    Args:
+        name: Channel name, e.g. "CAR.GYRO.Z"
+        capacity: Number of samples retained
+        period: For angular channels (e.g. 360.0 for a bearing in degrees),
+            interpolation and means wrap around this period
+        guard: Samples at the old end of the ring that queries never return
+    """
+
+    def __init__(self, name, capacity=4096, period=None, guard=64):
+        if capacity <= guard:
+            raise ValueError("capacity must be larger than guard")
+        self.name = name
+        self.capacity = capacity
+        self.period = period
+        self.guard = guard
+        self._t = np.zeros(2 * capacity, dtype=np.int64)
+        self._v = np.zeros(2 * capacity, dtype=np.float64)
+        self._count = 0  # Samples ever appended; published after each write
+
+    def __len__(self):
+        return min(self._count, self.capacity - self.guard)
+
+    def append(self, value, t_ns=None):
+        """
+        O(1) append. `t_ns` defaults to time.monotonic_ns() and must not decrease.
+        """
+        if t_ns is None:
+            t_ns = time.monotonic_ns()
+        count = self._count
+        i = count % self.capacity
+        j = i + self.capacity
+        self._t[i] = self._t[j] = t_ns
+        self._v[i] = self._v[j] = value
+        self._count = count + 1
+
+    def _views(self):
+        count = self._count
+        size = min(count, self.capacity - self.guard)
+        end = count % self.capacity + self.capacity
+        return self._t[end - size:end], self._v[end - size:end]
+
+    def latest(self):
+        """
+        (t_ns, value) of the newest sample, or None if empty.
+        """
+        count = self._count
+        if count == 0:
+            return None
+        i = (count - 1) % self.capacity
+        return int(self._t[i]), float(self._v[i])
+
+    def since(self, t_ns):
+        """
+        (times, values) views of every retained sample with time >= t_ns.
+        """
+        times, values = self._views()
+        start = np.searchsorted(times, t_ns, side="left")
+        return times[start:], values[start:]
+
+    def last(self, duration_s, now_ns=None):
+        """
+        (times, values) views of the samples from the last `duration_s` seconds.
+        """
+        if now_ns is None:
+            now_ns = time.monotonic_ns()
+        return self.since(now_ns - int(duration_s * 1e9))
+
+    def mean(self, duration_s, now_ns=None):
+        """
+        Mean over the last `duration_s` seconds (circular for angular channels), or None if no samples.
+        """
+        _, values = self.last(duration_s, now_ns)
+        if len(values) == 0:
+            return None
+        if self.period is None:
+            return float(values.mean())
+        angles = values * (2 * np.pi / self.period)
+        mean = np.arctan2(np.sin(angles).mean(), np.cos(angles).mean())
+        return float(mean * self.period / (2 * np.pi) % self.period)
+
+    def value_at(self, t_ns):
+        """
+        Value at time t_ns, linearly interpolated between the neighbouring
+        samples and clamped to the first/last retained sample. None if empty.
+        """
+        times, values = self._views()
+        if len(times) == 0:
+            return None
+        i = int(np.searchsorted(times, t_ns, side="right"))
+        if i == 0:
+            return float(values[0])
+        if i == len(times):
+            return float(values[-1])
+        t0, t1 = times[i - 1], times[i]
+        v0, v1 = values[i - 1], values[i]
+        frac = (t_ns - t0) / (t1 - t0) if t1 != t0 else 0.0
+        delta = v1 - v0
+        if self.period is not None:
+            # Shortest way round, e.g. 359 -> 1 is +2 degrees.
+            delta = (delta + self.period / 2) % self.period - self.period / 2
+            return float((v0 + frac * delta) % self.period)
+        return float(v0 + frac * delta)
+
+
+class TelemetryStore:
+    """
+    Named TelemetryChannels, fed by the car decoder.
+
+    `on_car_event` matches the CarInterface listener signature, so
+    `car.interface.add_listener(store.on_car_event)` records every numeric
+    telemetry message that has a channel.
+    """
+
+    def __init__(self, capacity=4096):
+        self.capacity = capacity
+        self.channels = {}
+
+    def add_channel(self, name, capacity=None, period=None):
+        channel = TelemetryChannel(name, capacity or self.capacity, period)
+        self.channels[name] = channel
+        return channel
+
+    def channel(self, name):
+        return self.channels.get(name)
+
+    def append(self, name, value, t_ns=None):
+        self.channels[name].append(value, t_ns)
+
+    def on_car_event(self, key, value):
+        channel = self.channels.get(key)
+        if channel is not None:
+            channel.append(value)
+
+
+def car_telemetry_store(capacity=4096):
+    """
+    TelemetryStore with the car's channels: CAR.GYRO.Z (bearing, degrees) and CAR.RANGE.
+    """
+    store = TelemetryStore(capacity)
+    store.add_channel("CAR.GYRO.Z", period=360.0)
+    store.add_channel("CAR.RANGE")
+    return store
@@ -0,0 +1,461 @@
+import atexit
+import logging
+import logging.handlers
+import math
+import multiprocessing
+import threading
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from multiprocessing import shared_memory
+
+import numpy as np
+
+from arenamap import ArenaMap
+from planner import START_POSE, Planner, capture_poses
+
+logger = logging.getLogger("Tour")
+
+# Obstacle counts up to this are ordered exactly (Held-Karp); larger ones heuristically.
+EXACT_LIMIT = 12
+# Legs costing more than this multiple of their grid distance (plus Planner.detour_slack)
+# are not worth driving; the search stops there and reports them as unreachable.
+DETOUR_LIMIT = 3.0
+
+
+def pair_cost(planner, start, goal, detour_limit=DETOUR_LIMIT):
+    """
+    Planner cost from pose `start` to pose `goal`; inf if unreachable or hopeless.
+    """
+    bound = math.inf
+    if detour_limit is not None:
+        lower = planner.lower_bound(start, goal)
+        if lower == math.inf:
+            return math.inf
+        bound = detour_limit * lower + planner.detour_slack
+    path = planner.plan(start, goal, bound=bound)
+    return math.inf if path is None else path.cost
+
+
+def _empty_matrix(n):
+    cost = np.full((n, n), math.inf)
+    np.fill_diagonal(cost, 0.0)
+    return cost
+
+
+def cost_matrix(planner, poses, detour_limit=DETOUR_LIMIT, progress=None):
+    """
+    Planner cost between every ordered pair of poses, in this process.
+
+    Args:
+        planner: Planner of the run
+        poses: List of (x, y, theta); poses[0] is the start
+        detour_limit: See pair_cost(); None plans every pair to completion
+        progress: Called as progress(done, total) after each goal column
+
+    Returns:
+        float array (n, n) with cost[i, j] from poses[i] to poses[j]
+        (inf if unreachable, 0 on the diagonal); nothing returns to the start
+    """
+    n = len(poses)
+    cost = _empty_matrix(n)
+    for j in range(1, n):
+        for i in range(n):
+            if i != j:
+                cost[i, j] = pair_cost(planner, poses[i], poses[j], detour_limit)
+        if progress is not None:
+            progress(j, n - 1)
+    return cost
+
+
+class _ForwardHandler(logging.Handler):
+    """
+    Hands log records from worker processes to the loggers of this process.
+    """
+
+    def emit(self, record):
+        logging.getLogger(record.name).handle(record)
+
+
+def _share_arena(arena):
+    """
+    Copy the obstacle table and configuration space of `arena` into a new
+    shared memory block.
+
+    Returns:
+        (SharedMemory, spec); the spec is what a worker needs to rebuild the
+        ArenaMap (see _load_arena()). The caller closes and unlinks the block.
+    """
+    obstacles = np.ascontiguousarray(arena.obstacles, dtype=np.int32)
+    cspace = np.ascontiguousarray(arena.cspace, dtype=bool)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, obstacles.nbytes + cspace.nbytes))
+    buf = np.ndarray(obstacles.nbytes + cspace.nbytes, dtype=np.uint8, buffer=shm.buf)
+    buf[:obstacles.nbytes] = obstacles.view(np.uint8).ravel()
+    buf[obstacles.nbytes:] = cspace.view(np.uint8).ravel()
+    del buf  # Release the export of shm.buf so the block can be closed
+    spec = (shm.name, obstacles.shape, cspace.shape,
+            dict(resolution=arena.resolution, length=arena.length, width=arena.width,
+                 clearance=arena.clearance))
+    return shm, spec
+
+
+def _load_arena(spec):
+    """
+    ArenaMap from a block made by _share_arena(). The arrays are copied out
+    (a few tens of kB), so the block is closed again at once.
+    """
+    name, obstacles_shape, cspace_shape, params = spec
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        count = int(np.prod(obstacles_shape))
+        obstacles = np.ndarray(obstacles_shape, dtype=np.int32, buffer=shm.buf).copy()
+        cspace = np.ndarray(cspace_shape, dtype=bool, buffer=shm.buf, offset=count * 4).copy()
+    finally:
+        shm.close()
+    return ArenaMap.from_arrays(obstacles, cspace, **params)
+
+
+# State of a PlannerPool worker process: the arena of the current plan and
+# its Planners by parameters; the motion lattice stays cached across plans.
+_worker_arena = None  # (shared memory name, ArenaMap)
+_worker_planners = {}
+
+
+def _init_worker(log_queue, level):
+    root = logging.getLogger()
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    root.addHandler(logging.handlers.QueueHandler(log_queue))
+    root.setLevel(level)
+
+
+def _worker_planner(spec, planner_kwargs):
+    global _worker_arena
+    if _worker_arena is None or _worker_arena[0] != spec[0]:
+        _worker_planners.clear()
+        _worker_arena = (spec[0], _load_arena(spec))
+    key = tuple(sorted(planner_kwargs.items()))
+    planner = _worker_planners.get(key)
+    if planner is None:
+        planner = _worker_planners[key] = Planner(_worker_arena[1], **planner_kwargs)
+    return planner
+
+
+def _warm(planner_kwargs):
+    Planner(ArenaMap(np.zeros((0, 4), dtype=np.int32)), **planner_kwargs)
+
+
+def _cost_column(spec, planner_kwargs, j, poses, detour_limit):
+    """
+    Costs from every pose to poses[j]; one task, so the goal's heuristic is built once.
+    """
+    planner = _worker_planner(spec, planner_kwargs)
+    goal = poses[j]
+    return j, [(i, pair_cost(planner, poses[i], goal, detour_limit))
+               for i in range(len(poses)) if i != j]
+
+
+class PlannerPool:
+    """
+    Persistent worker processes for parallel_cost_matrix().
+
+    Workers are started by the forkserver (spawn where it is unavailable),
+    never forked from the control process, whose I/O, logging and timer
+    threads may hold locks at that moment. They live for the whole run, so
+    process startup and the motion lattice are paid once per worker, not
+    once per plan. The arena of each plan is published once in shared
+    memory. Worker log records are forwarded to this process's loggers.
+
+    Args:
+        workers: Worker processes (default: one per CPU)
+        start_method: multiprocessing start method; "fork" is not safe here
+    """
+
+    def __init__(self, workers=None, start_method=None):
+        if start_method is None:
+            start_method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+        self.context = multiprocessing.get_context(start_method)
+        if start_method == "forkserver":
+            # The server imports the planner once; workers fork from it.
+            self.context.set_forkserver_preload(["tour"])
+        self.workers = workers or multiprocessing.cpu_count()
+        self._log_queue = self.context.Queue()
+        self._log_listener = logging.handlers.QueueListener(self._log_queue, _ForwardHandler())
+        self._log_listener.start()
+        self._executor = ProcessPoolExecutor(self.workers, mp_context=self.context, initializer=_init_worker,
+                                             initargs=(self._log_queue, logging.getLogger().getEffectiveLevel()))
+
+    def warm(self, **planner_kwargs):
+        """
+        Start every worker and build its motion lattice, so the first plan
+        does not pay for either. Blocks until done.
+        """
+        t0 = time.perf_counter()
+        for future in [self._executor.submit(_warm, planner_kwargs) for _ in range(self.workers)]:
+            future.result()
+        logger.info("%d planner workers ready in %.0f ms", self.workers, (time.perf_counter() - t0) * 1e3)
+
+    def cost_matrix(self, arena, poses, progress=None, detour_limit=DETOUR_LIMIT, **planner_kwargs):
+        """
+        Same as cost_matrix(), one goal column per task.
+        """
+        n = len(poses)
+        cost = _empty_matrix(n)
+        shm, spec = _share_arena(arena)
+        futures = []
+        try:
+            futures = [self._executor.submit(_cost_column, spec, planner_kwargs, j, poses, detour_limit)
+                       for j in range(1, n)]
+            for done, future in enumerate(as_completed(futures), 1):
+                j, column = future.result()
+                for i, value in column:
+                    cost[i, j] = value
+                if progress is not None:
+                    progress(done, n - 1)
+        finally:
+            for future in futures:
+                future.cancel()
+            shm.close()
+            shm.unlink()
+        return cost
+
+    def close(self):
+        self._executor.shutdown(wait=True, cancel_futures=True)
+        self._log_listener.stop()
+        self._log_queue.close()
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def planner_pool(workers=None):
+    """
+    The process-wide PlannerPool, created on first use with `workers`
+    processes; later calls return the same pool whatever `workers` is.
+    """
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = PlannerPool(workers)
+            atexit.register(close_planner_pool)
+        return _pool
+
+
+def close_planner_pool():
+    global _pool
+    with _pool_lock:
+        pool, _pool = _pool, None
+    if pool is not None:
+        pool.close()
+
+
+def parallel_cost_matrix(arena, poses, workers=None, progress=None, detour_limit=DETOUR_LIMIT,
+                         **planner_kwargs):
+    """
+    cost_matrix() spread over the process-wide PlannerPool.
+
+    Args:
+        arena: ArenaMap of the run
+        poses: List of (x, y, theta); poses[0] is the start
+        workers: Worker processes (default: one per CPU); 1 computes in this
+            process. Only the first call that needs the pool sizes it.
+        progress: Called as progress(done, total) in this process after each column
+        detour_limit: See pair_cost()
+        planner_kwargs: Planner parameters
+
+    Returns:
+        Same as cost_matrix()
+    """
+    workers = min(workers or multiprocessing.cpu_count(), max(len(poses) - 1, 1))
+    if workers <= 1:
+        return cost_matrix(Planner(arena, **planner_kwargs), poses, detour_limit, progress)
+    return planner_pool(workers).cost_matrix(arena, poses, progress, detour_limit, **planner_kwargs)
+
+
+def path_cost(cost, order):
+    """
+    Cost of visiting `order` (node indices) starting from node 0.
+    """
+    total = 0.0
+    prev = 0
+    for node in order:
+        total += cost[prev, node]
+        prev = node
+    return total
+
+
+def _reachable(cost):
+    """
+    Nodes reachable from node 0 over finite edges, in index order.
+    """
+    seen = {0}
+    frontier = [0]
+    while frontier:
+        i = frontier.pop()
+        for j in np.flatnonzero(np.isfinite(cost[i])):
+            j = int(j)
+            if j not in seen:
+                seen.add(j)
+                frontier.append(j)
+    return sorted(seen - {0})
+
+
+def held_karp(cost):
+    """
+    Exact cheapest open path from node 0 through nodes 1..n-1.
+
+    Dynamic programming over subsets, vectorized per subset size: for every
+    subset and last node, the best cost of visiting exactly that subset.
+    If no path covers every node (some legs are unreachable), the cheapest
+    path through the largest coverable subset is returned.
+
+    Returns:
+        (order as a list of node indices, cost)
+    """
+    m = len(cost) - 1
+    if m == 0:
+        return [], 0.0
+    c = cost[1:, 1:]
+    full = 1 << m
+    dp = np.full((full, m), math.inf)
+    parent = np.full((full, m), -1, dtype=np.int64)
+    bits = 1 << np.arange(m)
+    dp[bits, np.arange(m)] = cost[0, 1:]
+    masks = np.arange(full)
+    popcount = np.zeros(full, dtype=np.int64)
+    for b in range(m):
+        popcount += (masks >> b) & 1
+    for size in range(2, m + 1):
+        layer = masks[popcount == size]
+        for j in range(m):
+            with_j = layer[(layer >> j) & 1 == 1]
+            prev = with_j ^ (1 << j)
+            candidates = dp[prev] + c[:, j]  # (masks, previous node)
+            best = np.argmin(candidates, axis=1)
+            dp[with_j, j] = candidates[np.arange(len(with_j)), best]
+            parent[with_j, j] = best
+    ends = dp.min(axis=1)
+    finite = np.isfinite(ends)
+    if not finite.any():
+        return [], math.inf
+    # Most nodes first, then lowest cost; argmin picks the lowest mask on ties, so this is deterministic.
+    key = np.where(finite, -popcount * 1e12 + np.where(finite, ends, 0.0), math.inf)
+    mask = int(np.argmin(key))
+    last = int(np.argmin(dp[mask]))
+    total = float(dp[mask, last])
+    order = []
+    while mask:
+        order.append(last + 1)
+        prev = int(parent[mask, last])
+        mask ^= 1 << last
+        last = prev
+    order.reverse()
+    return order, total
+
+
+def improve_order(cost, order):
+    """
+    Local search on an open path: Or-opt (move a run of 1-3 nodes) and 2-opt
+    (reverse a segment), first improvement in a fixed scan order, until
+    neither helps. Deterministic for a given input.
+
+    Returns:
+        (order, cost)
+    """
+    best = list(order)
+    best_cost = path_cost(cost, best)
+    n = len(best)
+    improved = True
+    while improved:
+        improved = False
+        for length in (1, 2, 3):
+            for i in range(n - length + 1):
+                run = best[i:i + length]
+                rest = best[:i] + best[i + length:]
+                for k in range(len(rest) + 1):
+                    if k == i:
+                        continue
+                    candidate = rest[:k] + run + rest[k:]
+                    candidate_cost = path_cost(cost, candidate)
+                    if candidate_cost < best_cost - 1e-9:
+                        best, best_cost, improved = candidate, candidate_cost, True
+                        break
+                if improved:
+                    break
+            if improved:
+                break
+        if improved:
+            continue
+        for i in range(n - 1):
+            for k in range(i + 2, n + 1):
+                candidate = best[:i] + best[i:k][::-1] + best[k:]
+                candidate_cost = path_cost(cost, candidate)
+                if candidate_cost < best_cost - 1e-9:
+                    best, best_cost, improved = candidate, candidate_cost, True
+                    break
+            if improved:
+                break
+    return best, best_cost
+
+
+def nearest_neighbour(cost, nodes):
+    order = []
+    remaining = list(nodes)
+    prev = 0
+    while remaining:
+        nxt = min(remaining, key=lambda j: (cost[prev, j], j))
+        order.append(nxt)
+        remaining.remove(nxt)
+        prev = nxt
+    return order
+
+
+def solve_order(cost, exact_limit=EXACT_LIMIT):
+    """
+    Visiting order over a cost matrix from cost_matrix() (node 0 = start).
+
+    Nodes that cannot be reached from the start at all are left out. Up to
+    `exact_limit` nodes the order is optimal (held_karp); beyond that it is
+    nearest neighbour refined by improve_order().
+
+    Returns:
+        (order as node indices, cost)
+    """
+    nodes = _reachable(cost)
+    if len(nodes) < len(cost) - 1:
+        logger.warning("Unreachable from the start: %s", sorted(set(range(1, len(cost))) - set(nodes)))
+    sub = cost[np.ix_([0] + nodes, [0] + nodes)]
+    if len(nodes) <= exact_limit:
+        order, total = held_karp(sub)
+    else:
+        order, total = improve_order(sub, nearest_neighbour(sub, range(1, len(nodes) + 1)))
+    return [nodes[i - 1] for i in order], total
+
+
+def plan_task1(arena, start=START_POSE, exact_limit=EXACT_LIMIT, workers=None, progress=None, **kwargs):
+    """
+    TASK1 plan: visit the capture pose of every obstacle with an image face,
+    in the order with the lowest total planner cost.
+
+    Args:
+        arena: ArenaMap of the run
+        start: Start pose of the car
+        exact_limit: See solve_order()
+        workers, progress: See parallel_cost_matrix()
+        kwargs: Planner parameters
+
+    Returns:
+        List of (obstacle id, Path) legs in driving order
+    """
+    planner = Planner(arena, **kwargs)
+    goals = capture_poses(planner, arena.obstacles)
+    ids = list(goals)
+    poses = [start] + [goals[i] for i in ids]
+    t0 = time.perf_counter()
+    cost = parallel_cost_matrix(arena, poses, workers, progress, **kwargs)
+    logger.info("Cost matrix for %d poses in %.0f ms", len(poses), (time.perf_counter() - t0) * 1e3)
+    order, total = solve_order(cost, exact_limit)
+    logger.info("TASK1 order %s, cost %.1f", [ids[node - 1] for node in order], total)
+    # Replan the chosen chain from where each leg actually ends (within the goal tolerance).
+    legs, _ = planner.plan_route(start, [poses[node] for node in order])
+    return [(ids[order[i] - 1], path) for i, path in legs]